@@ -0,0 +1,647 @@
+import asyncio
+import argparse
+import email
+import email.policy
+import io
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from email.message import Message
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value, encode_rfc2231, format_datetime, getaddresses, parsedate_to_datetime
+import logging
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# Обработчик почты, который измеряется (лежит рядом с этим скриптом)
+PARSER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'e-mail-parser-v1.3.py')
+ORGANIZATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Список организаций.txt')
+
+# Способы загрузки: имя -> аргументы командной строки обработчика
+STRATEGIES = {
+    'sync': [],
+    'prescan': ['--prescan'],
+    'streaming': ['--streaming'],
+    'pool4': ['--connections', '4'],
+    'async1': ['--engine', 'async'],
+    'async4': ['--engine', 'async', '--connections', '4'],
+    'pipeline': ['--pipeline', '--parse-workers', '2', '--write-workers', '2'],
+    'local': [],
+}
+
+# Период опроса памяти дочернего процесса (rusage после fork учитывает память родителя, поэтому опрос)
+RSS_POLL_SECONDS = 0.05
+
+# Отправители тестового ящика: организации из списка, частные лица и рассылки
+SENDERS = [
+    ('Акимовка Статистика ЦРБ', 'akimovka-crb@example.ru'),
+    ('ГБУЗ Андреевская ЦРБ', 'andreevka@example.ru'),
+    ('Михайловская ЦРБ', 'mih-crb@example.ru'),
+    ('Оксана Мурашко', 'murashko@example.ru'),
+    ('Неизвестный Отправитель', 'unknown@example.org'),
+    ('Рассылка новостей', 'news@example.com'),
+]
+
+SUBJECTS = ['Отчет за {month}', 'Форма 30 за {month}', 'Сведения о численности ({month})',
+            'Re: Свод по учреждению за {month}', 'Мониторинг за {month} - исправленный']
+
+MONTHS = ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
+          'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
+
+
+def make_xlsx(rnd, size, title):
+    """Небольшая настоящая книга xlsx: строки с числами до нужного размера несжатого листа"""
+    rows = []
+    total = 0
+    row = 1
+    rows.append(f'<row r="1"><c r="A1" t="inlineStr"><is><t>{title}</t></is></c></row>')
+    while total < size:
+        row += 1
+        line = (f'<row r="{row}"><c r="A{row}"><v>{rnd.randint(0, 99999)}</v></c>'
+                f'<c r="B{row}"><v>{rnd.random():.6f}</v></c></row>')
+        rows.append(line)
+        total += len(line)
+    sheet = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+             + ''.join(rows) + '</sheetData></worksheet>')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml',
+                   '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                   '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                   '<Default Extension="xml" ContentType="application/xml"/>'
+                   '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                   '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                   '</Types>')
+        z.writestr('_rels/.rels',
+                   '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                   '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+                   '</Relationships>')
+        z.writestr('xl/workbook.xml',
+                   '<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                   'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                   '<sheets><sheet name="Лист1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        z.writestr('xl/_rels/workbook.xml.rels',
+                   '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                   '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+                   '</Relationships>')
+        z.writestr('xl/worksheets/sheet1.xml', sheet)
+    return buffer.getvalue()
+
+
+def make_pdf(rnd, size):
+    """Файл с заголовком PDF и случайным содержимым нужного размера (разбор PDF не измеряется)"""
+    return b'%PDF-1.4\n' + rnd.randbytes(max(0, size - 16)) + b'\n%%EOF\n'
+
+
+def generate_corpus(count, attachment_size=200 * 1024, attach_ratio=0.6, seed=1):
+    """Тестовый ящик: письма с кириллическими заголовками, текстом и вложениями xlsx/pdf"""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone(timedelta(hours=3))).replace(microsecond=0)
+    messages = []
+    for i in range(count):
+        name, address = SENDERS[i % len(SENDERS)]
+        month = MONTHS[i % len(MONTHS)]
+        msg = MIMEMultipart()
+        msg['From'] = f'{Header(name, "utf-8").encode()} <{address}>'
+        msg['To'] = 'svod@example.ru'
+        msg['Subject'] = Header(rnd.choice(SUBJECTS).format(month=month), 'utf-8').encode()
+        msg['Date'] = format_datetime(now - timedelta(hours=i * 7 % 240, minutes=i))
+        msg['Message-ID'] = f'<bench{i}.{seed}@example.ru>'
+        msg.attach(MIMEText(f'Добрый день!\nНаправляем сведения за {month}.\n\nС уважением,\n{name}', 'plain', 'utf-8'))
+        if rnd.random() < attach_ratio:
+            xlsx = MIMEApplication(make_xlsx(rnd, attachment_size, name), _subtype='vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            xlsx.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', f'Отчет {month} {i}.xlsx'))
+            msg.attach(xlsx)
+            if i % 3 == 0:
+                pdf = MIMEApplication(make_pdf(rnd, attachment_size // 2), _subtype='pdf')
+                pdf.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', f'Сопроводительное {i}.pdf'))
+                msg.attach(pdf)
+        if i % 5 == 0:
+            archive = MIMEApplication(rnd.randbytes(4096), _subtype='zip')
+            archive.add_header('Content-Disposition', 'attachment', filename='архив.zip')
+            msg.attach(archive)
+        messages.append(msg.as_bytes(policy=email.policy.SMTP))
+    return messages
+
+
+def split_raw(raw):
+    """Заголовок и тело части письма"""
+    index = raw.find(b'\r\n\r\n')
+    if index < 0:
+        index = raw.find(b'\n\n')
+        return raw[:index + 2], raw[index + 2:]
+    return raw[:index + 4], raw[index + 4:]
+
+
+class MimePart:
+    """Часть письма с исходными байтами (для BODYSTRUCTURE и загрузки BODY[n])"""
+
+    def __init__(self, raw):
+        self.header_bytes, self.body = split_raw(raw)
+        self.headers = BytesHeaderParser().parsebytes(self.header_bytes)
+        self.children = []
+        self.inner = None
+        if self.headers.get_content_type() == 'message/rfc822':
+            self.inner = MimePart(self.body)
+        if self.headers.get_content_maintype() == 'multipart':
+            boundary = self.headers.get_boundary().encode()
+            pieces = re.split(rb'(?:^|\r?\n)--' + re.escape(boundary) + rb'(?:--)?[ \t]*\r?\n?', self.body)
+            self.children = [MimePart(piece) for piece in pieces[1:-1]]
+
+    def find(self, section):
+        """Часть по номеру раздела IMAP (1.2.1)"""
+        node = self
+        for number in section.split('.'):
+            number = int(number)
+            if node.inner is not None:
+                node = node.inner
+            if node.children:
+                node = node.children[number - 1]
+            elif number != 1:
+                raise KeyError(section)
+        return node
+
+
+def imap_string(value):
+    """Строка IMAP: NIL, в кавычках или литералом (для 8-битных данных)"""
+    if value is None:
+        return b'NIL'
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if any(c > 126 or c in (13, 10, 34, 92) for c in value):
+        return b'{%d}\r\n' % len(value) + value
+    return b'"' + value + b'"'
+
+
+def imap_params(pairs):
+    if not pairs:
+        return b'NIL'
+    return b'(' + b' '.join(imap_string(k) + b' ' + imap_string(v) for k, v in pairs) + b')'
+
+
+def header_params(value):
+    """Параметры заголовка без декодирования: [(имя, значение)], первым идет само значение"""
+    if not value:
+        return []
+    message = Message()
+    message['Content-Type'] = value
+    params = []
+    for name, param in message.get_params(header='content-type'):
+        # Параметры RFC 2231 (части склеены) снова кодируются, как их отдал бы сервер
+        if isinstance(param, tuple):
+            charset, language, _ = param
+            params.append((name + '*', encode_rfc2231(collapse_rfc2231_value(param), charset, language)))
+        else:
+            params.append((name, param))
+    return params
+
+
+def bodystructure(part):
+    """BODYSTRUCTURE части письма (RFC 3501)"""
+    headers = part.headers
+    content_params = header_params(headers.get('Content-Type'))[1:]
+    if part.children:
+        inner = b''.join(bodystructure(child) for child in part.children)
+        return (b'(' + inner + b' ' + imap_string(headers.get_content_subtype().upper()) + b' '
+                + imap_params(content_params) + b' NIL NIL NIL)')
+    maintype = headers.get_content_maintype()
+    encoding = (headers.get('Content-Transfer-Encoding') or '7BIT').upper()
+    fields = [imap_string(maintype.upper()), imap_string(headers.get_content_subtype().upper()),
+              imap_params(content_params), b'NIL', b'NIL', imap_string(encoding), b'%d' % len(part.body)]
+    if maintype == 'text':
+        fields.append(b'%d' % part.body.count(b'\n'))
+    if part.inner is not None:
+        fields += [envelope(part.inner), bodystructure(part.inner), b'%d' % part.body.count(b'\n')]
+    fields.append(b'NIL')
+    disposition = headers.get('Content-Disposition')
+    if disposition:
+        params = header_params(disposition)
+        fields.append(b'(' + imap_string(params[0][0]) + b' ' + imap_params(params[1:]) + b')')
+    else:
+        fields.append(b'NIL')
+    fields += [b'NIL', b'NIL']
+    return b'(' + b' '.join(fields) + b')'
+
+
+def envelope(part):
+    """ENVELOPE письма (дата, тема, адреса, Message-ID)"""
+    headers = part.headers
+
+    def addresses(name):
+        values = headers.get_all(name)
+        if not values:
+            return b'NIL'
+        result = []
+        for display, address in getaddresses(values):
+            mailbox, _, host = address.partition('@')
+            result.append(b'(' + imap_string(display or None) + b' NIL ' + imap_string(mailbox) + b' '
+                          + imap_string(host) + b')')
+        return b'(' + b''.join(result) + b')'
+
+    return b'(' + b' '.join([imap_string(headers.get('Date')), imap_string(headers.get('Subject')),
+                             addresses('From'), addresses('From'), addresses('From'), addresses('To'),
+                             b'NIL', b'NIL', b'NIL', imap_string(headers.get('Message-ID'))]) + b')'
+
+
+def header_fields(part, names, negate=False):
+    """Выбранные заголовки части (HEADER.FIELDS и HEADER.FIELDS.NOT)"""
+    entries = []
+    current = []
+    for line in part.header_bytes.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t') and current:
+            current.append(line)
+            continue
+        if current:
+            entries.append(current)
+        current = [line] if line else []
+    if current:
+        entries.append(current)
+    result = b''
+    for entry in entries:
+        name = entry[0].split(b':', 1)[0].decode().upper()
+        if (name in names) != negate:
+            result += b'\r\n'.join(entry) + b'\r\n'
+    return result + b'\r\n'
+
+
+# Элементы FETCH: BODY.PEEK[раздел]<смещение.длина> или простые атомы
+FETCH_ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.]+)', re.IGNORECASE)
+BODY_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', re.IGNORECASE)
+
+
+class FakeImapServer:
+    """Локальный IMAP-сервер на asyncio с тестовым ящиком: UID SEARCH/FETCH, BODYSTRUCTURE, частичная
+    загрузка и IDLE. Задержка добавляется к каждому ответу без блокировки конвейера команд (как канал WAN)"""
+
+    def __init__(self, messages, latency=0.0, uidvalidity=1):
+        self.latency = latency
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.idle_writers = set()
+        self.loop = None
+        self.port = None
+        for raw in messages:
+            self.add_message(raw, notify=False)
+
+    def add_message(self, raw, notify=True):
+        """Новое письмо в ящике (с уведомлением клиентов в режиме IDLE)"""
+        self.messages.append((self.next_uid, raw, MimePart(raw)))
+        self.next_uid += 1
+        if notify and self.loop:
+            for writer in list(self.idle_writers):
+                self.loop.call_soon_threadsafe(writer.write, b'* %d EXISTS\r\n' % len(self.messages))
+
+    def search(self, criteria):
+        tokens = criteria.split()
+        result = self.messages
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if token == 'SINCE':
+                since = datetime.strptime(tokens[i + 1], '%d-%b-%Y').date()
+                result = [m for m in result if parsedate_to_datetime(m[2].headers['Date']).date() >= since]
+                i += 2
+            elif token == 'UID':
+                uids = self.expand_set(tokens[i + 1])
+                result = [m for m in result if m[0] in uids]
+                i += 2
+            else:
+                i += 1
+        return [m[0] for m in result]
+
+    def expand_set(self, text):
+        """Набор номеров IMAP (1:5,7,10:*) в множество"""
+        max_uid = self.messages[-1][0] if self.messages else 0
+        numbers = set()
+        for piece in text.split(','):
+            if ':' in piece:
+                first, last = (max_uid if x == '*' else int(x) for x in piece.split(':'))
+                numbers.update(range(min(first, last), max(first, last) + 1))
+            else:
+                numbers.add(max_uid if piece == '*' else int(piece))
+        return numbers
+
+    def fetch_item(self, raw, part, item):
+        """Один элемент ответа FETCH"""
+        name = item.upper()
+        if name == 'UID':
+            return None
+        if name == 'RFC822':
+            return b'RFC822 {%d}\r\n' % len(raw) + raw
+        if name == 'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % len(raw)
+        if name == 'RFC822.HEADER':
+            return b'RFC822.HEADER {%d}\r\n' % len(part.header_bytes) + part.header_bytes
+        if name == 'BODYSTRUCTURE':
+            return b'BODYSTRUCTURE ' + bodystructure(part)
+        if name == 'ENVELOPE':
+            return b'ENVELOPE ' + envelope(part)
+        if name == 'FLAGS':
+            return b'FLAGS ()'
+        match = BODY_ITEM_RE.match(item)
+        section = match.group(1).upper()
+        if section in ('', 'HEADER', 'TEXT') or section.startswith('HEADER.FIELDS'):
+            node, subsection = part, section
+        else:
+            numbers = re.match(r'([\d.]*\d)(?:\.(HEADER|TEXT|MIME))?$', section)
+            node, subsection = part.find(numbers.group(1)), numbers.group(2) or 'BODY'
+        if subsection == '':
+            data = raw
+        elif subsection in ('HEADER', 'MIME'):
+            data = node.header_bytes
+        elif subsection in ('TEXT', 'BODY'):
+            data = node.body
+        else:
+            names = set(re.findall(r'[A-Z0-9-]+', subsection.split('(', 1)[1]))
+            data = header_fields(node, names, negate=subsection.startswith('HEADER.FIELDS.NOT'))
+        origin = ''
+        if match.group(2):
+            offset, length = int(match.group(2)), int(match.group(3))
+            data = data[offset:offset + length]
+            origin = f'<{offset}>'
+        return f'BODY[{section}]{origin} '.encode() + b'{%d}\r\n' % len(data) + data
+
+    def uid_command(self, args):
+        subcommand, _, subargs = args.partition(' ')
+        subcommand = subcommand.upper()
+        if subcommand == 'SEARCH':
+            if subargs.upper().startswith('CHARSET'):
+                subargs = subargs.split(' ', 2)[2]
+            return b'* SEARCH' + b''.join(b' %d' % uid for uid in self.search(subargs)) + b'\r\n'
+        if subcommand == 'FETCH':
+            message_set, _, items = subargs.partition(' ')
+            wanted = self.expand_set(message_set)
+            items = FETCH_ITEM_RE.findall(items.strip()[1:-1] if items.strip().startswith('(') else items)
+            response = b''
+            for number, (uid, raw, part) in enumerate(self.messages, 1):
+                if uid in wanted:
+                    pieces = [b'UID %d' % uid]
+                    pieces += [p for p in (self.fetch_item(raw, part, item) for item in items) if p is not None]
+                    response += b'* %d FETCH (' % number + b' '.join(pieces) + b')\r\n'
+            return response
+        return b''
+
+    async def handle(self, reader, writer):
+        """Сессия одного клиента: ответы уходят по порядку, каждый не раньше чем через latency после команды"""
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue()
+        idle_tag = None
+
+        async def send_responses():
+            while True:
+                due, data = await responses.get()
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+                responses.task_done()
+
+        writer.write(b'* OK Fake IMAP ready\r\n')
+        sender = asyncio.create_task(send_responses())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                text = line.decode('utf-8', 'replace').rstrip('\r\n')
+                received = loop.time()
+                if text.upper() == 'DONE' and idle_tag:
+                    self.idle_writers.discard(writer)
+                    responses.put_nowait((received, idle_tag.encode() + b' OK IDLE terminated\r\n'))
+                    idle_tag = None
+                    continue
+                tag, _, rest = text.partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                response = b''
+                if command == 'CAPABILITY':
+                    response = b'* CAPABILITY IMAP4rev1 IDLE\r\n'
+                elif command in ('SELECT', 'EXAMINE'):
+                    response = (b'* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] UIDs valid\r\n'
+                                b'* OK [UIDNEXT %d] Predicted next UID\r\n'
+                                % (len(self.messages), self.uidvalidity, self.next_uid))
+                elif command == 'UID':
+                    response = self.uid_command(args)
+                elif command == 'IDLE':
+                    await responses.join()
+                    idle_tag = tag
+                    self.idle_writers.add(writer)
+                    writer.write(b'+ idling\r\n')
+                    continue
+                elif command == 'LOGOUT':
+                    await responses.join()
+                    writer.write(b'* BYE\r\n' + tag.encode() + b' OK LOGOUT completed\r\n')
+                    await writer.drain()
+                    break
+                response += tag.encode() + b' OK ' + command.encode() + b' completed\r\n'
+                responses.put_nowait((received + self.latency, response))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            sender.cancel()
+            self.idle_writers.discard(writer)
+            writer.close()
+
+    def start_in_thread(self, host='127.0.0.1', port=0):
+        """Запуск сервера в фоновом потоке; возвращает порт"""
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self.port
+
+
+def read_peak_rss(pid):
+    """Пиковая память процесса и его дочерних процессов (процессов разбора) в байтах или None"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            total = 0
+            for item in [process] + process.children(recursive=True):
+                info = item.memory_info()
+                # peak_wset есть только на Windows, на остальных системах - текущий объем
+                total += getattr(info, 'peak_wset', info.rss)
+            return total
+        except psutil.Error:
+            return None
+    # Linux без psutil: максимум резидентной памяти VmHWM из /proc
+    try:
+        pids = [pid]
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        total = 0
+        for item in pids:
+            with open(f'/proc/{item}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        return total
+    except (OSError, ValueError):
+        return None
+
+
+def wait_with_peak_rss(process):
+    """Ожидание дочернего процесса с опросом пиковой памяти: (код завершения, байты или None)"""
+    peak = None
+    while process.poll() is None:
+        measured = read_peak_rss(process.pid)
+        if measured is not None:
+            peak = max(peak or 0, measured)
+        time.sleep(RSS_POLL_SECONDS)
+    return process.returncode, peak
+
+
+def run_strategy(name, parser_script, port, days, archive_dir, workers, workdir):
+    """Замер одного способа загрузки: обработчик запускается отдельным процессом с чистой папкой результатов"""
+    os.makedirs(workdir)
+    command = [sys.executable, parser_script, '--org-file', ORGANIZATIONS_FILE, '--no-catalog']
+    if name == 'local':
+        command += ['--source', archive_dir]
+        if workers:
+            command += ['--workers', str(workers)]
+    else:
+        command += ['--server', '127.0.0.1', '--port', str(port), '--no-ssl', '--days', str(days), '--full-resync']
+        command += STRATEGIES[name]
+    env = dict(os.environ, EMAIL_PARSER_ADDRESS='bench@example.ru', EMAIL_PARSER_PASSWORD='bench')
+    log_path = os.path.join(workdir, 'журнал.txt')
+
+    # Журнал обработчика пишется в файл; Enter на вход закрывает паузу в конце работы
+    with open(log_path, 'wb') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=log)
+        process.stdin.write(b'\n')
+        process.stdin.close()
+        returncode, peak_rss = wait_with_peak_rss(process)
+        elapsed = time.perf_counter() - started
+
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+        log_text = f.read()
+    if returncode != 0 or 'Отчет сохранен' not in log_text:
+        logging.error(f"❌ Способ {name} завершился с ошибкой, журнал: {log_path}\n{log_text[-2000:]}")
+        return None
+    errors = log_text.count(' - ERROR: ')
+    if errors:
+        logging.warning(f"⚠️ Способ {name}: ошибок в журнале обработчика: {errors} ({log_path})")
+    return {'elapsed': elapsed, 'peak_rss': peak_rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Замер скорости обработчика почты на локальном тестовом IMAP-сервере'
+    )
+    parser.add_argument('--messages', type=int, default=500,
+                       help='Количество писем в тестовом ящике (по умолчанию: 500)')
+    parser.add_argument('--attachment-size', type=int, default=200 * 1024,
+                       help='Примерный размер вложения xlsx в байтах (по умолчанию: 204800)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                       help='Задержка каждого ответа сервера в секундах, имитация медленного канала (по умолчанию: 0)')
+    parser.add_argument('--strategies', type=str, default=','.join(STRATEGIES),
+                       help=f'Способы загрузки через запятую (по умолчанию: {",".join(STRATEGIES)})')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Процессов разбора для способа local (по умолчанию: число ядер процессора)')
+    parser.add_argument('--parser', type=str, default=PARSER_SCRIPT,
+                       help='Скрипт обработчика почты (по умолчанию: e-mail-parser-v1.3.py рядом с этим скриптом)')
+    parser.add_argument('--seed', type=int, default=1,
+                       help='Начальное значение генератора тестовых писем (по умолчанию: 1)')
+    parser.add_argument('--serve', action='store_true',
+                       help='Только запустить тестовый сервер (без SSL) и ждать подключений до Ctrl+C')
+    parser.add_argument('--port', type=int, default=0,
+                       help='Порт тестового сервера (по умолчанию: любой свободный; для --serve - 1143)')
+    parser.add_argument('--keep', action='store_true',
+                       help='Не удалять папки с результатами обработки после замера')
+
+    args = parser.parse_args()
+    strategies = [name.strip() for name in args.strategies.split(',') if name.strip()]
+    unknown = [name for name in strategies if name not in STRATEGIES]
+    if unknown:
+        parser.error(f"Неизвестные способы: {', '.join(unknown)}. Доступны: {', '.join(STRATEGIES)}")
+
+    logging.info(f"📨 Генерация тестового ящика: {args.messages} писем...")
+    messages = generate_corpus(args.messages, args.attachment_size, seed=args.seed)
+    corpus_bytes = sum(len(raw) for raw in messages)
+    logging.info(f"   Объем ящика: {corpus_bytes / 1048576:.1f} МБ")
+
+    server = FakeImapServer(messages, latency=args.latency)
+    port = server.start_in_thread(port=args.port or (1143 if args.serve else 0))
+
+    if args.serve:
+        print(f"Тестовый IMAP-сервер: 127.0.0.1:{port} (без SSL), любой логин и пароль. Ctrl+C - остановка")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return
+
+    workroot = tempfile.mkdtemp(prefix='email_benchmark_')
+    archive_dir = os.path.join(workroot, 'архив')
+    if 'local' in strategies:
+        os.makedirs(archive_dir)
+        for i, raw in enumerate(messages):
+            with open(os.path.join(archive_dir, f'{i:06d}.eml'), 'wb') as f:
+                f.write(raw)
+
+    # Период с запасом, чтобы в обработку попали все письма ящика
+    days = 3650
+    results = []
+    try:
+        for name in strategies:
+            logging.info(f"⏱️ Способ {name}...")
+            measured = run_strategy(name, args.parser, port, days, archive_dir, args.workers,
+                                    os.path.join(workroot, name))
+            if measured is not None:
+                results.append((name, measured))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workroot, ignore_errors=True)
+        else:
+            logging.info(f"Результаты обработки сохранены в: {workroot}")
+
+    print("=" * 70)
+    print(f"ЗАМЕР: {args.messages} писем, {corpus_bytes / 1048576:.1f} МБ, задержка ответа {args.latency * 1000:.0f} мс")
+    print("=" * 70)
+    print(f"{'Способ':<12}{'Время, с':>10}{'Писем/с':>12}{'МБ/с':>10}{'Пик памяти, МБ':>18}")
+    for name, measured in results:
+        elapsed = measured['elapsed']
+        rss = measured['peak_rss']
+        rss_text = f"{rss / 1048576:.1f}" if rss else 'н/д'
+        print(f"{name:<12}{elapsed:>10.2f}{args.messages / elapsed:>12.1f}"
+              f"{corpus_bytes / 1048576 / elapsed:>10.2f}{rss_text:>18}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
 import imaplib
 import email
+import email.message
 import os
 import re
 import argparse
+import binascii
+import codecs
 import csv
+import json
+import hashlib
+import sqlite3
+import threading
+import functools
+import asyncio
+import queue
+import ssl
+import time
+import contextlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import chardet
 from email.header import decode_header
 from datetime import datetime, timedelta
@@ -16,30 +31,1303 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# Ограничение числа одновременных соединений (серверы обычно допускают 5-10 сессий на ящик)
+MAX_IMAP_CONNECTIONS = 8
+
+# Размер LRU-кэшей декодированных заголовков и очищенных названий организаций (по умолчанию)
+HEADER_CACHE_SIZE = 4096
+
+# Текст письма нужен только для начала в информация_о_письме.txt: декодируем на символ больше,
+# чтобы знать, обрезан ли текст; кодировку без объявленной определяем по началу текста
+BODY_PREVIEW_CHARS = 500
+CHARSET_DETECT_BYTES = 4096
+
+# Запись метаданных: сколько CSV организаций держать открытыми и как часто сбрасывать буферы на диск
+MAX_OPEN_CSV_FILES = 64
+METADATA_FLUSH_SECONDS = 5.0
+
+# Письмо, которое не удалось загрузить или сохранить, повторяется в следующих запусках;
+# после стольких неудачных попыток отметка UID проходит его (письмо считается окончательно не обработанным)
+FAILED_RETRY_LIMIT = 3
+
+# Каталог обработанных писем: фиксация транзакции раз в столько писем (и перед сохранением отметки UID)
+CATALOG_COMMIT_EVERY = 100
+
+# Дедупликация вложений: если жесткие ссылки недоступны, вместо копии пишется файл-указатель с этим окончанием
+DEDUP_POINTER_SUFFIX = '.ссылка'
+
+# Режим службы: IDLE переоткрывается раньше 29-минутного тайм-аута сервера (RFC 2177),
+# после сбоя повторное подключение с удвоением паузы от минимальной до максимальной
+IDLE_TIMEOUT_SECONDS = 25 * 60
+DAEMON_BACKOFF_MIN_SECONDS = 5
+DAEMON_BACKOFF_MAX_SECONDS = 300
+# Полный отчет обходит все папки организаций: в режиме службы строится не чаще раза в этот интервал
+DAEMON_REPORT_INTERVAL_SECONDS = 60 * 60
+
+# Учетные данные без интерактивного ввода (для режима службы)
+CREDENTIALS_ENV_ADDRESS = 'EMAIL_PARSER_ADDRESS'
+CREDENTIALS_ENV_PASSWORD = 'EMAIL_PARSER_PASSWORD'
+
+# Этапы обработки письма для замера времени: (имя в метриках, название в отчете)
+TIMING_STAGES = [
+    ('imap_fetch', 'Загрузка с сервера (UID FETCH)'),
+    ('mime_parse', 'Разбор письма (MIME, с декодированием)'),
+    ('header_decode', 'Декодирование заголовков'),
+    ('org_match', 'Определение организации'),
+    ('folder', 'Выбор папки организации и даты'),
+    ('attachment_write', 'Запись вложений'),
+    ('metadata_write', 'Запись метаданных и каталога'),
+]
+
+# Локальные архивы (mbox, Maildir, .eml): сколько писем передавать процессу разбора одной задачей
+LOCAL_PARSE_BATCH = 32
+
+# Конвейер загрузка -> разбор -> запись: емкость очередей между этапами (в письмах)
+# и сколько писем передавать процессу разбора одной задачей
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_PARSE_BATCH = 8
+
+# Асинхронный движок: сколько пакетов одновременно в работе на одно соединение (конвейер команд)
+ASYNC_PIPELINE_DEPTH = 4
+
+# Потоковое сохранение вложений: размер одного запроса BODY.PEEK[n]<смещение.длина>
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+# Символы вне алфавита base64 (переводы строк и мусор) отбрасываются при декодировании
+BASE64_SKIP_RE = re.compile(rb'[^A-Za-z0-9+/=]')
+
+# Элементы фазы 1 предпросмотра структуры писем
+PRESCAN_FETCH_ITEMS = '(UID RFC822.SIZE BODYSTRUCTURE ENVELOPE)'
+
+# Литерал IMAP в конце строки ответа: {размер}
+IMAP_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+# Начало непомеченного ответа FETCH: * <номер> FETCH
+IMAP_UNTAGGED_FETCH_RE = re.compile(rb'^\* (\d+) FETCH ', re.IGNORECASE)
+
+# Уведомление о новых письмах в ящике: * <число> EXISTS / RECENT
+IMAP_UNTAGGED_EXISTS_RE = re.compile(rb'^\* \d+ (?:EXISTS|RECENT)\b', re.IGNORECASE)
+
+
+def format_message_set(uids):
+    """Сжатие списка UID в набор сообщений IMAP: [1, 2, 3, 7] -> '1:3,7'"""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def tokenize_imap_text(text):
+    """Разбиение строки ответа IMAP на лексемы: скобки, атомы, строки, NIL"""
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i:i + 1]
+        if ch in (b' ', b'\r', b'\n'):
+            i += 1
+        elif ch in (b'(', b')'):
+            yield (ch.decode(), None)
+            i += 1
+        elif ch == b'"':
+            value = bytearray()
+            i += 1
+            while i < n and text[i:i + 1] != b'"':
+                if text[i:i + 1] == b'\\':
+                    i += 1
+                value += text[i:i + 1]
+                i += 1
+            yield ('string', bytes(value))
+            i += 1
+        else:
+            # Атом может содержать секцию в квадратных скобках: BODY[HEADER.FIELDS (FROM)]
+            j, depth = i, 0
+            while j < n:
+                ch = text[j:j + 1]
+                if ch == b'[':
+                    depth += 1
+                elif ch == b']':
+                    depth -= 1
+                elif depth == 0 and ch in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                j += 1
+            atom = text[i:j]
+            yield ('nil', None) if atom.upper() == b'NIL' else ('atom', atom)
+            i = j
+
+
+def iter_imap_tokens(data):
+    """Лексемы ответа imaplib: строки и кортежи (строка с {n}, литерал)"""
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            head = head.rstrip()
+            match = IMAP_LITERAL_RE.search(head)
+            if match:
+                head = head[:match.start()]
+            yield from tokenize_imap_text(head)
+            yield ('string', literal)
+        elif isinstance(item, bytes):
+            yield from tokenize_imap_text(item)
+
+
+def parse_imap_fetch_response(data):
+    """Разбор ответа FETCH в список словарей {'UID': ..., 'RFC822': ..., ...}"""
+    tokens = list(iter_imap_tokens(data))
+    pos = 0
+
+    def parse_value():
+        nonlocal pos
+        kind, value = tokens[pos]
+        pos += 1
+        if kind == '(':
+            items = []
+            while pos < len(tokens) and tokens[pos][0] != ')':
+                items.append(parse_value())
+            pos += 1
+            return items
+        return value
+
+    messages = []
+    while pos < len(tokens):
+        kind, value = tokens[pos]
+        # Ответ на каждое письмо: <номер> (ЭЛЕМЕНТ значение ...)
+        if kind != 'atom' or not value.isdigit() or pos + 1 >= len(tokens) or tokens[pos + 1][0] != '(':
+            pos += 1
+            continue
+        pos += 1
+        items = parse_value()
+        fetched = {'SEQ': int(value)}
+        for key, item_value in zip(items[0::2], items[1::2]):
+            if isinstance(key, bytes):
+                fetched[key.decode('ascii', errors='ignore').upper()] = item_value
+        messages.append(fetched)
+    return messages
+
+
+def _imap_str(value):
+    """Значение из ответа IMAP (bytes/None) в строку"""
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _imap_params(values):
+    """Список параметров BODYSTRUCTURE ('NAME', 'x.xlsx', ...) в список пар"""
+    if not isinstance(values, list):
+        return []
+    return [(_imap_str(k), _imap_str(v)) for k, v in zip(values[0::2], values[1::2])]
+
+
+def parse_bodystructure(structure, prefix=''):
+    """Обход BODYSTRUCTURE: список конечных частей письма с номерами секций в порядке msg.walk()"""
+    leaves = []
+    if not isinstance(structure, list) or not structure:
+        return leaves
+    
+    # Составная часть: вложенные списки, затем подтип
+    if isinstance(structure[0], list):
+        number = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            section = f"{prefix}.{number}" if prefix else str(number)
+            leaves.extend(parse_bodystructure(child, section))
+            number += 1
+        return leaves
+    
+    section = prefix or '1'
+    maintype = _imap_str(structure[0]).lower()
+    subtype = _imap_str(structure[1]).lower() if len(structure) > 1 else ''
+    size = structure[6] if len(structure) > 6 else 0
+    
+    # Расширенные поля идут после обязательных; их число зависит от типа части
+    if maintype == 'text':
+        ext_index = 8
+    elif maintype == 'message' and subtype == 'rfc822':
+        ext_index = 10
+    else:
+        ext_index = 7
+    disposition = structure[ext_index + 1] if len(structure) > ext_index + 1 else None
+    disposition_type = ''
+    disposition_params = []
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _imap_str(disposition[0]).lower()
+        disposition_params = _imap_params(disposition[1] if len(disposition) > 1 else None)
+    
+    leaves.append({
+        'section': section,
+        'content_type': f"{maintype}/{subtype}",
+        'params': _imap_params(structure[2] if len(structure) > 2 else None),
+        'encoding': _imap_str(structure[5] if len(structure) > 5 else None).lower(),
+        'size': int(size) if isinstance(size, bytes) and size.isdigit() else 0,
+        'disposition': disposition_type,
+        'disposition_params': disposition_params,
+    })
+    
+    # Вложенное письмо (message/rfc822): его части нумеруются от номера этой части
+    if maintype == 'message' and subtype == 'rfc822' and len(structure) > 8:
+        inner = structure[8]
+        if isinstance(inner, list) and inner and isinstance(inner[0], list):
+            leaves.extend(parse_bodystructure(inner, section))
+        else:
+            leaves.extend(parse_bodystructure(inner, f"{section}.1"))
+    return leaves
+
+
+def quote_imap_string(value):
+    """Строка IMAP в кавычках с экранированием обратной косой черты и кавычек"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def put_until_stopped(results, stop, item):
+    """Запись в ограниченную очередь с проверкой флага остановки (чтобы поток не завис на полной очереди)"""
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_local_messages(source_path):
+    """Письма локального архива: (метка, файл, смещение, длина); длина None - письмо занимает весь файл"""
+    if os.path.isfile(source_path):
+        paths = [source_path]
+    else:
+        paths = []
+        for root, dirs, files in os.walk(source_path):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in sorted(files))
+    
+    for path in paths:
+        label = os.path.relpath(path, source_path) if path != source_path else os.path.basename(path)
+        parent = os.path.basename(os.path.dirname(path))
+        with open(path, 'rb') as f:
+            is_mbox = f.read(5) == b'From '
+        if is_mbox:
+            yield from iter_mbox_messages(path, label)
+        elif path.lower().endswith('.eml') or parent in ('cur', 'new'):
+            # Отдельный файл .eml или письмо Maildir (папки cur/new, tmp - недописанные письма)
+            yield label, path, 0, None
+
+
+def iter_mbox_messages(path, label):
+    """Границы писем в mbox: письмо начинается после строки "From " в начале файла или после пустой строки"""
+    start = None
+    number = 0
+    offset = 0
+    previous_blank = True
+    previous_length = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if previous_blank and line.startswith(b'From '):
+                if start is not None:
+                    number += 1
+                    # Пустая строка перед разделителем (\n или \r\n) принадлежит формату mbox, а не письму
+                    yield f"{label}#{number}", path, start, max(0, offset - start - previous_length)
+                start = offset + len(line)
+            previous_blank = line in (b'\n', b'\r\n')
+            previous_length = len(line)
+            offset += len(line)
+    if start is not None:
+        number += 1
+        yield f"{label}#{number}", path, start, offset - start
+
+
+def read_local_message(path, offset, length):
+    """Исходные байты письма локального архива"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read() if length is None else f.read(length)
+
+
+# Обработчик в процессе пула разбора (копия настроек разбора основного процесса)
+_parse_worker = None
+
+
+def init_parse_worker(processor):
+    """Инициализация процесса пула разбора"""
+    global _parse_worker
+    _parse_worker = processor
+
+
+def parse_local_batch(sources):
+    """Разбор части писем архива в процессе пула: ([(метка, данные письма или None при ошибке)], замеры этапов)"""
+    _parse_worker.timings = StageTimings()
+    results = []
+    for label, path, offset, length in sources:
+        try:
+            raw_email = read_local_message(path, offset, length)
+            with _parse_worker.timings.measure('mime_parse'):
+                email_data = _parse_worker.extract_email_data(raw_email)
+        except Exception as e:
+            logging.error(f"Ошибка разбора письма {label}: {e}")
+            email_data = None
+        results.append((label, email_data))
+    return results, _parse_worker.timings.samples
+
+
+def parse_pipeline_batch(jobs):
+    """Этап разбора конвейера в процессе пула: ([(uid, данные письма или None)], замеры этапов)"""
+    _parse_worker.timings = StageTimings()
+    return _parse_worker.parse_jobs(jobs), _parse_worker.timings.samples
+
+
+class StreamingDecoder:
+    """Декодирование Content-Transfer-Encoding по частям: base64, quoted-printable или без изменений"""
+    
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').strip().lower()
+        self.buffer = b''
+    
+    def decode(self, chunk):
+        """Декодирование очередной части; неполный хвост остается в буфере до следующей"""
+        if self.encoding == 'base64':
+            data = self.buffer + BASE64_SKIP_RE.sub(b'', chunk)
+            usable = len(data) - len(data) % 4
+            self.buffer = data[usable:]
+            return binascii.a2b_base64(data[:usable]) if usable else b''
+        if self.encoding == 'quoted-printable':
+            # Строки декодируются целиком, чтобы не разорвать =XX и мягкий перенос
+            data = self.buffer + chunk
+            end = data.rfind(b'\n') + 1
+            self.buffer = data[end:]
+            return binascii.a2b_qp(data[:end]) if end else b''
+        return chunk
+    
+    def flush(self):
+        """Декодирование остатка буфера в конце части"""
+        data, self.buffer = self.buffer, b''
+        if not data:
+            return b''
+        if self.encoding == 'base64':
+            try:
+                return binascii.a2b_base64(data + b'=' * (-len(data) % 4))
+            except binascii.Error:
+                return b''
+        if self.encoding == 'quoted-printable':
+            return binascii.a2b_qp(data)
+        return data
+
+
+class AsyncImapClient:
+    """Соединение IMAP на asyncio: несколько помеченных команд в работе одновременно (конвейер)"""
+    
+    def __init__(self, host, port=993, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.tag_counter = 0
+        self.pending = {}
+        self.fetched = {}
+        self.error = None
+        self.continuation = None
+        self.exists_event = None
+        # Замеры времени загрузки (StageTimings обработчика), если заданы
+        self.timings = None
+    
+    async def connect(self):
+        """Открытие соединения, проверка приветствия сервера и запуск чтения ответов"""
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context, limit=4 * 1024 * 1024)
+        self.exists_event = asyncio.Event()
+        greeting = await self.reader.readline()
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise imaplib.IMAP4.error(f"Неожиданное приветствие сервера: {greeting[:100]!r}")
+        self.reader_task = asyncio.create_task(self.read_responses())
+    
+    async def read_responses(self):
+        """Чтение ответов сервера: непомеченные FETCH собираются по UID, помеченные завершают команды"""
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionError("Соединение закрыто сервером")
+                line = line.rstrip(b'\r\n')
+                if line.startswith(b'* '):
+                    # Ответ в формате imaplib: кортежи (строка с {n}, литерал) и хвост строки
+                    parts = []
+                    match = IMAP_LITERAL_RE.search(line)
+                    while match:
+                        literal = await self.reader.readexactly(int(match.group(1)))
+                        parts.append((line, literal))
+                        line = (await self.reader.readline()).rstrip(b'\r\n')
+                        match = IMAP_LITERAL_RE.search(line)
+                    parts.append(line)
+                    self.handle_untagged(parts)
+                elif line.startswith(b'+'):
+                    # Продолжение команды (IDLE ждет его перед ожиданием уведомлений)
+                    if self.continuation is not None and not self.continuation.done():
+                        self.continuation.set_result(line)
+                else:
+                    tag, _, rest = line.partition(b' ')
+                    future = self.pending.pop(tag.decode('ascii', errors='ignore'), None)
+                    if future is not None and not future.done():
+                        status, _, text = rest.partition(b' ')
+                        future.set_result((status.decode('ascii', errors='ignore').upper(),
+                                           text.decode('utf-8', errors='ignore')))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Ошибка соединения: {e}"))
+            self.pending.clear()
+            # Будим ожидание IDLE, чтобы обрыв обнаружился сразу, а не по тайм-ауту
+            self.exists_event.set()
+    
+    def handle_untagged(self, parts):
+        """Разбор непомеченного ответа FETCH и добавление элементов к данным письма по UID"""
+        head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        if IMAP_UNTAGGED_EXISTS_RE.match(head):
+            self.exists_event.set()
+            return
+        match = IMAP_UNTAGGED_FETCH_RE.match(head)
+        if not match:
+            return
+        head = match.group(1) + b' ' + head[match.end():]
+        parts[0] = (head, parts[0][1]) if isinstance(parts[0], tuple) else head
+        for fetched in parse_imap_fetch_response(parts):
+            if 'UID' in fetched:
+                self.fetched.setdefault(int(fetched['UID']), {}).update(fetched)
+    
+    async def command(self, name, args=''):
+        """Отправка помеченной команды и ожидание ее завершения: (статус, текст)"""
+        if self.error is not None:
+            raise ConnectionError(f"Ошибка соединения: {self.error}")
+        self.tag_counter += 1
+        tag = f"A{self.tag_counter:04d}"
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = future
+        try:
+            self.writer.write(f"{tag} {name} {args}".rstrip().encode('utf-8') + b'\r\n')
+            await self.writer.drain()
+        except Exception as e:
+            self.pending.pop(tag, None)
+            self.error = e
+            raise ConnectionError(f"Ошибка соединения: {e}")
+        return await future
+    
+    async def login(self, user, password):
+        status, text = await self.command('LOGIN', f"{quote_imap_string(user)} {quote_imap_string(password)}")
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"LOGIN: {text}")
+    
+    async def select(self, mailbox):
+        status, text = await self.command('SELECT', quote_imap_string(mailbox))
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SELECT {mailbox}: {text}")
+    
+    async def uid_fetch(self, uids, items):
+        """UID FETCH: (статус, {uid: {'UID': ..., элемент: значение}})"""
+        started = time.perf_counter()
+        status, text = await self.command('UID FETCH', f"{format_message_set(uids)} {items}")
+        if self.timings is not None:
+            self.timings.add('imap_fetch', time.perf_counter() - started)
+        fetched = {uid: self.fetched.pop(uid) for uid in uids if uid in self.fetched}
+        return status, fetched
+    
+    async def idle(self, timeout):
+        """Ожидание новых писем командой IDLE: True - сервер сообщил о новых письмах, False - тайм-аут"""
+        if self.error is not None:
+            raise ConnectionError(f"Ошибка соединения: {self.error}")
+        loop = asyncio.get_running_loop()
+        self.exists_event.clear()
+        self.tag_counter += 1
+        tag = f"A{self.tag_counter:04d}"
+        future = loop.create_future()
+        self.pending[tag] = future
+        self.continuation = loop.create_future()
+        self.writer.write(f"{tag} IDLE\r\n".encode('ascii'))
+        await self.writer.drain()
+        
+        # Сервер без IDLE ответит сразу завершением команды вместо продолжения
+        await asyncio.wait({self.continuation, future}, timeout=60, return_when=asyncio.FIRST_COMPLETED)
+        if future.done():
+            status, text = future.result()
+            raise imaplib.IMAP4.error(f"IDLE: {status} {text}")
+        if not self.continuation.done():
+            raise ConnectionError("Сервер не подтвердил IDLE")
+        
+        try:
+            await asyncio.wait_for(self.exists_event.wait(), timeout)
+            arrived = True
+        except asyncio.TimeoutError:
+            arrived = False
+        if self.error is not None:
+            raise ConnectionError(f"Ошибка соединения: {self.error}")
+        
+        self.writer.write(b'DONE\r\n')
+        await self.writer.drain()
+        status, text = await asyncio.wait_for(future, 60)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"IDLE: {status} {text}")
+        return arrived
+    
+    async def logout(self):
+        """Завершение сессии и закрытие соединения"""
+        try:
+            if self.error is None:
+                await asyncio.wait_for(self.command('LOGOUT'), timeout=10)
+        except Exception:
+            pass
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+
+class OrganizationMatcher:
+    """Автомат Ахо-Корасик по ключам поиска организаций: все ключи проверяются за один проход по заголовку"""
+    
+    def __init__(self, mapping, longest=False):
+        # Приоритет совпадения: порядок ключей в файле или сначала самый длинный ключ
+        self.longest = longest
+        self.folders = list(mapping.values())
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [None]
+        
+        for index, search_key in enumerate(mapping):
+            pattern = search_key.lower()
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                    self.goto[node][char] = next_node
+                node = next_node
+            self.best[node] = self.better(self.best[node], self.rank(index, len(pattern)))
+        
+        # Ссылки неудач обходом в ширину; лучший ключ узла учитывает ключи-суффиксы
+        nodes = deque(self.goto[0].values())
+        while nodes:
+            node = nodes.popleft()
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.best[child] = self.better(self.best[child], self.best[self.fail[child]])
+                nodes.append(child)
+    
+    def rank(self, index, length):
+        """Ранг совпадения (меньше - лучше); номер ключа всегда последний"""
+        return (-length, index) if self.longest else (index,)
+    
+    def better(self, first, second):
+        """Лучший из двух рангов (None - совпадения нет)"""
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return min(first, second)
+    
+    def find(self, text):
+        """Название папки для лучшего ключа, найденного в тексте, или None"""
+        node = 0
+        best = None
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            found = self.best[node]
+            if found is not None and (best is None or found < best):
+                best = found
+                # Первый ключ списка лучше любого другого - дальше искать незачем
+                if not self.longest and best[0] == 0:
+                    break
+        return self.folders[best[-1]] if best else None
+
+
+class StageTimings:
+    """Замеры времени этапов обработки (из любых потоков): процентили и итоги для отчета и метрик"""
+    
+    def __init__(self):
+        self.samples = {stage: [] for stage, _ in TIMING_STAGES}
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+    
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+    
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Замер блока кода как одного события этапа"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+    
+    def merge(self, samples):
+        """Добавление замеров другого процесса (разбор локальных архивов)"""
+        with self.lock:
+            for stage, values in samples.items():
+                self.samples[stage].extend(values)
+    
+    def summary(self):
+        """Итоги по этапам: количество, сумма, p50, p95 и максимум в секундах"""
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+        result = {}
+        for stage, values in samples.items():
+            count = len(values)
+            result[stage] = {
+                'count': count,
+                'total': sum(values),
+                # Процентили по ближайшему рангу
+                'p50': values[max(0, -(-count * 50 // 100) - 1)] if count else 0.0,
+                'p95': values[max(0, -(-count * 95 // 100) - 1)] if count else 0.0,
+                'max': values[-1] if count else 0.0,
+            }
+        return result
+    
+    def elapsed(self):
+        return time.perf_counter() - self.started
+    
+    def report_lines(self):
+        """Таблица этапов для отчета"""
+        summary = self.summary()
+        lines = [f"{'Этап':<42}{'Событий':>9}{'Всего, с':>11}{'p50, мс':>10}{'p95, мс':>10}{'Макс, мс':>10}"]
+        for stage, title in TIMING_STAGES:
+            item = summary[stage]
+            lines.append(f"{title:<42}{item['count']:>9}{item['total']:>11.2f}{item['p50'] * 1000:>10.2f}"
+                         f"{item['p95'] * 1000:>10.2f}{item['max'] * 1000:>10.2f}")
+        return lines
+    
+    def write_json(self, filepath, run_info):
+        """Метрики запуска в JSON"""
+        data = dict(run_info, elapsed_seconds=round(self.elapsed(), 3),
+                    stages={stage: {key: (round(value, 6) if isinstance(value, float) else value)
+                                    for key, value in item.items()}
+                            for stage, item in self.summary().items()})
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    
+    def write_prometheus(self, filepath, run_info):
+        """Метрики в текстовом формате Prometheus (для textfile collector node_exporter)"""
+        lines = [
+            '# HELP email_parser_stage_duration_seconds Время этапа обработки одного письма или запроса.',
+            '# TYPE email_parser_stage_duration_seconds summary',
+        ]
+        summary = self.summary()
+        for stage, item in summary.items():
+            lines.append(f'email_parser_stage_duration_seconds{{stage="{stage}",quantile="0.5"}} {item["p50"]:.6f}')
+            lines.append(f'email_parser_stage_duration_seconds{{stage="{stage}",quantile="0.95"}} {item["p95"]:.6f}')
+            lines.append(f'email_parser_stage_duration_seconds_sum{{stage="{stage}"}} {item["total"]:.6f}')
+            lines.append(f'email_parser_stage_duration_seconds_count{{stage="{stage}"}} {item["count"]}')
+        lines += ['# HELP email_parser_stage_duration_max_seconds Максимальное время события этапа за запуск.',
+                  '# TYPE email_parser_stage_duration_max_seconds gauge']
+        lines += [f'email_parser_stage_duration_max_seconds{{stage="{stage}"}} {item["max"]:.6f}'
+                  for stage, item in summary.items()]
+        lines += ['# HELP email_parser_run_duration_seconds Длительность последнего запуска.',
+                  '# TYPE email_parser_run_duration_seconds gauge',
+                  f'email_parser_run_duration_seconds {self.elapsed():.3f}',
+                  '# HELP email_parser_processed_emails Писем с сохраненными вложениями за последний запуск.',
+                  '# TYPE email_parser_processed_emails gauge',
+                  f'email_parser_processed_emails {run_info["processed_emails"]}',
+                  '# HELP email_parser_saved_files Сохраненных файлов за последний запуск.',
+                  '# TYPE email_parser_saved_files gauge',
+                  f'email_parser_saved_files {run_info["saved_files"]}',
+                  '# HELP email_parser_last_run_timestamp_seconds Время завершения последнего запуска (Unix).',
+                  '# TYPE email_parser_last_run_timestamp_seconds gauge',
+                  f'email_parser_last_run_timestamp_seconds {time.time():.0f}']
+        # Атомарная замена: node_exporter не должен прочитать недописанный файл
+        tmp_path = filepath + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, filepath)
+
+
+class MetadataWriter:
+    """Буферизованная запись метаданных: открытые CSV организаций и общий JSONL за запуск"""
+    
+    def __init__(self, base_folder, metadata_format='txt', flush_interval=METADATA_FLUSH_SECONDS):
+        self.base_folder = base_folder
+        self.metadata_format = metadata_format
+        self.flush_interval = flush_interval
+        self.csv_files = OrderedDict()
+        self.jsonl_file = None
+        self.jsonl_path = None
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.flush_thread = None
+    
+    def start_flush_timer(self):
+        """Фоновый сброс буферов раз в flush_interval секунд (запускается при первой записи)"""
+        if self.flush_thread is not None or not self.flush_interval:
+            return
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self.flush_loop, args=(self.stop_event,), daemon=True)
+        self.flush_thread.start()
+    
+    def flush_loop(self, stop_event):
+        while not stop_event.wait(self.flush_interval):
+            self.flush()
+    
+    def write_csv_row(self, csv_file, row):
+        """Строка в CSV организации; файл остается открытым до конца запуска"""
+        with self.lock:
+            entry = self.csv_files.get(csv_file)
+            if entry is None:
+                file_exists = os.path.isfile(csv_file)
+                f = open(csv_file, 'a', newline='', encoding='utf-8-sig', buffering=64 * 1024)
+                writer = csv.DictWriter(f, fieldnames=row.keys())
+                if not file_exists:
+                    writer.writeheader()
+                entry = (f, writer)
+                self.csv_files[csv_file] = entry
+                # Не держим открытыми больше MAX_OPEN_CSV_FILES файлов: закрываем давно не использованные
+                while len(self.csv_files) > MAX_OPEN_CSV_FILES:
+                    _, (old_file, _) = self.csv_files.popitem(last=False)
+                    old_file.close()
+            else:
+                self.csv_files.move_to_end(csv_file)
+            entry[1].writerow(row)
+        self.start_flush_timer()
+    
+    def write_record(self, record):
+        """Метаданные письма строкой в общий JSONL текущего запуска"""
+        with self.lock:
+            if self.jsonl_file is None:
+                self.jsonl_path = os.path.join(
+                    self.base_folder, f"метаданные_писем_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.jsonl")
+                self.jsonl_file = open(self.jsonl_path, 'a', encoding='utf-8', buffering=64 * 1024)
+            self.jsonl_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.start_flush_timer()
+    
+    def flush(self):
+        """Сброс буферов всех открытых файлов на диск"""
+        with self.lock:
+            for f, _ in self.csv_files.values():
+                f.flush()
+            if self.jsonl_file is not None:
+                self.jsonl_file.flush()
+    
+    def close(self):
+        """Остановка таймера и закрытие файлов (следующая запись откроет их заново, JSONL - новый)"""
+        if self.flush_thread is not None:
+            self.stop_event.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        with self.lock:
+            for f, _ in self.csv_files.values():
+                f.close()
+            self.csv_files.clear()
+            if self.jsonl_file is not None:
+                self.jsonl_file.close()
+                logging.info(f"Метаданные писем сохранены в: {self.jsonl_path}")
+                self.jsonl_file = None
+
+
+def message_catalog_key(headers):
+    """Ключ письма в каталоге: Message-ID, а без него - хеш исходных заголовков Date, From и Subject"""
+    message_id = str(headers.get('Message-ID', '') or '').strip()
+    if message_id:
+        return message_id
+    raw = '\n'.join(str(headers.get(name, '') or '') for name in ('Date', 'From', 'Subject'))
+    return 'sha1:' + hashlib.sha1(raw.encode('utf-8', errors='surrogateescape')).hexdigest()
+
+
+class MessageCatalog:
+    """Каталог обработанных писем и сохраненных вложений в SQLite (WAL, фиксация пакетами)"""
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        # Запись идет и из потоков записи конвейера - соединение общее, под блокировкой
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_key TEXT PRIMARY KEY,
+                organization TEXT,
+                date_folder TEXT,
+                email_date TEXT,
+                subject TEXT,
+                sender TEXT,
+                files_saved INTEGER,
+                processed_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS attachments (
+                sha256 TEXT NOT NULL,
+                message_key TEXT NOT NULL,
+                filename TEXT,
+                path TEXT,
+                size INTEGER,
+                processed_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_organization ON messages (organization);
+            CREATE INDEX IF NOT EXISTS messages_date_folder ON messages (date_folder);
+            CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+            CREATE INDEX IF NOT EXISTS attachments_message ON attachments (message_key);
+        """)
+        # Ключи известных писем держим в памяти: проверка при каждом запуске без запросов к базе
+        self.known_keys = {row[0] for row in self.connection.execute('SELECT message_key FROM messages')}
+        self.pending = 0
+    
+    def __contains__(self, message_key):
+        return message_key in self.known_keys
+    
+    def __len__(self):
+        return len(self.known_keys)
+    
+    def add_message(self, message_key, organization, date_folder, email_data, files):
+        """Запись обработанного письма и его файлов: [(имя, путь, размер, sha256)]"""
+        processed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (message_key, organization, date_folder, email_data.get('date', ''), email_data.get('subject', ''),
+                 email_data.get('sender', ''), len(files), processed_at))
+            # Повторная запись письма заменяет его файлы, а не дописывает к старым
+            self.connection.execute('DELETE FROM attachments WHERE message_key = ?', (message_key,))
+            self.connection.executemany(
+                'INSERT INTO attachments VALUES (?, ?, ?, ?, ?, ?)',
+                [(sha256, message_key, filename, path, size, processed_at) for filename, path, size, sha256 in files])
+            self.known_keys.add(message_key)
+            self.pending += 1
+        if self.pending >= CATALOG_COMMIT_EVERY:
+            self.commit()
+    
+    def remove_message(self, message_key):
+        """Удаление письма и его файлов из каталога (откат записи, прерванной сбоем)"""
+        with self.lock:
+            self.connection.execute('DELETE FROM messages WHERE message_key = ?', (message_key,))
+            self.connection.execute('DELETE FROM attachments WHERE message_key = ?', (message_key,))
+            self.known_keys.discard(message_key)
+            self.pending += 1
+    
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                self.connection.commit()
+                self.pending = 0
+    
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class AttachmentStore:
+    """Хранилище вложений по содержимому: один экземпляр на SHA-256, в папках писем - жесткие ссылки на него"""
+    
+    def __init__(self, root):
+        # Объекты без расширения в папке с точкой: отчет, индекс папок и сортировщик их не трогают
+        self.root = root
+        self.hardlinks = True
+        self.files = 0
+        self.duplicates = 0
+        self.pointers = 0
+        self.bytes_total = 0
+        self.bytes_saved = 0
+        # Одно содержимое могут сохранять несколько потоков записи конвейера
+        self.lock = threading.Lock()
+    
+    def __getstate__(self):
+        """Копия для процессов разбора (обработчик передается им целиком): без блокировки"""
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+    
+    def object_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+    
+    def write_pointer(self, pointer_path, target_path):
+        """Файл-указатель с относительным путем к файлу с содержимым"""
+        with open(pointer_path, 'w', encoding='utf-8') as f:
+            f.write(os.path.relpath(target_path, os.path.dirname(pointer_path)) + '\n')
+        return pointer_path
+    
+    def read_pointer(self, pointer_path):
+        """Путь из файла-указателя или None, если указателя или файла по нему нет"""
+        try:
+            with open(pointer_path, 'r', encoding='utf-8') as f:
+                target_path = os.path.normpath(os.path.join(os.path.dirname(pointer_path), f.read().strip()))
+        except OSError:
+            return None
+        return target_path if os.path.isfile(target_path) else None
+    
+    def try_link(self, object_path, filepath):
+        """Жесткая ссылка на объект; при первой неудаче переходим на указатели до конца запуска"""
+        if not self.hardlinks:
+            return False
+        try:
+            os.link(object_path, filepath)
+            return True
+        except OSError as e:
+            logging.warning(f"⚠️ Жесткие ссылки недоступны ({e}), повторы вложений сохраняются указателями")
+            self.hardlinks = False
+            return False
+    
+    def store(self, temp_path, sha256, size, filepath):
+        """Размещение загруженного во временный файл вложения под именем filepath.
+        Возвращает путь сохраненного файла (или указателя для повтора без жестких ссылок)"""
+        with self.lock:
+            return self.store_unlocked(temp_path, sha256, size, filepath)
+    
+    def store_unlocked(self, temp_path, sha256, size, filepath):
+        self.files += 1
+        self.bytes_total += size
+        object_path = self.object_path(sha256)
+        
+        # Повтор: содержимое уже есть в хранилище (или, без жестких ссылок, в папке другого письма)
+        existing_path = object_path if os.path.isfile(object_path) else self.read_pointer(
+            object_path + DEDUP_POINTER_SUFFIX)
+        if existing_path:
+            os.remove(temp_path)
+            self.duplicates += 1
+            self.bytes_saved += size
+            if existing_path == object_path and self.try_link(object_path, filepath):
+                return filepath
+            self.pointers += 1
+            return self.write_pointer(filepath + DEDUP_POINTER_SUFFIX, existing_path)
+        
+        # Новое содержимое
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if self.hardlinks:
+            os.replace(temp_path, object_path)
+            if self.try_link(object_path, filepath):
+                return filepath
+            temp_path = object_path
+        # Без жестких ссылок файл остается в папке письма, а хранилище указывает на него
+        os.replace(temp_path, filepath)
+        self.write_pointer(object_path + DEDUP_POINTER_SUFFIX, filepath)
+        return filepath
+    
+    def reset_stats(self):
+        """Обнуление статистики перед новым запуском обработки"""
+        self.files = 0
+        self.duplicates = 0
+        self.pointers = 0
+        self.bytes_total = 0
+        self.bytes_saved = 0
+    
+    def stats_line(self):
+        """Строка статистики для отчета"""
+        stored = self.bytes_total - self.bytes_saved
+        ratio = self.bytes_total / stored if stored else 1.0
+        share = self.duplicates / self.files * 100 if self.files else 0
+        return (f"файлов {self.files}, повторов {self.duplicates} ({share:.1f}%), "
+                f"сэкономлено {self.bytes_saved / 1048576:.1f} МБ, коэффициент {ratio:.2f}, указателей {self.pointers}")
+
+
+class SyncState:
+    """Состояние инкрементальной синхронизации: UIDVALIDITY и последний обработанный UID по каждому ящику"""
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.mailboxes = {}
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    self.mailboxes = json.load(f).get('mailboxes', {})
+            except Exception as e:
+                logging.warning(f"Не удалось прочитать состояние синхронизации {filepath}: {e}")
+                self.mailboxes = {}
+    
+    def get(self, key):
+        """Состояние ящика или None, если синхронизации еще не было"""
+        return self.mailboxes.get(key)
+    
+    def update(self, key, uidvalidity, last_uid, deferred=None, failed=None):
+        """Обновление отметки последнего обработанного UID, списка отложенных писем и неудачных попыток"""
+        self.mailboxes[key] = {
+            'uidvalidity': uidvalidity,
+            'last_uid': last_uid,
+            'updated': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if deferred:
+            self.mailboxes[key]['deferred'] = sorted(deferred)
+        if failed:
+            # Ключи JSON - строки: {UID: число неудачных попыток}
+            self.mailboxes[key]['failed'] = {str(uid): attempts for uid, attempts in sorted(failed.items())}
+    
+    def save(self):
+        """Атомарная запись состояния (через временный файл)"""
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'mailboxes': self.mailboxes}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.filepath)
+
+
+class CheckpointJournal:
+    """Журнал запуска (JSONL, дописывается построчно): завершенные письма и начатые записи файлов.
+    После сбоя по нему пропускаются готовые письма и откатываются недописанные"""
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        # Завершенные письма попадают в журнал только при sync(), после сброса их метаданных
+        self.pending_done = []
+        self.run_key = None
+        self.uidvalidity = None
+        # Записи идут и из потоков записи конвейера
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """Журнал прошлого запуска: (заголовок, завершенные письма, незавершенные {письмо: папка, ключ, файлы})"""
+        header = None
+        done = set()
+        unfinished = {}
+        if not os.path.exists(self.filepath):
+            return header, done, unfinished
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Последняя строка могла не дописаться при сбое
+                        continue
+                    kind = record.get('type')
+                    if kind == 'run':
+                        header = record
+                    elif kind == 'begin':
+                        unfinished[record['id']] = {'folder': record.get('folder'),
+                                                    'message_key': record.get('message_key'), 'files': []}
+                    elif kind == 'file' and record['id'] in unfinished:
+                        unfinished[record['id']]['files'].append(record['path'])
+                    elif kind == 'done':
+                        done.add(record['id'])
+                        unfinished.pop(record['id'], None)
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать журнал обработки {self.filepath}: {e}")
+        return header, done, unfinished
+    
+    def start(self, run_key, uidvalidity, done=(), unfinished=None):
+        """Новый журнал: заголовок запуска, перенесенные завершенные письма и незавершенные записи для отката"""
+        self.run_key = run_key
+        self.uidvalidity = uidvalidity
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'type': 'run', 'key': run_key, 'uidvalidity': uidvalidity,
+                                'started': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, ensure_ascii=False) + '\n')
+            for item in done:
+                f.write(json.dumps({'type': 'done', 'id': item}, ensure_ascii=False) + '\n')
+            for item, entry in (unfinished or {}).items():
+                f.write(json.dumps({'type': 'begin', 'id': item, 'message_key': entry['message_key'],
+                                    'folder': entry['folder']}, ensure_ascii=False) + '\n')
+                for path in entry['files']:
+                    f.write(json.dumps({'type': 'file', 'id': item, 'path': path}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.filepath)
+        self.file = open(self.filepath, 'a', encoding='utf-8')
+        self.pending_done = []
+    
+    def write(self, record):
+        """Строка журнала; сбрасывается сразу, чтобы пережить падение процесса"""
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.file.flush()
+    
+    def begin(self, item, message_key, folder):
+        self.write({'type': 'begin', 'id': item, 'message_key': message_key, 'folder': folder})
+    
+    def add_file(self, item, path):
+        # Пишется до создания файла: при откате удаляются и недописанные .part
+        self.write({'type': 'file', 'id': item, 'path': path})
+    
+    def done(self, item):
+        with self.lock:
+            self.pending_done.append(item)
+    
+    def sync(self):
+        """Запись завершенных писем и сброс журнала на диск (fsync). Вызывается после сброса метаданных
+        и каталога: письма, завершенные позже, после сбоя откатываются и обрабатываются заново"""
+        with self.lock:
+            if self.file is not None:
+                for item in self.pending_done:
+                    self.file.write(json.dumps({'type': 'done', 'id': item}, ensure_ascii=False) + '\n')
+                self.pending_done = []
+                self.file.flush()
+                os.fsync(self.file.fileno())
+    
+    def close(self):
+        """Закрытие без сжатия: журнал остается для продолжения после сбоя"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.pending_done = []
+    
+    def finish(self, keep=()):
+        """Завершение запуска: в журнале остаются завершенные письма, еще не учтенные отметкой UID, и
+        письма, запись которых прервала ошибка, - их откатит следующий запуск. Вызывается после sync()"""
+        self.close()
+        _, _, unfinished = self.load()
+        if keep or unfinished:
+            self.start(self.run_key, self.uidvalidity, keep, unfinished)
+            self.close()
+        elif os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
 class EmailOrganizationProcessor:
-    def __init__(self, imap_server, email_address, password, organizations_file):
+    def __init__(self, imap_server, email_address, password, organizations_file,
+                 batch_size=200, batch_max_bytes=64 * 1024 * 1024, sync_state_file=None,
+                 prescan=False, sender_prematch=None, connections=1, engine='sync', streaming=False,
+                 org_match='first', header_cache_size=HEADER_CACHE_SIZE, metadata_format='txt',
+                 catalog_file=None, use_catalog=True, dedup=False, imap_port=993, use_ssl=True,
+                 prometheus_file=None, pipeline=False, parse_workers=1, write_workers=1,
+                 queue_size=PIPELINE_QUEUE_SIZE, journal_file=None, use_journal=True):
         """
         Инициализация обработчика писем с сортировкой по организациям
         """
         self.imap_server = imap_server
+        # Порт и SSL настраиваются для локальных и тестовых серверов (по умолчанию IMAPS, порт 993)
+        self.imap_port = imap_port
+        self.use_ssl = use_ssl
         self.email_address = email_address
         self.password = password
         self.mail = None
         
+        # Пакетная загрузка: сколько писем запрашивать одной командой UID FETCH
+        # и сколько байт максимум держать в памяти за один пакет
+        self.batch_size = max(1, batch_size)
+        self.batch_max_bytes = batch_max_bytes
+        
+        # Предварительный просмотр BODYSTRUCTURE: загружаются только письма и части с нужными вложениями
+        self.prescan = prescan or streaming
+        
+        # Потоковое сохранение: вложения загружаются частями по STREAM_CHUNK_BYTES и декодируются
+        # сразу во временный файл в папке даты (нужна структура письма, поэтому включает предпросмотр)
+        self.streaming = streaming
+        self.bytes_total = 0
+        self.bytes_downloaded = 0
+        
+        # Предварительное сопоставление отправителя по заголовкам: None (выключено),
+        # 'skip' - не загружать письма неизвестных отправителей, 'defer' - отложить до
+        # запуска с --process-deferred, 'download' - загружать все, только посчитать совпадения
+        self.sender_prematch = sender_prematch
+        self.deferred_uids = set()
+        # Письма с неудачными попытками загрузки или сохранения: {UID: число попыток}
+        self.failed_uids = {}
+        
+        # Пул соединений: письма загружают и разбирают несколько сессий, сохранение идет по порядку UID
+        if connections > MAX_IMAP_CONNECTIONS:
+            logging.warning(f"⚠️ Запрошено {connections} соединений, используется максимум {MAX_IMAP_CONNECTIONS}")
+        self.connections = max(1, min(connections, MAX_IMAP_CONNECTIONS))
+        self.pool_local = threading.local()
+        self.pool_connections = []
+        self.counters_lock = threading.Lock()
+        
+        # Движок загрузки: 'sync' - imaplib (с пулом потоков при connections > 1),
+        # 'async' - asyncio с конвейером команд на каждом соединении
+        self.engine = engine
+        
+        # Конвейер: загрузка (connections соединений), разбор (parse_workers процессов) и запись
+        # (write_workers потоков, письма одной организации - в одном потоке по порядку) идут одновременно,
+        # между этапами - очереди не больше queue_size писем
+        self.pipeline = pipeline
+        self.parse_workers = max(1, parse_workers)
+        self.write_workers = max(1, write_workers)
+        self.queue_size = max(1, queue_size)
+        self.defer_parse = False
+        self.stream_mail = None
+        self.folder_lock = threading.Lock()
+        
+        # Ограниченные LRU-кэши: одни и те же отправители и закодированные темы повторяются тысячи раз
+        self.header_cache_size = header_cache_size
+        self.decode_header_cached = functools.lru_cache(maxsize=header_cache_size)(self.decode_header_uncached)
+        self.clean_organization_name_cached = functools.lru_cache(maxsize=header_cache_size)(
+            self.clean_organization_name_uncached)
+        
         # Основная папка для всех организаций
         self.base_folder = "Организации_и_письма"
         
+        # Обрабатываемый почтовый ящик и файл состояния инкрементальной синхронизации
+        self.mailbox = 'INBOX'
+        self.sync_state_file = sync_state_file or os.path.join(self.base_folder, "состояние_синхронизации.json")
+        
+        # Каталог обработанных писем (SQLite): уже сохраненные письма не загружаются повторно
+        self.catalog_file = (catalog_file or os.path.join(self.base_folder, "каталог_писем.sqlite")) if use_catalog else None
+        self.catalog = None
+        
+        # Журнал запуска: завершенные письма и начатые записи файлов (продолжение и откат после сбоя)
+        self.journal_file = (journal_file or os.path.join(self.base_folder, "журнал_обработки.jsonl")) if use_journal else None
+        self.journal = None
+        
+        # Дедупликация вложений по SHA-256: повторы становятся жесткими ссылками на одну копию
+        self.attachment_store = AttachmentStore(os.path.join(self.base_folder, ".хранилище_вложений")) if dedup else None
+        
+        # Метаданные писем: 'txt' - информация_о_письме.txt в папке письма, 'jsonl' - один файл за запуск;
+        # все_письма.csv организаций пишутся в обоих случаях через буферизованный писатель
+        self.metadata_format = metadata_format
+        self.metadata_writer = MetadataWriter(self.base_folder, metadata_format)
+        
+        # Замеры времени этапов: таблица в отчете, метрики_обработки.json в базовой папке и,
+        # если задан файл, метрики Prometheus для textfile collector node_exporter
+        self.timings = StageTimings()
+        self.prometheus_file = prometheus_file
+        
         # Поддерживаемые форматы файлов
         self.supported_extensions = ['xlsx', 'pdf', 'docx', 'doc']
         
         # Словарь для отслеживания уже созданных папок организаций
         self.organizations_cache = {}
         
-        # Загружаем список организаций
+        # Создаем базовую папку до загрузки списка (туда пишется отладка_организаций.txt)
+        os.makedirs(self.base_folder, exist_ok=True)
+        
+        # Загружаем список организаций и строим по ключам автомат поиска
+        # ('first' - первый подходящий ключ в порядке файла, 'longest' - самый длинный)
         self.organizations_mapping = self.load_organizations_mapping(organizations_file)
+        self.organization_matcher = OrganizationMatcher(self.organizations_mapping, longest=(org_match == 'longest'))
         
-        # Создаем базовую папку
-        os.makedirs(self.base_folder, exist_ok=True)
+        # Индексируем уже созданные папки организаций
+        self.build_folder_index()
+    
+    def __getstate__(self):
+        """Копия для процессов разбора: без соединений, потоков, кэшей и открытых файлов"""
+        state = self.__dict__.copy()
+        for name in ('mail', 'stream_mail', 'pool_local', 'pool_connections', 'counters_lock', 'folder_lock',
+                     'decode_header_cached', 'clean_organization_name_cached', 'metadata_writer', 'catalog',
+                     'sync_state', 'timings', 'journal'):
+            state.pop(name, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mail = None
+        self.stream_mail = None
+        self.catalog = None
+        self.journal = None
+        self.metadata_writer = None
+        self.pool_local = threading.local()
+        self.pool_connections = []
+        self.counters_lock = threading.Lock()
+        self.folder_lock = threading.Lock()
+        self.timings = StageTimings()
+        self.decode_header_cached = functools.lru_cache(maxsize=self.header_cache_size)(self.decode_header_uncached)
+        self.clean_organization_name_cached = functools.lru_cache(maxsize=self.header_cache_size)(
+            self.clean_organization_name_uncached)
     
     def load_organizations_mapping(self, filepath):
         """Загрузка словаря соответствия 'ключ поиска' -> 'название папки' из файла"""
@@ -99,13 +1387,18 @@ class EmailOrganizationProcessor:
         # Убираем разделители
         clean_search_text = re.sub(r'[_\-.]', ' ', search_text)
 
-        for search_key, folder_name in self.organizations_mapping.items():
-            # Ищем ключ в очищенном заголовке (без учета регистра и разделителей)
-            if search_key.lower() in clean_search_text:
-                return folder_name
-        return None # Не найдено соответствие
+        # Ищем все ключи в очищенном заголовке за один проход (без учета регистра и разделителей)
+        return self.organization_matcher.find(clean_search_text)
 
     def clean_organization_name(self, name):
+        """Очистка и нормализация названия организации (через кэш по исходной строке)"""
+        try:
+            return self.clean_organization_name_cached(name)
+        except TypeError:
+            # Нехешируемое значение - без кэша
+            return self.clean_organization_name_uncached(name)
+    
+    def clean_organization_name_uncached(self, name):
         """Очистка и нормализация названия организации (для случаев без списка)"""
         if not name:
             return ""
@@ -263,8 +1556,43 @@ class EmailOrganizationProcessor:
             logging.warning(f"Не удалось извлечь организацию из отправителя: {e}")
             return "Неизвестная_организация", "Неизвестная_организация"
     
+    def build_folder_index(self):
+        """Индекс существующих папок организаций: один проход os.scandir по базовой папке"""
+        # Имена сравниваются через os.path.normcase - как os.path.exists (на Windows без учета регистра)
+        self.base_folder_names = set()
+        self.org_folder_index = {}
+        self.date_folder_index = {}
+        with os.scandir(self.base_folder) as entries:
+            for entry in entries:
+                self.base_folder_names.add(os.path.normcase(entry.name))
+                # Служебные папки с точкой (хранилище вложений) - не организации
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    # Первая подходящая папка в порядке каталога, как при переборе os.listdir
+                    self.org_folder_index.setdefault(self.clean_organization_name(entry.name), entry.path)
+    
+    def get_date_folder_names(self, org_folder_path):
+        """Имена в папке организации (индексируются при первом обращении к папке)"""
+        names = self.date_folder_index.get(org_folder_path)
+        if names is None:
+            names = set()
+            if os.path.isdir(org_folder_path):
+                with os.scandir(org_folder_path) as entries:
+                    names = {os.path.normcase(entry.name) for entry in entries}
+            self.date_folder_index[org_folder_path] = names
+        return names
+    
     def get_organization_folder(self, organization_name, email_date):
         """Получение или создание папки организации и подпапки с датой"""
+        # Индексы папок общие для потоков записи конвейера
+        with self.folder_lock:
+            return self.get_organization_folder_unlocked(organization_name, email_date)
+    
+    def resolve_organization_folder(self, organization_name):
+        """Папка организации (создается при первом обращении) - без подпапки письма"""
+        with self.folder_lock:
+            return self.resolve_organization_folder_unlocked(organization_name)
+    
+    def resolve_organization_folder_unlocked(self, organization_name):
         # Очищаем имя организации для использования в пути
         safe_org_name = organization_name
         
@@ -273,52 +1601,67 @@ class EmailOrganizationProcessor:
         if organization_name in self.organizations_cache:
             org_folder_path = self.organizations_cache[organization_name]
         else:
-            # Ищем существующую папку
-            for item in os.listdir(self.base_folder):
-                item_path = os.path.join(self.base_folder, item)
-                if os.path.isdir(item_path):
-                    # Проверяем схожесть имен (без учета регистра и окончаний)
-                    item_clean = self.clean_organization_name(item)
-                    if item_clean == organization_name:
-                        org_folder_path = item_path
-                        self.organizations_cache[organization_name] = org_folder_path
-                        break
+            # Ищем существующую папку по индексу (без учета регистра и окончаний)
+            org_folder_path = self.org_folder_index.get(organization_name)
+            if org_folder_path:
+                self.organizations_cache[organization_name] = org_folder_path
             
             # Если не нашли, создаем новую
             if not org_folder_path:
-                # Создаем папку с оригинальным именем
-                org_folder_path = os.path.join(self.base_folder, safe_org_name)
-                
-                # Если такая папка уже существует (но под другим названием)
+                # Создаем папку с оригинальным именем; если имя занято (но под другим названием) - с номером
+                org_folder_name = safe_org_name
                 counter = 1
-                original_path = org_folder_path
-                while os.path.exists(org_folder_path):
-                    org_folder_path = f"{original_path}_{counter}"
+                while os.path.normcase(org_folder_name) in self.base_folder_names:
+                    org_folder_name = f"{safe_org_name}_{counter}"
                     counter += 1
+                org_folder_path = os.path.join(self.base_folder, org_folder_name)
                 
                 os.makedirs(org_folder_path, exist_ok=True)
+                self.base_folder_names.add(os.path.normcase(org_folder_name))
+                self.org_folder_index.setdefault(self.clean_organization_name(org_folder_name), org_folder_path)
                 self.organizations_cache[organization_name] = org_folder_path
                 logging.info(f"Создана папка организации: {os.path.basename(org_folder_path)}")
+        return org_folder_path
+    
+    def get_organization_folder_unlocked(self, organization_name, email_date):
+        org_folder_path = self.resolve_organization_folder_unlocked(organization_name)
         
         # Создаем подпапку с датой письма
+        date_folder_names = self.get_date_folder_names(org_folder_path)
         date_folder_name = self.format_date_for_folder(email_date)
-        date_folder_path = os.path.join(org_folder_path, date_folder_name)
         
         # Если папка с такой датой уже существует, добавляем время с секундами
         counter = 1
-        original_date_path = date_folder_path
-        while os.path.exists(date_folder_path):
+        while os.path.normcase(date_folder_name) in date_folder_names:
             date_folder_name = email_date.strftime("%Y-%m-%d_%H%M%S")
             if counter > 1:
                 date_folder_name = f"{date_folder_name}_{counter}"
-            date_folder_path = os.path.join(org_folder_path, date_folder_name)
             counter += 1
+        date_folder_path = os.path.join(org_folder_path, date_folder_name)
         
         os.makedirs(date_folder_path, exist_ok=True)
+        date_folder_names.add(os.path.normcase(date_folder_name))
         
         return org_folder_path, date_folder_path, os.path.basename(org_folder_path), date_folder_name
     
     def decode_header(self, header):
+        """Декодирование заголовка через кэш по исходному значению"""
+        with self.timings.measure('header_decode'):
+            try:
+                return self.decode_header_cached(header)
+            except TypeError:
+                # email.header.Header и другие нехешируемые значения - без кэша
+                return self.decode_header_uncached(header)
+    
+    def cache_stats_line(self, cache):
+        """Строка статистики LRU-кэша для отчета"""
+        info = cache.cache_info()
+        total = info.hits + info.misses
+        hit_rate = info.hits / total * 100 if total else 0
+        return (f"попаданий {info.hits}, промахов {info.misses} ({hit_rate:.1f}% попаданий), "
+                f"записей {info.currsize} из {info.maxsize}")
+    
+    def decode_header_uncached(self, header):
         """Декодирование заголовка с исправлением кодировки"""
         if not header:
             return ""
@@ -360,6 +1703,28 @@ class EmailOrganizationProcessor:
             logging.warning(f"Ошибка декодирования заголовка: {e}")
             return str(header)
     
+    def decode_body_text(self, payload, declared_charset=None):
+        """Начало текста письма (BODY_PREVIEW_CHARS + 1 символ): объявленная кодировка, иначе chardet по началу"""
+        limit = BODY_PREVIEW_CHARS + 1
+        # Байт хватает на limit символов в любой кодировке (до 4 байт на символ)
+        prefix = payload[:(limit + 1) * 4]
+        
+        if declared_charset:
+            try:
+                # Инкрементальный декодер не спотыкается о символ, разрезанный концом префикса
+                decoder = codecs.getincrementaldecoder(declared_charset)(errors='strict')
+                return decoder.decode(prefix, final=len(prefix) == len(payload))[:limit]
+            except (LookupError, UnicodeDecodeError):
+                # Неизвестная или неверно объявленная кодировка - определяем по содержимому
+                pass
+        
+        result = chardet.detect(payload[:CHARSET_DETECT_BYTES])
+        encoding = result['encoding'] if result['encoding'] else 'utf-8'
+        try:
+            return prefix.decode(encoding, errors='ignore')[:limit]
+        except LookupError:
+            return prefix.decode('utf-8', errors='ignore')[:limit]
+    
     def get_email_body(self, msg):
         """Получение текста письма"""
         body = ""
@@ -372,9 +1737,7 @@ class EmailOrganizationProcessor:
                     try:
                         payload = part.get_payload(decode=True)
                         if payload:
-                            result = chardet.detect(payload)
-                            encoding = result['encoding'] if result['encoding'] else 'utf-8'
-                            body = payload.decode(encoding, errors='ignore')
+                            body = self.decode_body_text(payload, part.get_content_charset())
                             break
                     except Exception as e:
                         logging.warning(f"Ошибка декодирования тела письма: {e}")
@@ -383,9 +1746,7 @@ class EmailOrganizationProcessor:
             try:
                 payload = msg.get_payload(decode=True)
                 if payload:
-                    result = chardet.detect(payload)
-                    encoding = result['encoding'] if result['encoding'] else 'utf-8'
-                    body = payload.decode(encoding, errors='ignore')
+                    body = self.decode_body_text(payload, msg.get_content_charset())
             except Exception as e:
                 logging.warning(f"Ошибка получения тела письма: {e}")
         
@@ -394,30 +1755,44 @@ class EmailOrganizationProcessor:
     def save_email_metadata(self, date_folder_path, email_data, organization):
         """Сохранение метаданных письма"""
         try:
-            # Создаем текстовый файл с информацией о письме
-            metadata_file = os.path.join(date_folder_path, "информация_о_письме.txt")
-            
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                f.write("=" * 60 + "\n")
-                f.write("ИНФОРМАЦИЯ О ПИСЬМЕ\n")
-                f.write("=" * 60 + "\n\n")
-                
-                f.write(f"Организация: {organization}\n")
-                f.write(f"Дата письма: {email_data.get('date', 'Неизвестно')}\n")
-                f.write(f"Тема: {email_data.get('subject', 'Без темы')}\n")
-                f.write(f"Отправитель: {email_data.get('sender', 'Неизвестно')}\n")
-                f.write(f"Дата обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n")
-                f.write(f"Количество вложений: {len(email_data.get('attachments', []))}\n\n")
+            body = email_data.get('body', '')
+            if self.metadata_format == 'jsonl':
+                # Одна строка на письмо в общем файле запуска вместо отдельного файла в папке письма
+                self.metadata_writer.write_record({
+                    'organization': organization,
+                    'folder': os.path.relpath(date_folder_path, self.base_folder),
+                    'date': email_data.get('date', 'Неизвестно'),
+                    'subject': email_data.get('subject', 'Без темы'),
+                    'sender': email_data.get('sender', 'Неизвестно'),
+                    'processed': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    'attachments': [attachment['filename'] for attachment in email_data.get('attachments', [])],
+                    'body': body[:500],
+                    'body_truncated': len(body) > 500
+                })
+            else:
+                # Создаем текстовый файл с информацией о письме
+                metadata_file = os.path.join(date_folder_path, "информация_о_письме.txt")
                 
-                # Сохраняем первые 500 символов тела письма
-                body = email_data.get('body', '')
-                if body:
-                    f.write("Текст письма (начало):\n")
-                    f.write("-" * 40 + "\n")
-                    f.write(body[:500])
-                    if len(body) > 500:
-                        f.write("\n... [текст обрезан]")
-                    f.write("\n")
+                with open(metadata_file, 'w', encoding='utf-8') as f:
+                    f.write("=" * 60 + "\n")
+                    f.write("ИНФОРМАЦИЯ О ПИСЬМЕ\n")
+                    f.write("=" * 60 + "\n\n")
+                    
+                    f.write(f"Организация: {organization}\n")
+                    f.write(f"Дата письма: {email_data.get('date', 'Неизвестно')}\n")
+                    f.write(f"Тема: {email_data.get('subject', 'Без темы')}\n")
+                    f.write(f"Отправитель: {email_data.get('sender', 'Неизвестно')}\n")
+                    f.write(f"Дата обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n")
+                    f.write(f"Количество вложений: {len(email_data.get('attachments', []))}\n\n")
+                    
+                    # Сохраняем первые 500 символов тела письма
+                    if body:
+                        f.write("Текст письма (начало):\n")
+                        f.write("-" * 40 + "\n")
+                        f.write(body[:500])
+                        if len(body) > 500:
+                            f.write("\n... [текст обрезан]")
+                        f.write("\n")
             
             # Также сохраняем в общий CSV файл организации
             org_folder_path = os.path.dirname(date_folder_path)
@@ -431,23 +1806,25 @@ class EmailOrganizationProcessor:
                 'Вложений': len(email_data.get('attachments', [])),
                 'Дата_обработки': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
-            
-            file_exists = os.path.isfile(csv_file)
-            with open(csv_file, 'a', newline='', encoding='utf-8-sig') as f:
-                writer = csv.DictWriter(f, fieldnames=csv_data.keys())
-                if not file_exists:
-                    writer.writeheader()
-                writer.writerow(csv_data)
+            self.metadata_writer.write_csv_row(csv_file, csv_data)
                 
         except Exception as e:
             logging.error(f"Ошибка сохранения метаданных письма: {e}")
     
+    def open_connection(self):
+        """Новое авторизованное соединение с почтовым сервером"""
+        if self.use_ssl:
+            mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+        else:
+            mail = imaplib.IMAP4(self.imap_server, self.imap_port)
+        mail.login(self.email_address, self.password)
+        return mail
+    
     def connect(self):
         """Подключение к почтовому серверу"""
         try:
             logging.info(f"Подключение к {self.imap_server}...")
-            self.mail = imaplib.IMAP4_SSL(self.imap_server)
-            self.mail.login(self.email_address, self.password)
+            self.mail = self.open_connection()
             logging.info("✓ Успешное подключение!")
             return True
         except Exception as e:
@@ -464,127 +1841,1387 @@ class EmailOrganizationProcessor:
             except:
                 pass
     
-    def process_emails(self, days=7):
-        """Основная обработка писем"""
-        if not self.connect():
+    def count_bytes(self, total=0, downloaded=0):
+        """Учет объема писем и загруженных данных (вызывается и из потоков пула)"""
+        with self.counters_lock:
+            self.bytes_total += total
+            self.bytes_downloaded += downloaded
+    
+    def uid_fetch(self, mail, message_set, items):
+        """UID FETCH через imaplib с замером времени загрузки"""
+        with self.timings.measure('imap_fetch'):
+            return mail.uid('FETCH', message_set, items)
+    
+    def get_message_sizes(self, uids, mail=None):
+        """Получение размеров писем (RFC822.SIZE) одной командой"""
+        mail = self.mail if mail is None else mail
+        sizes = {}
+        if not uids:
+            return sizes
+        try:
+            result, data = self.uid_fetch(mail, format_message_set(uids), '(RFC822.SIZE)')
+            if result != 'OK':
+                return sizes
+            for fetched in parse_imap_fetch_response(data):
+                if 'UID' in fetched and 'RFC822.SIZE' in fetched:
+                    sizes[int(fetched['UID'])] = int(fetched['RFC822.SIZE'])
+        except Exception as e:
+            logging.warning(f"Не удалось получить размеры писем: {e}")
+        return sizes
+    
+    def split_into_batches(self, uids, sizes=None):
+        """Разбиение UID на пакеты по количеству писем и суммарному размеру"""
+        sizes = sizes or {}
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if batch and (len(batch) >= self.batch_size or batch_bytes + size > self.batch_max_bytes):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(uid)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def fetch_emails_batched(self, uids, mail=None, sizes=None):
+        """Пакетная загрузка писем: одна команда UID FETCH на пакет, письма отдаются по одному"""
+        mail = self.mail if mail is None else mail
+        if sizes is None:
+            sizes = self.get_message_sizes(uids, mail)
+            self.count_bytes(total=sum(sizes.values()))
+        batches = self.split_into_batches(uids, sizes)
+        logging.info(f"Загрузка {len(uids)} писем пакетами: {len(batches)} запрос(ов)")
+        
+        for batch in batches:
+            try:
+                result, data = self.uid_fetch(mail, format_message_set(batch), '(RFC822)')
+                if result != 'OK':
+                    logging.error(f"Ошибка загрузки пакета UID {batch[0]}-{batch[-1]}")
+                    continue
+                
+                fetched_by_uid = {}
+                for fetched in parse_imap_fetch_response(data):
+                    if 'UID' in fetched and isinstance(fetched.get('RFC822'), bytes):
+                        fetched_by_uid[int(fetched['UID'])] = fetched['RFC822']
+                del data
+            except Exception as e:
+                logging.error(f"Ошибка загрузки пакета UID {batch[0]}-{batch[-1]}: {e}")
+                continue
+            
+            # Отдаем письма в порядке UID, освобождая память по мере обработки
+            for uid in batch:
+                raw_email = fetched_by_uid.pop(uid, None)
+                if raw_email is None:
+                    continue
+                self.count_bytes(downloaded=len(raw_email))
+                try:
+                    email_data = self.parse_or_defer(raw_email)
+                except Exception as e:
+                    logging.error(f"Ошибка обработки письма: {e}")
+                    continue
+                yield uid, email_data
+    
+    def plan_message_parts(self, leaves):
+        """Выбор по BODYSTRUCTURE частей для загрузки: текст письма и поддерживаемые вложения"""
+        plan = {'body': None, 'attachments': [], 'size': 0, 'body_size': 0, 'encodings': {}}
+        for leaf in leaves:
+            if leaf['disposition'] == 'attachment':
+                # Имя файла разбираем так же, как email.message (включая RFC 2231)
+                part_headers = email.message.Message()
+                part_headers['Content-Type'] = leaf['content_type'] + ''.join(
+                    f'; {key}="{value}"' for key, value in leaf['params'])
+                part_headers['Content-Disposition'] = 'attachment' + ''.join(
+                    f'; {key}="{value}"' for key, value in leaf['disposition_params'])
+                filename = part_headers.get_filename()
+                if filename:
+                    decoded_filename = self.decode_header(filename)
+                    file_ext = os.path.splitext(decoded_filename)[1].lower().replace('.', '')
+                    if file_ext in self.supported_extensions:
+                        plan['attachments'].append(leaf['section'])
+                        plan['encodings'][leaf['section']] = leaf['encoding']
+                        plan['size'] += leaf['size']
+            elif leaf['content_type'] == 'text/plain' and plan['body'] is None:
+                plan['body'] = leaf['section']
+                plan['size'] += leaf['size']
+                plan['body_size'] = leaf['size']
+        return plan
+    
+    def plan_from_prescan(self, fetched):
+        """План загрузки письма по ответу фазы 1 (BODYSTRUCTURE, ENVELOPE, RFC822.SIZE)"""
+        structure = fetched['BODYSTRUCTURE']
+        message_size = int(fetched.get('RFC822.SIZE') or 0)
+        plan = self.plan_message_parts(parse_bodystructure(structure))
+        if plan['attachments'] and not (isinstance(structure, list) and structure and isinstance(structure[0], list)):
+            # Письмо из одной части: вложение возможно только как все письмо целиком
+            plan = {'body': None, 'attachments': [], 'size': message_size, 'full': True}
+        plan['wanted'] = bool(plan['attachments'] or plan.get('full'))
+        envelope = fetched.get('ENVELOPE')
+        if isinstance(envelope, list) and len(envelope) > 9:
+            plan['message_id'] = _imap_str(envelope[9])
+        return plan
+    
+    def prescan_items(self, plan):
+        """Элементы UID FETCH фазы 2 для письма (при потоковом сохранении - без содержимого вложений)"""
+        if plan.get('full'):
+            return '(BODY.PEEK[HEADER])' if self.streaming else '(RFC822)'
+        items = ['BODY.PEEK[HEADER.FIELDS (DATE SUBJECT FROM MESSAGE-ID)]']
+        if plan['body']:
+            items.append(f"BODY.PEEK[{plan['body']}.MIME] BODY.PEEK[{plan['body']}]")
+        for section in plan['attachments']:
+            items.append(f'BODY.PEEK[{section}.MIME]' if self.streaming
+                         else f'BODY.PEEK[{section}.MIME] BODY.PEEK[{section}]')
+        return '(' + ' '.join(items) + ')'
+    
+    def prescan_fetch_size(self, plan):
+        """Объем, загружаемый в фазе 2 (для разбиения по batch_max_bytes)"""
+        if not self.streaming:
+            return plan['size']
+        return 0 if plan.get('full') else plan['body_size']
+    
+    def prescan_commands(self, uids, plans):
+        """Команды фазы 2: письма с одинаковым набором секций загружаются одной командой"""
+        groups = {}
+        for uid in uids:
+            groups.setdefault(self.prescan_items(plans[uid]), []).append(uid)
+        
+        commands = []
+        for items, group_uids in groups.items():
+            sizes = {uid: self.prescan_fetch_size(plans[uid]) for uid in group_uids}
+            for batch in self.split_into_batches(group_uids, sizes):
+                commands.append((batch, items))
+        return commands
+    
+    def parse_or_defer(self, fetched, plan=None):
+        """Разбор загруженного письма (RFC822 или ответ фазы 2 с планом частей);
+        в конвейере - задача (загруженные данные, план) для этапа разбора"""
+        if plan is not None:
+            self.count_bytes(downloaded=sum(len(value) for value in fetched.values() if isinstance(value, bytes)))
+        if self.defer_parse:
+            return fetched, plan
+        return self.parse_fetched_message(fetched, plan)
+    
+    def parse_fetched_message(self, fetched, plan=None):
+        """Данные письма из загруженного RFC822 или ответа фазы 2"""
+        with self.timings.measure('mime_parse'):
+            if plan is not None:
+                return self.email_data_from_prescan(fetched, plan)
+            return self.extract_email_data(fetched)
+    
+    def parse_jobs(self, jobs):
+        """Разбор задач этапа разбора: [(uid, данные письма или None)]; письма с ошибкой разбора пропускаются"""
+        results = []
+        for uid, job in jobs:
+            if job is None:
+                # Письмо без нужных вложений (определено по структуре без загрузки)
+                results.append((uid, None))
+                continue
+            try:
+                results.append((uid, self.parse_fetched_message(*job)))
+            except Exception as e:
+                logging.error(f"Ошибка обработки письма: {e}")
+        return results
+    
+    def email_data_from_prescan(self, fetched, plan):
+        """Данные письма из ответа фазы 2"""
+        if plan.get('full') and self.streaming:
+            return self.extract_single_part_stream_data(fetched)
+        if plan.get('full'):
+            return self.extract_email_data(fetched['RFC822'])
+        return self.extract_email_data_from_parts(fetched, plan)
+    
+    def fetch_emails_prescan(self, uids, mail=None):
+        """Двухфазная загрузка: BODYSTRUCTURE для всех писем, затем только нужные части (BODY.PEEK[n])"""
+        mail = self.mail if mail is None else mail
+        
+        for batch in self.split_into_batches(uids):
+            # Фаза 1: структура писем пакета
+            plans = {}
+            try:
+                result, data = self.uid_fetch(mail, format_message_set(batch), PRESCAN_FETCH_ITEMS)
+                if result != 'OK':
+                    logging.error(f"Ошибка получения структуры писем UID {batch[0]}-{batch[-1]}")
+                    continue
+                for fetched in parse_imap_fetch_response(data):
+                    if 'UID' in fetched and 'BODYSTRUCTURE' in fetched:
+                        self.count_bytes(total=int(fetched.get('RFC822.SIZE') or 0))
+                        plans[int(fetched['UID'])] = self.plan_from_prescan(fetched)
+            except Exception as e:
+                logging.error(f"Ошибка получения структуры писем UID {batch[0]}-{batch[-1]}: {e}")
+                continue
+            
+            wanted = [uid for uid in batch if uid in plans and plans[uid]['wanted']]
+            logging.info(f"🔎 Предпросмотр структуры: письма с нужными вложениями {len(wanted)} из {len(batch)}")
+            
+            # Фаза 2 частями не больше batch_max_bytes; письма отдаются в порядке UID,
+            # письма без нужных вложений - как обработанные без загрузки (None)
+            position = 0
+            wanted_sizes = {uid: self.prescan_fetch_size(plans[uid]) for uid in wanted}
+            for sub_batch in self.split_into_batches(wanted, wanted_sizes) + [[]]:
+                fetched_parts = {}
+                for command_uids, items in self.prescan_commands(sub_batch, plans):
+                    try:
+                        result, data = self.uid_fetch(mail, format_message_set(command_uids), items)
+                        if result != 'OK':
+                            logging.error(f"Ошибка загрузки частей писем UID {command_uids[0]}-{command_uids[-1]}")
+                            continue
+                        for fetched in parse_imap_fetch_response(data):
+                            if 'UID' in fetched:
+                                fetched_parts[int(fetched['UID'])] = fetched
+                        del data
+                    except Exception as e:
+                        logging.error(f"Ошибка загрузки частей писем UID {command_uids[0]}-{command_uids[-1]}: {e}")
+                
+                last_uid = sub_batch[-1] if sub_batch else batch[-1]
+                while position < len(batch) and batch[position] <= last_uid:
+                    uid = batch[position]
+                    position += 1
+                    if uid not in plans:
+                        continue
+                    if not plans[uid]['wanted']:
+                        yield uid, None
+                        continue
+                    fetched = fetched_parts.pop(uid, None)
+                    if fetched is None:
+                        continue
+                    try:
+                        email_data = self.parse_or_defer(fetched, plans[uid])
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки письма: {e}")
+                        continue
+                    yield uid, email_data
+    
+    def extract_email_data_from_parts(self, fetched, plan):
+        """Сборка данных письма из загруженных заголовков и отдельных частей"""
+        header_bytes = b''
+        for key, value in fetched.items():
+            if key.startswith('BODY[HEADER.FIELDS') and isinstance(value, bytes):
+                header_bytes = value
+        headers = email.message_from_bytes(header_bytes)
+        
+        def load_part(section):
+            # MIME-заголовки части + ее содержимое = самостоятельное сообщение
+            mime = fetched.get(f'BODY[{section}.MIME]') or b''
+            content = fetched.get(f'BODY[{section}]') or b''
+            return email.message_from_bytes(mime + content)
+        
+        email_date_str = headers.get("Date", "")
+        email_data = {
+            'date': email_date_str,
+            'date_obj': self.parse_email_date(email_date_str),
+            'subject': self.decode_header(headers.get("Subject", "Без темы")),
+            'sender': self.decode_header(headers.get("From", "")),
+            'body': self.get_email_body(load_part(plan['body'])) if plan['body'] else "",
+            'message_key': message_catalog_key(headers),
+            'attachments': []
+        }
+        
+        for section in plan['attachments']:
+            part = load_part(section)
+            decoded_filename = self.decode_header(part.get_filename())
+            file_ext = os.path.splitext(decoded_filename)[1].lower().replace('.', '')
+            attachment = {
+                'filename': decoded_filename,
+                'extension': file_ext
+            }
+            if self.streaming:
+                # Содержимое не загружено: при сохранении оно читается с сервера частями
+                attachment.update({'uid': int(fetched['UID']), 'section': section,
+                                   'encoding': plan['encodings'].get(section, '')})
+            else:
+                attachment['content'] = part.get_payload(decode=True)
+            email_data['attachments'].append(attachment)
+        return email_data
+    
+    def extract_single_part_stream_data(self, fetched):
+        """Данные письма из одной части (само письмо - вложение) по заголовку, без загрузки содержимого"""
+        msg = email.message_from_bytes(fetched.get('BODY[HEADER]') or b'')
+        email_date_str = msg.get("Date", "")
+        email_data = {
+            'date': email_date_str,
+            'date_obj': self.parse_email_date(email_date_str),
+            'subject': self.decode_header(msg.get("Subject", "Без темы")),
+            'sender': self.decode_header(msg.get("From", "")),
+            'body': "",
+            'message_key': message_catalog_key(msg),
+            'attachments': []
+        }
+        filename = msg.get_filename()
+        if filename:
+            decoded_filename = self.decode_header(filename)
+            file_ext = os.path.splitext(decoded_filename)[1].lower().replace('.', '')
+            if file_ext in self.supported_extensions:
+                email_data['attachments'].append({
+                    'filename': decoded_filename,
+                    'extension': file_ext,
+                    'uid': int(fetched['UID']),
+                    'section': 'TEXT',
+                    'encoding': msg.get('Content-Transfer-Encoding', '')
+                })
+        return email_data
+    
+    def fetch_section_chunks(self, uid, section):
+        """Загрузка секции письма частями BODY.PEEK[n]<смещение.длина> по основному соединению
+        (в конвейере основное соединение занято этапом загрузки - по отдельному соединению записи)"""
+        mail = self.stream_mail or self.mail
+        offset = 0
+        while True:
+            result, data = self.uid_fetch(mail, str(uid), f'(BODY.PEEK[{section}]<{offset}.{STREAM_CHUNK_BYTES}>)')
+            if result != 'OK':
+                raise imaplib.IMAP4.error(f"Ошибка загрузки UID {uid} секции {section} со смещения {offset}")
+            chunk = b''
+            for fetched in parse_imap_fetch_response(data):
+                for key, value in fetched.items():
+                    if key.startswith('BODY[') and isinstance(value, bytes):
+                        chunk = value
+            del data
+            if not chunk:
+                return
+            self.count_bytes(downloaded=len(chunk))
+            yield chunk
+            if len(chunk) < STREAM_CHUNK_BYTES:
+                return
+            offset += len(chunk)
+    
+    def stream_attachment_to_file(self, attachment, filepath):
+        """Потоковая запись вложения частями с декодированием. Возвращает размер и SHA-256 содержимого"""
+        decoder = StreamingDecoder(attachment['encoding'])
+        digest = hashlib.sha256()
+        size = 0
+        with open(filepath, 'wb') as f:
+            for chunk in self.fetch_section_chunks(attachment['uid'], attachment['section']):
+                data = decoder.decode(chunk)
+                f.write(data)
+                digest.update(data)
+                size += len(data)
+            data = decoder.flush()
+            f.write(data)
+            digest.update(data)
+            size += len(data)
+        return size, digest.hexdigest()
+    
+    def iter_emails(self, uids, mail=None, sizes=None):
+        """Загрузка писем выбранным способом: целиком пакетами или с предпросмотром структуры"""
+        if self.engine == 'async' and mail is None:
+            return self.fetch_emails_async(uids)
+        if self.connections > 1 and mail is None and len(uids) > self.batch_size:
+            return self.fetch_emails_parallel(uids)
+        if self.prescan:
+            return self.fetch_emails_prescan(uids, mail)
+        return self.fetch_emails_batched(uids, mail, sizes)
+    
+    def fetch_chunk_in_pool(self, chunk, sizes=None):
+        """Загрузка и разбор части UID в потоке пула на собственном соединении потока"""
+        mail = getattr(self.pool_local, 'mail', None)
+        if mail is None:
+            mail = self.open_connection()
+            mail.select(self.mailbox)
+            self.pool_local.mail = mail
+            with self.counters_lock:
+                self.pool_connections.append(mail)
+        return list(self.iter_emails(chunk, mail, sizes))
+    
+    def close_pool_connections(self):
+        """Закрытие соединений пула (параллельно, чтобы не ждать LOGOUT каждого по очереди)"""
+        def logout(mail):
+            try:
+                mail.logout()
+            except:
+                pass
+        if self.pool_connections:
+            with ThreadPoolExecutor(max_workers=len(self.pool_connections)) as executor:
+                list(executor.map(logout, self.pool_connections))
+        self.pool_connections = []
+    
+    def fetch_emails_parallel(self, uids):
+        """Загрузка через пул соединений; результаты отдаются строго в порядке UID"""
+        # Размеры писем запрашиваются один раз, части делятся по количеству и объему
+        sizes = None
+        if not self.prescan:
+            sizes = self.get_message_sizes(uids)
+            self.count_bytes(total=sum(sizes.values()))
+            chunks = self.split_into_batches(uids, sizes)
+        else:
+            chunks = self.split_into_batches(uids)
+        logging.info(f"🔀 Параллельная загрузка: {self.connections} соединений, {len(chunks)} частей")
+        
+        # Не больше двух частей на соединение в работе, чтобы не держать в памяти весь ящик
+        max_in_flight = self.connections * 2
+        pending = deque()
+        next_chunk = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                while next_chunk < len(chunks) or pending:
+                    while next_chunk < len(chunks) and len(pending) < max_in_flight:
+                        chunk = chunks[next_chunk]
+                        pending.append((chunk, executor.submit(self.fetch_chunk_in_pool, chunk, sizes)))
+                        next_chunk += 1
+                    
+                    # Единая упорядоченная запись: ждем самую раннюю часть
+                    chunk, future = pending.popleft()
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        # Соединение пула не удалось (например, лимит сессий) - догружаем через основное
+                        logging.warning(f"⚠️ Ошибка соединения пула ({e}), часть UID {chunk[0]}-{chunk[-1]} "
+                                        f"загружается через основное соединение")
+                        results = list(self.iter_emails(chunk, self.mail, sizes))
+                    yield from results
+        finally:
+            self.close_pool_connections()
+    
+    def parse_fetched_batch(self, batch, fetched_by_uid, plans=None):
+        """Разбор загруженного пакета в порядке UID: [(uid, данные письма или None)]"""
+        results = []
+        for uid in batch:
+            if plans is not None:
+                if uid not in plans:
+                    continue
+                if not plans[uid]['wanted']:
+                    results.append((uid, None))
+                    continue
+            fetched = fetched_by_uid.pop(uid, None)
+            if fetched is None:
+                continue
+            try:
+                if plans is not None:
+                    email_data = self.parse_or_defer(fetched, plans[uid])
+                elif isinstance(fetched.get('RFC822'), bytes):
+                    self.count_bytes(downloaded=len(fetched['RFC822']))
+                    email_data = self.parse_or_defer(fetched['RFC822'])
+                else:
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка обработки письма: {e}")
+                continue
+            results.append((uid, email_data))
+        return results
+    
+    async def open_async_connection(self):
+        """Новое авторизованное асинхронное соединение с выбранным ящиком"""
+        client = AsyncImapClient(self.imap_server, self.imap_port, self.use_ssl)
+        client.timings = self.timings
+        await client.connect()
+        await client.login(self.email_address, self.password)
+        await client.select(self.mailbox)
+        return client
+    
+    async def async_fetch_batch(self, client, batch, executor):
+        """Загрузка пакета на асинхронном соединении; разбор писем идет в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        if not self.prescan:
+            status, fetched = await client.uid_fetch(batch, '(RFC822)')
+            if status != 'OK':
+                logging.error(f"Ошибка загрузки пакета UID {batch[0]}-{batch[-1]}")
+                return []
+            return await loop.run_in_executor(executor, self.parse_fetched_batch, batch, fetched)
+        
+        # Предпросмотр: структура пакета, затем команды фазы 2 отправляются конвейером
+        status, fetched = await client.uid_fetch(batch, PRESCAN_FETCH_ITEMS)
+        if status != 'OK':
+            logging.error(f"Ошибка получения структуры писем UID {batch[0]}-{batch[-1]}")
+            return []
+        plans = {}
+        for uid, item in fetched.items():
+            if 'BODYSTRUCTURE' in item:
+                self.count_bytes(total=int(item.get('RFC822.SIZE') or 0))
+                plans[uid] = self.plan_from_prescan(item)
+        wanted = [uid for uid in batch if uid in plans and plans[uid]['wanted']]
+        logging.info(f"🔎 Предпросмотр структуры: письма с нужными вложениями {len(wanted)} из {len(batch)}")
+        
+        commands = self.prescan_commands(wanted, plans)
+        responses = await asyncio.gather(*(client.uid_fetch(command_uids, items)
+                                           for command_uids, items in commands))
+        fetched_parts = {}
+        for (command_uids, items), (status, fetched) in zip(commands, responses):
+            if status != 'OK':
+                logging.error(f"Ошибка загрузки частей писем UID {command_uids[0]}-{command_uids[-1]}")
+                continue
+            fetched_parts.update(fetched)
+        return await loop.run_in_executor(executor, self.parse_fetched_batch, batch, fetched_parts, plans)
+    
+    async def async_fetch_with_failover(self, clients, index, batch, executor):
+        """Загрузка пакета на своем соединении; при обрыве - на следующем живом"""
+        for offset in range(len(clients)):
+            client = clients[(index + offset) % len(clients)]
+            if client.error is not None:
+                continue
+            try:
+                return await self.async_fetch_batch(client, batch, executor)
+            except Exception as e:
+                if client.error is None:
+                    raise
+                logging.warning(f"⚠️ Обрыв асинхронного соединения ({e}), пакет UID {batch[0]}-{batch[-1]} "
+                                f"загружается через другое соединение")
+        raise ConnectionError("Нет доступных соединений")
+    
+    async def async_fetch(self, uids, results, stop):
+        """Конвейерная загрузка на нескольких асинхронных соединениях; результаты в очередь по порядку UID"""
+        loop = asyncio.get_running_loop()
+        # Соединения открываются одновременно; при отказе части из них работаем с оставшимися
+        opened = await asyncio.gather(*(self.open_async_connection() for _ in range(self.connections)),
+                                      return_exceptions=True)
+        clients = [client for client in opened if not isinstance(client, BaseException)]
+        errors = [error for error in opened if isinstance(error, BaseException)]
+        if not clients:
+            raise errors[0]
+        if errors:
+            logging.warning(f"⚠️ Не удалось открыть {len(errors)} соединений ({errors[0]}), используется {len(clients)}")
+        
+        executor = ThreadPoolExecutor(max_workers=len(clients))
+        try:
+            # Размеры писем запрашиваются одной командой (без предпросмотра - он сам получает размеры)
+            sizes = None
+            if not self.prescan:
+                status, fetched = await clients[0].uid_fetch(uids, '(RFC822.SIZE)')
+                sizes = {uid: int(item['RFC822.SIZE']) for uid, item in fetched.items() if 'RFC822.SIZE' in item}
+                self.count_bytes(total=sum(sizes.values()))
+            batches = self.split_into_batches(uids, sizes)
+            max_in_flight = len(clients) * ASYNC_PIPELINE_DEPTH
+            logging.info(f"⚡ Асинхронная загрузка: {len(clients)} соединений, {len(batches)} пакетов, "
+                         f"до {max_in_flight} команд в работе")
+            
+            pending = deque()
+            next_batch = 0
+            while (next_batch < len(batches) or pending) and not stop.is_set():
+                while next_batch < len(batches) and len(pending) < max_in_flight:
+                    batch = batches[next_batch]
+                    task = asyncio.create_task(self.async_fetch_with_failover(
+                        clients, next_batch % len(clients), batch, executor))
+                    pending.append((batch, task))
+                    next_batch += 1
+                
+                # Самый ранний пакет передается на запись, пока остальные загружаются
+                batch, task = pending.popleft()
+                try:
+                    batch_results = await task
+                except Exception as e:
+                    logging.error(f"Ошибка загрузки пакета UID {batch[0]}-{batch[-1]}: {e}")
+                    continue
+                for item in batch_results:
+                    if not await loop.run_in_executor(None, put_until_stopped, results, stop, item):
+                        break
+            
+            for batch, task in pending:
+                task.cancel()
+        finally:
+            await asyncio.gather(*(client.logout() for client in clients), return_exceptions=True)
+            executor.shutdown(wait=False)
+    
+    def fetch_emails_async(self, uids):
+        """Загрузка через asyncio в отдельном потоке; сохранение остается в основном потоке"""
+        if not uids:
             return
+        results = queue.Queue(maxsize=self.batch_size)
+        stop = threading.Event()
         
+        def run():
+            try:
+                asyncio.run(self.async_fetch(uids, results, stop))
+            except Exception as e:
+                logging.error(f"Ошибка асинхронной загрузки: {e}")
+            finally:
+                put_until_stopped(results, stop, None)
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
         try:
-            self.mail.select('INBOX')
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+    
+    def extract_email_data(self, raw_email):
+        """Разбор письма: дата, тема, отправитель, текст и поддерживаемые вложения"""
+        msg = email.message_from_bytes(raw_email)
+        
+        # Извлекаем информацию
+        email_date_str = msg.get("Date", "")
+        email_date = self.parse_email_date(email_date_str)
+        
+        email_data = {
+            'date': email_date_str,
+            'date_obj': email_date,
+            'subject': self.decode_header(msg.get("Subject", "Без темы")),
+            'sender': self.decode_header(msg.get("From", "")),
+            'body': self.get_email_body(msg),
+            'message_key': message_catalog_key(msg),
+            'attachments': []
+        }
+        
+        # Собираем вложения
+        for part in msg.walk():
+            if part.get_content_disposition() == 'attachment':
+                filename = part.get_filename()
+                if filename:
+                    decoded_filename = self.decode_header(filename)
+                    file_ext = os.path.splitext(decoded_filename)[1].lower().replace('.', '')
+                    
+                    if file_ext in self.supported_extensions:
+                        content = part.get_payload(decode=True)
+                        email_data['attachments'].append({
+                            'filename': decoded_filename,
+                            'content': content,
+                            'extension': file_ext
+                        })
+        
+        return email_data
+    
+    def save_email(self, email_data, journal_id=None):
+        """Сохранение письма с нужными вложениями в папку организации. Возвращает число сохраненных файлов.
+        journal_id - UID (или метка письма архива) для журнала запуска"""
+        if not email_data['attachments']:
+            # Письмо без нужных вложений тоже отмечаем в каталоге (с организацией отправителя, без папки),
+            # чтобы не загружать его снова
+            if self.catalog is not None and email_data.get('message_key'):
+                with self.timings.measure('org_match'):
+                    org_name_for_folder, _ = self.extract_organization_from_sender(email_data['sender'])
+                with self.timings.measure('metadata_write'):
+                    self.catalog.add_message(email_data['message_key'], org_name_for_folder, None, email_data, [])
+            return 0
+        
+        # Определяем организацию (имя для папки, имя для файла)
+        with self.timings.measure('org_match'):
+            org_name_for_folder, org_name_for_file = self.extract_organization_from_sender(email_data['sender'])
+        
+        # Получаем пути для сохранения
+        with self.timings.measure('folder'):
+            org_folder_path, date_folder_path, org_name_actual, date_folder_name = self.get_organization_folder(
+                org_name_for_folder, email_data['date_obj'] # Используем имя для папки
+            )
+        
+        # Начало записи - в журнал до первого файла, чтобы после сбоя откатить письмо целиком
+        if self.journal is not None and journal_id is not None:
+            self.journal.begin(journal_id, email_data.get('message_key'),
+                               os.path.relpath(date_folder_path, self.base_folder))
+        
+        # Сохраняем метаданные письма
+        with self.timings.measure('metadata_write'):
+            self.save_email_metadata(date_folder_path, email_data, org_name_for_folder)
+        
+        files_saved = 0
+        catalog_files = []
+        # Сохраняем файлы в папку с датой
+        for attachment in email_data['attachments']:
+            # Создаем новое имя файла: [имя_организации_из_списка]_[оригинальное_имя_без_расширения].[расширение]
+            original_name_no_ext, original_ext = os.path.splitext(attachment['filename'])
             
-            # Формируем дату для поиска
-            since_date = (datetime.now() - timedelta(days=days)).strftime("%d-%b-%Y")
+            # Используем имя организации из списка (org_name_for_file) для начала имени файла
+            new_filename = f"{org_name_for_file}_{original_name_no_ext}{original_ext}"
+
+            # Создаем безопасное имя файла
+            safe_filename = re.sub(r'[^\w\-.]', '_', new_filename)
+            safe_filename = safe_filename[:150] # Ограничиваем общую длину имени файла
+        
+            # Добавляем индекс если нужно
+            filepath = os.path.join(date_folder_path, safe_filename)
             
-            # Ищем все письма за период
-            result, data = self.mail.search(None, f'SINCE {since_date}')
-            if result != 'OK':
+            counter = 1
+            base_name, ext = os.path.splitext(filepath)
+            while os.path.exists(filepath) or os.path.exists(filepath + DEDUP_POINTER_SUFFIX):
+                filepath = f"{base_name}_{counter}{ext}"
+                counter += 1
+            
+            # Сохраняем файл (содержимое в памяти или потоково с сервера) во временный файл в папке даты,
+            # затем переименовываем на место или передаем в хранилище дедупликации
+            tmp_path = filepath + '.part'
+            if self.journal is not None and journal_id is not None:
+                self.journal.add_file(journal_id, os.path.relpath(filepath, self.base_folder))
+            with self.timings.measure('attachment_write'):
+                try:
+                    if 'content' in attachment:
+                        with open(tmp_path, 'wb') as f:
+                            f.write(attachment['content'])
+                        size, sha256 = len(attachment['content']), hashlib.sha256(attachment['content']).hexdigest()
+                    else:
+                        size, sha256 = self.stream_attachment_to_file(attachment, tmp_path)
+                    if self.attachment_store is not None:
+                        filepath = self.attachment_store.store(tmp_path, sha256, size, filepath)
+                    else:
+                        os.replace(tmp_path, filepath)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            catalog_files.append((attachment['filename'], os.path.relpath(filepath, self.base_folder), size, sha256))
+            
+            files_saved += 1
+            logging.info(f"  ✓ Сохранен: {org_name_actual}/{date_folder_name}/{os.path.basename(filepath)}")
+        
+        if self.catalog is not None and email_data.get('message_key'):
+            with self.timings.measure('metadata_write'):
+                self.catalog.add_message(email_data['message_key'], org_name_actual,
+                                         os.path.relpath(date_folder_path, self.base_folder), email_data, catalog_files)
+        
+        logging.info(f"  Письмо сохранено в: {org_name_actual}/{date_folder_name}")
+        return files_saved
+    
+    def get_uidvalidity(self):
+        """UIDVALIDITY выбранного ящика (из ответа SELECT или через STATUS)"""
+        _, data = self.mail.response('UIDVALIDITY')
+        if data and data[0]:
+            return int(data[0])
+        result, data = self.mail.status(self.mailbox, '(UIDVALIDITY)')
+        if result == 'OK' and data and data[0]:
+            match = re.search(rb'UIDVALIDITY (\d+)', data[0])
+            if match:
+                return int(match.group(1))
+        return None
+    
+    def search_new_uids(self, days, full_resync=False):
+        """Поиск UID для загрузки: только новые письма, если UIDVALIDITY не менялся"""
+        since_date = (datetime.now() - timedelta(days=days)).strftime("%d-%b-%Y")
+        sync_key = f"{self.imap_server}/{self.email_address}/{self.mailbox}"
+        uidvalidity = self.get_uidvalidity()
+        
+        state = self.sync_state.get(sync_key)
+        last_uid = 0
+        if full_resync:
+            logging.info("🔄 Полная синхронизация по запросу (--full-resync)")
+        elif state and uidvalidity is not None and state.get('uidvalidity') == uidvalidity:
+            last_uid = state.get('last_uid', 0)
+            logging.info(f"🔄 Инкрементальная синхронизация: письма с UID > {last_uid}")
+        elif state:
+            logging.warning(f"⚠️ UIDVALIDITY изменился ({state.get('uidvalidity')} -> {uidvalidity}), "
+                            f"выполняется полная синхронизация")
+        
+        criteria = f'SINCE {since_date}'
+        if last_uid:
+            criteria += f' UID {last_uid + 1}:*'
+        result, data = self.mail.uid('SEARCH', None, criteria)
+        if result != 'OK':
+            return None, sync_key, uidvalidity, last_uid
+        
+        # Диапазон N:* всегда включает последнее письмо ящика, даже если его UID меньше N
+        uids = sorted(uid for uid in (int(x) for x in data[0].split()) if uid > last_uid)
+        return uids, sync_key, uidvalidity, last_uid
+    
+    def prematch_senders(self, uids):
+        """Загрузка только заголовков и сопоставление отправителя со списком организаций"""
+        matched = set()
+        for batch in self.split_into_batches(uids):
+            try:
+                result, data = self.uid_fetch(self.mail, format_message_set(batch),
+                                              '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)])')
+                if result != 'OK':
+                    logging.error(f"Ошибка загрузки заголовков UID {batch[0]}-{batch[-1]}")
+                    matched.update(batch)
+                    continue
+                answered = set()
+                for fetched in parse_imap_fetch_response(data):
+                    if 'UID' not in fetched:
+                        continue
+                    uid = int(fetched['UID'])
+                    answered.add(uid)
+                    header_bytes = b''
+                    for key, value in fetched.items():
+                        if key.startswith('BODY[HEADER.FIELDS') and isinstance(value, bytes):
+                            header_bytes = value
+                    headers = email.message_from_bytes(header_bytes)
+                    if self.find_organization_name(self.decode_header(headers.get("From", ""))):
+                        matched.add(uid)
+                # Письма без ответа на заголовки не отбрасываем
+                matched.update(uid for uid in batch if uid not in answered)
+            except Exception as e:
+                logging.error(f"Ошибка загрузки заголовков UID {batch[0]}-{batch[-1]}: {e}")
+                matched.update(batch)
+        return matched
+    
+    def fetch_message_keys(self, uids):
+        """Ключи каталога писем по заголовкам Message-ID, Date, From и Subject (без загрузки писем)"""
+        keys = {}
+        for batch in self.split_into_batches(uids):
+            try:
+                result, data = self.uid_fetch(self.mail, format_message_set(batch),
+                                              '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM SUBJECT)])')
+                if result != 'OK':
+                    logging.error(f"Ошибка загрузки заголовков UID {batch[0]}-{batch[-1]}")
+                    continue
+                for fetched in parse_imap_fetch_response(data):
+                    if 'UID' not in fetched:
+                        continue
+                    for key, value in fetched.items():
+                        if key.startswith('BODY[HEADER.FIELDS') and isinstance(value, bytes):
+                            keys[int(fetched['UID'])] = message_catalog_key(email.message_from_bytes(value))
+            except Exception as e:
+                logging.error(f"Ошибка загрузки заголовков UID {batch[0]}-{batch[-1]}: {e}")
+        return keys
+    
+    def flush_checkpoint(self):
+        """Сброс метаданных и каталога, затем запись завершенных писем в журнал"""
+        self.metadata_writer.flush()
+        if self.catalog is not None:
+            self.catalog.commit()
+        if self.journal is not None:
+            self.journal.sync()
+    
+    def mark_done(self, uid, done_uids):
+        """Письмо обработано: учет для отметки UID и запись в журнал запуска"""
+        done_uids.add(uid)
+        self.deferred_uids.discard(uid)
+        self.failed_uids.pop(uid, None)
+        if self.journal is not None:
+            self.journal.done(uid)
+    
+    def mark_failed(self, uid, done_uids):
+        """Неудачная попытка загрузить или сохранить письмо; после FAILED_RETRY_LIMIT попыток отметка UID его проходит"""
+        attempts = self.failed_uids.get(uid, 0) + 1
+        if attempts < FAILED_RETRY_LIMIT:
+            self.failed_uids[uid] = attempts
+            logging.warning(f"⚠️ Письмо UID {uid} не обработано (попытка {attempts} из {FAILED_RETRY_LIMIT}), "
+                            f"повтор при следующем запуске")
+            return
+        self.failed_uids.pop(uid, None)
+        self.deferred_uids.discard(uid)
+        done_uids.add(uid)
+        logging.error(f"❌ Письмо UID {uid} окончательно не обработано после {attempts} попыток, пропускается")
+    
+    def resume_from_journal(self, run_key, uidvalidity):
+        """Журнал прерванного запуска: откат недописанных писем и завершенные письма того же ящика.
+        Начинает журнал нового запуска; возвращает множество уже обработанных писем"""
+        if not self.journal_file:
+            return set()
+        self.journal = CheckpointJournal(self.journal_file)
+        header, done, unfinished = self.journal.load()
+        if unfinished:
+            logging.warning(f"↩️ Прошлый запуск прерван: откат недописанных писем ({len(unfinished)})")
+            self.rollback_unfinished(unfinished)
+        if not header or header.get('key') != run_key or header.get('uidvalidity') != uidvalidity:
+            done = set()
+        elif done:
+            logging.info(f"▶️ Продолжение прерванного запуска: уже обработано писем {len(done)}")
+        # Новый журнал заменяет старый только после отката - сбой во время отката его повторит
+        self.journal.start(run_key, uidvalidity, sorted(done, key=str))
+        return done
+    
+    def rollback_unfinished(self, unfinished):
+        """Откат писем, запись которых прервал сбой: файлы, метаданные, строка CSV и запись каталога"""
+        for entry in unfinished.values():
+            for path in entry['files']:
+                filepath = os.path.join(self.base_folder, path)
+                for candidate in (filepath, filepath + '.part', filepath + DEDUP_POINTER_SUFFIX):
+                    if os.path.isfile(candidate):
+                        os.remove(candidate)
+            if entry.get('folder'):
+                date_folder_path = os.path.join(self.base_folder, entry['folder'])
+                metadata_file = os.path.join(date_folder_path, "информация_о_письме.txt")
+                if os.path.isfile(metadata_file):
+                    os.remove(metadata_file)
+                self.remove_csv_rows(os.path.join(os.path.dirname(date_folder_path), "все_письма.csv"),
+                                     os.path.basename(date_folder_path))
+                # Папку письма удаляем, только если в ней ничего не осталось
+                try:
+                    os.rmdir(date_folder_path)
+                except OSError:
+                    pass
+            if self.catalog is not None and entry.get('message_key'):
+                self.catalog.remove_message(entry['message_key'])
+            logging.info(f"  ↩️ Откат: {entry.get('folder')} (файлов: {len(entry['files'])})")
+        if self.catalog is not None:
+            self.catalog.commit()
+        # Имена удаленных папок снова свободны
+        self.build_folder_index()
+    
+    def remove_csv_rows(self, csv_file, date_folder_name):
+        """Удаление из все_письма.csv организации строк письма с папкой date_folder_name (атомарная перезапись)"""
+        if not os.path.isfile(csv_file):
+            return
+        with open(csv_file, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames
+            rows = list(reader)
+        kept = [row for row in rows if row.get('Дата_папки') != date_folder_name]
+        if len(kept) == len(rows) or not fieldnames:
+            return
+        tmp_path = csv_file + '.tmp'
+        with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(kept)
+        os.replace(tmp_path, csv_file)
+    
+    def advance_sync_state(self, sync_key, uidvalidity, last_uid, uids, done_uids):
+        """Сдвиг отметки до последнего UID, перед которым все письма обработаны"""
+        high_water = last_uid
+        for uid in uids:
+            if uid not in done_uids:
+                break
+            high_water = uid
+        # Метаданные и каталог отмеченных писем должны быть на диске раньше самой отметки
+        self.flush_checkpoint()
+        if uidvalidity is not None:
+            self.sync_state.update(sync_key, uidvalidity, high_water, self.deferred_uids, self.failed_uids)
+            try:
+                self.sync_state.save()
+            except Exception as e:
+                logging.error(f"Ошибка сохранения состояния синхронизации: {e}")
+        return high_water
+    
+    def run_pipeline(self, uids, done_uids, checkpoint):
+        """Конвейер загрузка -> разбор -> запись на ограниченных очередях.
+        Возвращает (писем с сохраненными файлами, сохранено файлов)"""
+        stop = threading.Event()
+        parse_queue = queue.Queue(maxsize=self.queue_size)
+        route_queue = queue.Queue(maxsize=self.queue_size)
+        completed = queue.Queue()
+        errors = []
+        
+        write_workers = self.write_workers
+        if self.streaming:
+            # Потоковые вложения читаются с сервера при записи - одним потоком по отдельному соединению
+            write_workers = 1
+            self.stream_mail = self.open_connection()
+            self.stream_mail.select(self.mailbox)
+        write_queues = [queue.Queue(maxsize=self.queue_size) for _ in range(write_workers)]
+        logging.info(f"🏭 Конвейер: загрузка {self.connections} соед., разбор {self.parse_workers} проц., "
+                     f"запись {write_workers} пот., очереди по {self.queue_size} писем")
+        
+        executor = None
+        if self.parse_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.parse_workers, initializer=init_parse_worker,
+                                           initargs=(self,))
+            # Процессы (fork на Linux) создаются при первой задаче - до запуска потоков конвейера
+            executor.submit(int).result()
+        
+        def fetch_stage():
+            try:
+                for item in self.iter_emails(uids):
+                    if not put_until_stopped(parse_queue, stop, item):
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put_until_stopped(parse_queue, stop, None)
+        
+        def parse_stage():
+            # Задачи уходят пачками в пул процессов, результаты отдаются в порядке загрузки
+            pending = deque()
+            finished = False
+            try:
+                while not finished or pending:
+                    if not finished and len(pending) < self.parse_workers * 2:
+                        jobs = []
+                        while len(jobs) < PIPELINE_PARSE_BATCH:
+                            try:
+                                # Ждем загрузку, только если разбирать больше нечего
+                                if pending or jobs:
+                                    item = parse_queue.get_nowait()
+                                else:
+                                    item = parse_queue.get(timeout=0.5)
+                            except queue.Empty:
+                                if stop.is_set():
+                                    return
+                                if pending or jobs:
+                                    break
+                                continue
+                            if item is None:
+                                finished = True
+                                break
+                            jobs.append(item)
+                        if jobs:
+                            if executor is not None:
+                                pending.append(executor.submit(parse_pipeline_batch, jobs))
+                            else:
+                                pending.append(self.parse_jobs(jobs))
+                            continue
+                    if pending:
+                        results = pending.popleft()
+                        if executor is not None:
+                            results, samples = results.result()
+                            self.timings.merge(samples)
+                        for parsed in results:
+                            if not put_until_stopped(route_queue, stop, parsed):
+                                return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put_until_stopped(route_queue, stop, None)
+        
+        def write_stage(write_queue):
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                uid, email_data = item
+                try:
+                    completed.put((uid, self.save_email(email_data, uid), True))
+                except Exception as e:
+                    logging.error(f"Ошибка обработки письма: {e}")
+                    completed.put((uid, 0, False))
+        
+        processed_count = 0
+        files_saved = 0
+        finished_count = 0
+        
+        def collect(block=False):
+            # Учет записанных писем и периодическая отметка - только в этом потоке
+            nonlocal processed_count, files_saved, finished_count
+            while True:
+                try:
+                    uid, saved, ok = completed.get(block=block)
+                except queue.Empty:
+                    return
+                block = False
+                if not ok:
+                    continue
+                if saved:
+                    files_saved += saved
+                    processed_count += 1
+                self.mark_done(uid, done_uids)
+                finished_count += 1
+                # Периодически сохраняем отметку, чтобы после сбоя не начинать сначала
+                if finished_count % 50 == 0:
+                    checkpoint()
+        
+        threads = [threading.Thread(target=fetch_stage, daemon=True),
+                   threading.Thread(target=parse_stage, daemon=True)]
+        writers = [threading.Thread(target=write_stage, args=(write_queue,), daemon=True)
+                   for write_queue in write_queues]
+        self.defer_parse = True
+        try:
+            for thread in threads + writers:
+                thread.start()
+            
+            routed = 0
+            while True:
+                item = route_queue.get()
+                if item is None:
+                    break
+                uid, email_data = item
+                routed += 1
+                logging.info(f"[{routed}/{len(uids)}] Обработка письма...")
+                if email_data is None:
+                    self.mark_done(uid, done_uids)
+                    continue
+                
+                # Письма одной папки организации пишет один поток и строго по порядку - папки и имена файлов
+                # получаются теми же, что и при последовательной обработке. Папку организации определяем
+                # (и при необходимости создаем) здесь, в порядке писем: разные названия одной организации
+                # могут вести к одной папке, и ее имя не должно зависеть от того, какой поток успел первым
+                shard = 0
+                if write_workers > 1 and email_data['attachments']:
+                    org_name_for_folder = self.extract_organization_from_sender(email_data['sender'])[0]
+                    org_folder_path = self.resolve_organization_folder(org_name_for_folder)
+                    shard = hash(os.path.normcase(org_folder_path)) % write_workers
+                write_queues[shard].put((uid, email_data))
+                collect()
+            
+            for write_queue in write_queues:
+                write_queue.put(None)
+            for writer in writers:
+                writer.join()
+            collect()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            return processed_count, files_saved
+        finally:
+            self.defer_parse = False
+            stop.set()
+            for write_queue in write_queues:
+                try:
+                    write_queue.put_nowait(None)
+                except queue.Full:
+                    pass
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            if self.stream_mail is not None:
+                try:
+                    self.stream_mail.logout()
+                except:
+                    pass
+                self.stream_mail = None
+    
+    def reset_run_counters(self):
+        """Счетчики одного запуска: в режиме службы обработка повторяется, итоги не должны накапливаться"""
+        self.bytes_total = 0
+        self.bytes_downloaded = 0
+        if self.attachment_store is not None:
+            self.attachment_store.reset_stats()
+    
+    def process_emails(self, days=7, full_resync=False, process_deferred=False, report=True):
+        """Основная обработка писем. Возвращает False, если обработка не удалась (нет соединения, ошибка).
+        report=False - без полного отчета (режим службы строит его не после каждого письма)"""
+        self.timings = StageTimings()
+        self.reset_run_counters()
+        if not self.connect():
+            return False
+        
+        try:
+            self.mail.select(self.mailbox)
+            self.sync_state = SyncState(self.sync_state_file)
+            if self.catalog_file:
+                self.catalog = MessageCatalog(self.catalog_file)
+                logging.info(f"🗂️ Каталог обработанных писем: {self.catalog_file} ({len(self.catalog)} писем)")
+            
+            # Ищем письма за период (по UID, чтобы загружать их диапазонами и помнить, что уже обработано)
+            email_uids, sync_key, uidvalidity, last_uid = self.search_new_uids(days, full_resync)
+            if email_uids is None:
                 logging.error("Ошибка поиска писем")
-                return
+                return False
             
-            email_ids = data[0].split()
-            logging.info(f"Найдено писем за {days} дней: {len(email_ids)}")
+            logging.info(f"Найдено новых писем за {days} дней: {len(email_uids)}")
             
             processed_count = 0
             files_saved = 0
+            done_uids = set()
             
-            for i, email_id in enumerate(email_ids, 1):
-                try:
-                    logging.info(f"[{i}/{len(email_ids)}] Обработка письма...")
-                    
-                    # Получаем письмо
-                    result, data = self.mail.fetch(email_id, '(RFC822)')
-                    if result != 'OK':
-                        continue
-                    
-                    # Парсим письмо
-                    raw_email = data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    # Извлекаем информацию
-                    email_date_str = msg.get("Date", "")
-                    email_date = self.parse_email_date(email_date_str)
-                    
-                    email_data = {
-                        'date': email_date_str,
-                        'date_obj': email_date,
-                        'subject': self.decode_header(msg.get("Subject", "Без темы")),
-                        'sender': self.decode_header(msg.get("From", "")),
-                        'body': self.get_email_body(msg),
-                        'attachments': []
-                    }
-                    
-                    # Собираем вложения
-                    for part in msg.walk():
-                        if part.get_content_disposition() == 'attachment':
-                            filename = part.get_filename()
-                            if filename:
-                                decoded_filename = self.decode_header(filename)
-                                file_ext = os.path.splitext(decoded_filename)[1].lower().replace('.', '')
-                                
-                                if file_ext in self.supported_extensions:
-                                    content = part.get_payload(decode=True)
-                                    email_data['attachments'].append({
-                                        'filename': decoded_filename,
-                                        'content': content,
-                                        'extension': file_ext
-                                    })
-                    
-                    # Если есть нужные вложения, обрабатываем
-                    if email_data['attachments']:
-                        # Определяем организацию (имя для папки, имя для файла)
-                        org_name_for_folder, org_name_for_file = self.extract_organization_from_sender(email_data['sender'])
-                        
-                        # Получаем пути для сохранения
-                        org_folder_path, date_folder_path, org_name_actual, date_folder_name = self.get_organization_folder(
-                            org_name_for_folder, email_date # Используем имя для папки
-                        )
+            # Отложенные письма прошлых запусков (действительны только при том же UIDVALIDITY)
+            state = self.sync_state.get(sync_key)
+            self.failed_uids = {}
+            if state and not full_resync and state.get('uidvalidity') == uidvalidity:
+                self.deferred_uids = set(state.get('deferred', []))
+                self.failed_uids = {int(uid): attempts for uid, attempts in state.get('failed', {}).items()}
+            
+            # Письма, обработанные до сбоя прошлого запуска (по журналу), повторно не загружаем
+            resumed = self.resume_from_journal(sync_key, uidvalidity)
+            if resumed:
+                done_uids.update(uid for uid in email_uids if uid in resumed)
+                self.deferred_uids.difference_update(resumed)
+            
+            uids_to_fetch = [uid for uid in email_uids if uid not in resumed]
+            if self.sender_prematch and not self.organizations_mapping:
+                logging.warning("⚠️ Список организаций пуст, предварительное сопоставление отправителей отключено")
+            elif self.sender_prematch and uids_to_fetch:
+                candidates = uids_to_fetch
+                matched = self.prematch_senders(candidates)
+                unmatched = [uid for uid in candidates if uid not in matched]
+                logging.info(f"📨 Отправитель найден в списке организаций: {len(matched)} из {len(candidates)} писем")
+                if self.sender_prematch == 'skip':
+                    uids_to_fetch = [uid for uid in candidates if uid in matched]
+                    done_uids.update(unmatched)
+                    logging.info(f"   Пропущено писем неизвестных отправителей: {len(unmatched)}")
+                elif self.sender_prematch == 'defer':
+                    uids_to_fetch = [uid for uid in candidates if uid in matched]
+                    done_uids.update(unmatched)
+                    self.deferred_uids.update(unmatched)
+                    logging.info(f"   Отложено писем неизвестных отправителей: {len(unmatched)} "
+                                 f"(загрузка при запуске с --process-deferred)")
+            
+            if process_deferred and self.deferred_uids:
+                logging.info(f"⏳ Загрузка отложенных писем: {len(self.deferred_uids)}")
+                uids_to_fetch = sorted(self.deferred_uids | set(uids_to_fetch))
+            
+            # Письма, уже записанные в каталог (например, при --full-resync), повторно не загружаем.
+            # Выше сохраненной отметки UID только новые письма ящика - заголовки для каталога
+            # запрашиваются лишь без отметки (первый запуск, --full-resync, смена UIDVALIDITY)
+            if self.catalog is not None and len(self.catalog) and uids_to_fetch and not last_uid:
+                message_keys = self.fetch_message_keys(uids_to_fetch)
+                known = [uid for uid in uids_to_fetch if message_keys.get(uid) in self.catalog]
+                if known:
+                    known_set = set(known)
+                    done_uids.update(known_set)
+                    self.deferred_uids.difference_update(known_set)
+                    uids_to_fetch = [uid for uid in uids_to_fetch if uid not in known_set]
+                    logging.info(f"🗂️ Пропущено писем из каталога (уже обработаны): {len(known)}")
+            
+            if self.pipeline:
+                processed_count, files_saved = self.run_pipeline(
+                    uids_to_fetch, done_uids,
+                    lambda: self.advance_sync_state(sync_key, uidvalidity, last_uid, email_uids, done_uids))
+            else:
+                for i, (uid, email_data) in enumerate(self.iter_emails(uids_to_fetch), 1):
+                    try:
+                        logging.info(f"[{i}/{len(uids_to_fetch)}] Обработка письма...")
                         
-                        # Сохраняем метаданные письма
-                        self.save_email_metadata(date_folder_path, email_data, org_name_for_folder)
+                        # Письмо без нужных вложений (определено по структуре без загрузки)
+                        if email_data is None:
+                            self.mark_done(uid, done_uids)
+                            continue
                         
-                        # Сохраняем файлы в папку с датой
-                        for attachment in email_data['attachments']:
-                            # Создаем новое имя файла: [имя_организации_из_списка]_[оригинальное_имя_без_расширения].[расширение]
-                            original_name_no_ext, original_ext = os.path.splitext(attachment['filename'])
-                            
-                            # Используем имя организации из списка (org_name_for_file) для начала имени файла
-                            new_filename = f"{org_name_for_file}_{original_name_no_ext}{original_ext}"
-
-                            # Создаем безопасное имя файла
-                            safe_filename = re.sub(r'[^\w\-.]', '_', new_filename)
-                            safe_filename = safe_filename[:150] # Ограничиваем общую длину имени файла
+                        # Если есть нужные вложения, обрабатываем
+                        saved = self.save_email(email_data, uid)
+                        if saved:
+                            files_saved += saved
+                            processed_count += 1
+                        self.mark_done(uid, done_uids)
                         
-                            # Добавляем индекс если нужно
-                            filepath = os.path.join(date_folder_path, safe_filename)
-                            
-                            counter = 1
-                            base_name, ext = os.path.splitext(filepath)
-                            while os.path.exists(filepath):
-                                filepath = f"{base_name}_{counter}{ext}"
-                                counter += 1
-                            
-                            # Сохраняем файл
-                            with open(filepath, 'wb') as f:
-                                f.write(attachment['content'])
-                            
-                            files_saved += 1
-                            logging.info(f"  ✓ Сохранен: {org_name_actual}/{date_folder_name}/{os.path.basename(filepath)}")
+                        # Периодически сохраняем отметку, чтобы после сбоя не начинать сначала
+                        if len(done_uids) % 50 == 0:
+                            self.advance_sync_state(sync_key, uidvalidity, last_uid, email_uids, done_uids)
                         
-                        processed_count += 1
-                        logging.info(f"  Письмо сохранено в: {org_name_actual}/{date_folder_name}")
-                    
-                except Exception as e:
-                    logging.error(f"Ошибка обработки письма: {e}")
-                    continue
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки письма: {e}")
+                        continue
+            
+            # Письма, которые не сохранились или не пришли с сервера (ошибка загрузки части UID), -
+            # неудачная попытка; после предела попыток они больше не держат отметку
+            for uid in uids_to_fetch:
+                if uid not in done_uids:
+                    self.mark_failed(uid, done_uids)
+            
+            high_water = self.advance_sync_state(sync_key, uidvalidity, last_uid, email_uids, done_uids)
+            if self.journal is not None:
+                # Следующему запуску нужны только обработанные письма после первого пропущенного
+                self.journal.finish(sorted(uid for uid in done_uids if uid > high_water))
+            if email_uids:
+                logging.info(f"Последний обработанный UID: {high_water}")
+                logging.info(f"📦 Загружено {self.bytes_downloaded / 1048576:.1f} МБ "
+                             f"из {self.bytes_total / 1048576:.1f} МБ писем")
+            
+            # Закрываем файлы метаданных до отчета, чтобы все записи были на диске
+            self.metadata_writer.close()
             
             # Генерируем отчет
-            self.generate_report(processed_count, files_saved)
+            if report:
+                self.generate_report(processed_count, files_saved)
+            return True
             
         except Exception as e:
             logging.error(f"Ошибка при обработке писем: {e}")
+            return False
         finally:
+            self.metadata_writer.close()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
             self.disconnect()
     
+    def iter_local_emails(self, sources, workers=None):
+        """Разбор писем архива в пуле процессов; результаты отдаются строго в порядке архива"""
+        workers = max(1, workers or os.cpu_count() or 1)
+        batches = [sources[i:i + LOCAL_PARSE_BATCH] for i in range(0, len(sources), LOCAL_PARSE_BATCH)]
+        logging.info(f"🔀 Разбор в {workers} процессах: {len(batches)} частей по {LOCAL_PARSE_BATCH} писем")
+        
+        # Не больше двух частей на процесс в работе, чтобы не держать в памяти весь архив
+        max_in_flight = workers * 2
+        pending = deque()
+        next_batch = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_parse_worker, initargs=(self,)) as executor:
+            while next_batch < len(batches) or pending:
+                while next_batch < len(batches) and len(pending) < max_in_flight:
+                    batch = batches[next_batch]
+                    pending.append((batch, executor.submit(parse_local_batch, batch)))
+                    next_batch += 1
+                
+                # Единая упорядоченная запись: ждем самую раннюю часть
+                batch, future = pending.popleft()
+                try:
+                    results, samples = future.result()
+                    self.timings.merge(samples)
+                except Exception as e:
+                    logging.error(f"Ошибка процесса разбора ({e}), пропущены письма {batch[0][0]} - {batch[-1][0]}")
+                    results = [(label, None) for label, _, _, _ in batch]
+                yield from results
+    
+    def process_local_archive(self, source_path, workers=None):
+        """Обработка локального архива (mbox, Maildir, папка .eml) без IMAP. Возвращает False при ошибке"""
+        if not os.path.exists(source_path):
+            logging.error(f"❌ Архив не найден: {source_path}")
+            return False
+        
+        self.timings = StageTimings()
+        self.reset_run_counters()
+        try:
+            sources = list(iter_local_messages(source_path))
+            logging.info(f"📂 Найдено писем в архиве {source_path}: {len(sources)}")
+            if self.catalog_file:
+                self.catalog = MessageCatalog(self.catalog_file)
+                logging.info(f"🗂️ Каталог обработанных писем: {self.catalog_file} ({len(self.catalog)} писем)")
+            
+            # Письма архива, обработанные до сбоя прошлого запуска, повторно не разбираем
+            resumed = self.resume_from_journal(f"local:{os.path.abspath(source_path)}", None)
+            if resumed:
+                sources = [source for source in sources if source[0] not in resumed]
+            
+            processed_count = 0
+            files_saved = 0
+            skipped = 0
+            for i, (label, email_data) in enumerate(self.iter_local_emails(sources, workers), 1):
+                try:
+                    logging.info(f"[{i}/{len(sources)}] Обработка письма {label}...")
+                    
+                    # Письма, уже записанные в каталог, повторно не сохраняем
+                    if email_data is not None and self.catalog is not None and \
+                            email_data.get('message_key') in self.catalog:
+                        skipped += 1
+                    elif email_data is not None:
+                        saved = self.save_email(email_data, label)
+                        if saved:
+                            files_saved += saved
+                            processed_count += 1
+                    if self.journal is not None:
+                        self.journal.done(label)
+                        if i % 50 == 0:
+                            self.flush_checkpoint()
+                except Exception as e:
+                    logging.error(f"Ошибка обработки письма {label}: {e}")
+                    continue
+            
+            if skipped:
+                logging.info(f"🗂️ Пропущено писем из каталога (уже обработаны): {skipped}")
+            
+            # Закрываем файлы метаданных до отчета, чтобы все записи были на диске
+            self.metadata_writer.close()
+            if self.journal is not None:
+                self.flush_checkpoint()
+                self.journal.finish()
+            self.generate_report(processed_count, files_saved)
+            return True
+        
+        except Exception as e:
+            logging.error(f"Ошибка при обработке архива: {e}")
+            return False
+        finally:
+            self.metadata_writer.close()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
+    
+    def run_daemon(self, days=7, idle_timeout=IDLE_TIMEOUT_SECONDS):
+        """Режим службы: обработка новых писем сразу после их поступления (IMAP IDLE)"""
+        asyncio.run(self.daemon_loop(days, idle_timeout))
+    
+    async def daemon_loop(self, days, idle_timeout):
+        """Цикл службы: догоняющая обработка, ожидание IDLE, повторное подключение с нарастающей паузой"""
+        loop = asyncio.get_running_loop()
+        backoff = DAEMON_BACKOFF_MIN_SECONDS
+        last_report = None
+        
+        def process_new_emails():
+            # Полный отчет - при первом проходе и затем не чаще DAEMON_REPORT_INTERVAL_SECONDS
+            nonlocal last_report
+            now = time.monotonic()
+            report = last_report is None or now - last_report >= DAEMON_REPORT_INTERVAL_SECONDS
+            if not self.process_emails(days, report=report):
+                raise ConnectionError("обработка писем не удалась")
+            if report:
+                last_report = now
+        
+        while True:
+            client = None
+            try:
+                # Обработка идет в потоке; новые письма выбираются по сохраненной отметке UID
+                await loop.run_in_executor(None, process_new_emails)
+                client = await self.open_async_connection()
+                backoff = DAEMON_BACKOFF_MIN_SECONDS
+                while True:
+                    logging.info(f"👂 Ожидание новых писем в {self.mailbox} (IDLE)...")
+                    if await client.idle(idle_timeout):
+                        logging.info("📬 Поступили новые письма")
+                        await loop.run_in_executor(None, process_new_emails)
+            except Exception as e:
+                logging.error(f"❌ Ошибка в режиме службы: {e}. Повторное подключение через {backoff} с")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, DAEMON_BACKOFF_MAX_SECONDS)
+            finally:
+                if client is not None:
+                    await client.logout()
+    
     def generate_report(self, processed_emails, saved_files):
         """Генерация отчета"""
         report_file = os.path.join(self.base_folder, "отчет_обработки.txt")
@@ -593,7 +3230,7 @@ class EmailOrganizationProcessor:
         org_stats = {}
         for item in os.listdir(self.base_folder):
             item_path = os.path.join(self.base_folder, item)
-            if os.path.isdir(item_path) and item != "отчет_обработки.txt":
+            if os.path.isdir(item_path) and item != "отчет_обработки.txt" and not item.startswith('.'):
                 # Подсчитываем папки с письмами
                 email_folders = [d for d in os.listdir(item_path) 
                                if os.path.isdir(os.path.join(item_path, d))]
@@ -625,7 +3262,18 @@ class EmailOrganizationProcessor:
             f.write(f"Количество загруженных соответствий: {len(self.organizations_mapping)}\n")
             f.write(f"Обработано писем: {processed_emails}\n")
             f.write(f"Сохранено файлов: {saved_files}\n")
-            f.write(f"Организаций: {len(org_stats)}\n\n")
+            f.write(f"Организаций: {len(org_stats)}\n")
+            f.write(f"Кэш заголовков: {self.cache_stats_line(self.decode_header_cached)}\n")
+            f.write(f"Кэш названий организаций: {self.cache_stats_line(self.clean_organization_name_cached)}\n")
+            if self.attachment_store is not None:
+                f.write(f"Дедупликация вложений: {self.attachment_store.stats_line()}\n")
+            f.write("\n")
+            
+            f.write(f"ВРЕМЯ ПО ЭТАПАМ (всего {self.timings.elapsed():.1f} с):\n")
+            f.write("=" * 80 + "\n")
+            for line in self.timings.report_lines():
+                f.write(line + "\n")
+            f.write("\n")
             
             f.write("СТАТИСТИКА ПО ОРГАНИЗАЦИЯМ:\n")
             f.write("=" * 80 + "\n")
@@ -671,6 +3319,35 @@ class EmailOrganizationProcessor:
             f.write("=" * 80 + "\n")
         
         logging.info(f"Отчет сохранен: {report_file}")
+        self.save_timing_metrics(processed_emails, saved_files)
+    
+    def save_timing_metrics(self, processed_emails, saved_files):
+        """Метрики времени этапов в JSON и, если задано, в файл Prometheus"""
+        run_info = {
+            'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'processed_emails': processed_emails,
+            'saved_files': saved_files,
+        }
+        try:
+            metrics_file = os.path.join(self.base_folder, "метрики_обработки.json")
+            self.timings.write_json(metrics_file, run_info)
+            logging.info(f"⏱️ Метрики этапов сохранены: {metrics_file}")
+            if self.prometheus_file:
+                self.timings.write_prometheus(self.prometheus_file, run_info)
+                logging.info(f"⏱️ Метрики Prometheus сохранены: {self.prometheus_file}")
+        except Exception as e:
+            logging.error(f"Ошибка сохранения метрик: {e}")
+
+
+def load_credentials(credentials_file=None):
+    """Учетные данные из файла (адрес и пароль в первых двух строках) или из переменных окружения"""
+    if credentials_file:
+        with open(credentials_file, 'r', encoding='utf-8') as f:
+            lines = [line.strip() for line in f if line.strip()]
+        if len(lines) < 2:
+            raise ValueError(f"В файле {credentials_file} должны быть адрес и пароль (две строки)")
+        return lines[0], lines[1]
+    return os.environ.get(CREDENTIALS_ENV_ADDRESS), os.environ.get(CREDENTIALS_ENV_PASSWORD)
 
 
 def main():
@@ -681,43 +3358,169 @@ def main():
                        help='Количество дней для обработки (по умолчанию: 7)')
     parser.add_argument('--server', type=str, default='imap.mail.ru',
                        help='IMAP сервер (по умолчанию: imap.mail.ru)')
+    parser.add_argument('--port', type=int, default=993,
+                       help='Порт IMAP сервера (по умолчанию: 993)')
+    parser.add_argument('--no-ssl', action='store_true',
+                       help='Подключаться без SSL (локальный или тестовый сервер)')
     parser.add_argument('--org-file', type=str, default='Список организаций.txt',
                        help='Файл со списком организаций (по умолчанию: Список организаций.txt)')
+    parser.add_argument('--batch-size', type=int, default=200,
+                       help='Количество писем в одном запросе UID FETCH (по умолчанию: 200)')
+    parser.add_argument('--prescan', action='store_true',
+                       help='Сначала получать BODYSTRUCTURE и загружать только части с нужными вложениями')
+    parser.add_argument('--org-match', choices=['first', 'longest'], default='first',
+                       help='Какой ключ выбирать, если в заголовке найдено несколько: first - первый в списке '
+                            'организаций, longest - самый длинный (по умолчанию: first)')
+    parser.add_argument('--header-cache-size', type=int, default=HEADER_CACHE_SIZE,
+                       help=f'Размер кэша декодированных заголовков и названий организаций (по умолчанию: {HEADER_CACHE_SIZE})')
+    parser.add_argument('--metadata-format', choices=['txt', 'jsonl'], default='txt',
+                       help='Метаданные писем: txt - информация_о_письме.txt в папке каждого письма, '
+                            'jsonl - один файл метаданных за запуск (по умолчанию: txt)')
+    parser.add_argument('--catalog-file', type=str, default=None,
+                       help='Каталог обработанных писем SQLite (по умолчанию: Организации_и_письма/каталог_писем.sqlite)')
+    parser.add_argument('--no-catalog', action='store_true',
+                       help='Не вести каталог и не пропускать уже обработанные письма')
+    parser.add_argument('--journal-file', type=str, default=None,
+                       help='Журнал запуска для продолжения после сбоя (по умолчанию: Организации_и_письма/журнал_обработки.jsonl)')
+    parser.add_argument('--no-journal', action='store_true',
+                       help='Не вести журнал запуска (после сбоя недописанные файлы не откатываются)')
+    parser.add_argument('--dedup', action='store_true',
+                       help='Хранить одинаковые вложения один раз (жесткие ссылки, иначе файлы-указатели)')
+    parser.add_argument('--prometheus-file', type=str, default=None,
+                       help='Записывать метрики времени этапов в файл Prometheus (*.prom для textfile collector)')
+    parser.add_argument('--source', type=str, default=None,
+                       help='Обработать локальный архив вместо почтового ящика: файл mbox, папку Maildir '
+                            'или папку с файлами .eml (--days не учитывается)')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Процессов разбора для --source (по умолчанию: число ядер процессора)')
+    parser.add_argument('--daemon', action='store_true',
+                       help='Режим службы: ждать новые письма (IMAP IDLE) и обрабатывать их сразу; учетные данные '
+                            f'из --credentials-file или переменных {CREDENTIALS_ENV_ADDRESS} и {CREDENTIALS_ENV_PASSWORD}')
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT_SECONDS,
+                       help=f'Через сколько секунд переоткрывать IDLE в режиме службы (по умолчанию: {IDLE_TIMEOUT_SECONDS})')
+    parser.add_argument('--credentials-file', type=str, default=None,
+                       help='Файл с адресом (первая строка) и паролем (вторая строка) вместо ввода с клавиатуры')
+    parser.add_argument('--streaming', action='store_true',
+                       help='Загружать вложения частями сразу в файл (память не зависит от размера вложений; '
+                            'включает --prescan)')
+    parser.add_argument('--prematch', choices=['skip', 'defer', 'download'], default=None,
+                       help='Сначала загружать только заголовки и сопоставлять отправителя со списком организаций; '
+                            'письма неизвестных отправителей: skip - пропустить, defer - отложить, '
+                            'download - загрузить все равно')
+    parser.add_argument('--process-deferred', action='store_true',
+                       help='Загрузить письма, отложенные при прошлых запусках с --prematch defer')
+    parser.add_argument('--connections', type=int, default=1,
+                       help=f'Количество параллельных IMAP-соединений (по умолчанию: 1, максимум: {MAX_IMAP_CONNECTIONS})')
+    parser.add_argument('--engine', choices=['sync', 'async'], default='sync',
+                       help='Движок загрузки: sync - imaplib, async - asyncio с конвейером команд (по умолчанию: sync)')
+    parser.add_argument('--pipeline', action='store_true',
+                       help='Конвейер: загрузка, разбор и запись писем идут одновременно (результат тот же)')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                       help='Процессов разбора писем в конвейере (по умолчанию: 1; загрузку задает --connections)')
+    parser.add_argument('--write-workers', type=int, default=1,
+                       help='Потоков записи в конвейере; письма одной организации пишет один поток (по умолчанию: 1)')
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                       help=f'Емкость очередей между этапами конвейера в письмах (по умолчанию: {PIPELINE_QUEUE_SIZE})')
+    parser.add_argument('--full-resync', action='store_true',
+                       help='Игнорировать сохраненное состояние и загрузить все письма за период')
+    parser.add_argument('--state-file', type=str, default=None,
+                       help='Файл состояния синхронизации (по умолчанию: Организации_и_письма/состояние_синхронизации.json)')
     
     args = parser.parse_args()
     
     print("=" * 70)
     print("📧 ОБРАБОТЧИК ПОЧТЫ - СОРТИРОВКА ПО ОРГАНИЗАЦИЯМ И ДАТАМ")
     print("=" * 70)
-    print(f"Период: последние {args.days} дней")
-    print(f"Сервер: {args.server}")
+    if args.source:
+        print(f"Локальный архив: {args.source} (процессов разбора: {args.workers or os.cpu_count()})")
+    else:
+        print(f"Период: последние {args.days} дней")
+        print(f"Сервер: {args.server}:{args.port}{' (без SSL)' if args.no_ssl else ''}")
     print(f"Файл организаций: {args.org_file}")
+    print(f"Размер пакета загрузки: {args.batch_size}")
+    print(f"IMAP-соединений: {args.connections}")
+    print(f"Движок загрузки: {args.engine}")
+    if args.pipeline:
+        print(f"Конвейер: разбор {args.parse_workers} проц., запись {args.write_workers} пот., очереди {args.queue_size}")
+    print(f"Предпросмотр структуры писем: {'Да' if args.prescan or args.streaming else 'Нет'}")
+    print(f"Выбор ключа организации: {args.org_match}")
+    print(f"Формат метаданных писем: {args.metadata_format}")
+    print(f"Каталог обработанных писем: {'Нет' if args.no_catalog else (args.catalog_file or 'по умолчанию')}")
+    print(f"Журнал запуска: {'Нет' if args.no_journal else (args.journal_file or 'по умолчанию')}")
+    print(f"Дедупликация вложений: {'Да' if args.dedup else 'Нет'}")
+    print(f"Режим службы (IDLE): {'Да' if args.daemon else 'Нет'}")
+    print(f"Потоковое сохранение вложений: {'Да' if args.streaming else 'Нет'}")
+    print(f"Сопоставление отправителей по заголовкам: {args.prematch or 'Нет'}")
+    if args.prometheus_file:
+        print(f"Метрики Prometheus: {args.prometheus_file}")
     print("Форматы файлов: XLSX, PDF, DOCX, DOC")
     print("=" * 70)
     
-    # Запрос учетных данных
-    email_address = input("\nВведите email адрес: ").strip()
-    password = input("Введите пароль: ").strip()
+    # Учетные данные: из файла или окружения, иначе запрос (в режиме службы спрашивать некого);
+    # для локального архива не нужны
+    try:
+        email_address, password = load_credentials(args.credentials_file)
+    except Exception as e:
+        logging.error(f"❌ Ошибка чтения учетных данных: {e}")
+        return
+    if args.source:
+        email_address, password = email_address or '', password or ''
+    elif not email_address or not password:
+        if args.daemon:
+            logging.error(f"❌ Для режима службы задайте --credentials-file или переменные "
+                          f"{CREDENTIALS_ENV_ADDRESS} и {CREDENTIALS_ENV_PASSWORD}")
+            return
+        email_address = input("\nВведите email адрес: ").strip()
+        password = input("Введите пароль: ").strip()
     
     # Создаем процессор
     processor = EmailOrganizationProcessor(
         imap_server=args.server,
         email_address=email_address,
         password=password,
-        organizations_file=args.org_file # Передаем файл организаций
+        organizations_file=args.org_file, # Передаем файл организаций
+        batch_size=args.batch_size,
+        sync_state_file=args.state_file,
+        prescan=args.prescan,
+        sender_prematch=args.prematch,
+        connections=args.connections,
+        engine=args.engine,
+        streaming=args.streaming,
+        org_match=args.org_match,
+        header_cache_size=args.header_cache_size,
+        metadata_format=args.metadata_format,
+        catalog_file=args.catalog_file,
+        use_catalog=not args.no_catalog,
+        dedup=args.dedup,
+        imap_port=args.port,
+        use_ssl=not args.no_ssl,
+        prometheus_file=args.prometheus_file,
+        pipeline=args.pipeline,
+        parse_workers=args.parse_workers,
+        write_workers=args.write_workers,
+        queue_size=args.queue_size,
+        journal_file=args.journal_file,
+        use_journal=not args.no_journal
     )
     
     try:
         # Запускаем обработку
-        processor.process_emails(days=args.days)
+        if args.source:
+            processor.process_local_archive(args.source, workers=args.workers)
+        elif args.daemon:
+            processor.run_daemon(days=args.days, idle_timeout=args.idle_timeout)
+        else:
+            processor.process_emails(days=args.days, full_resync=args.full_resync,
+                                     process_deferred=args.process_deferred)
         
     except KeyboardInterrupt:
         print("\n\n⚠️ Программа прервана пользователем")
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}")
     
-    # Пауза перед закрытием
-    input("\nНажмите Enter для выхода...")
+    # Пауза перед закрытием (служба запускается без консоли)
+    if not args.daemon:
+        input("\nНажмите Enter для выхода...")
 
 
 if __name__ == "__main__":
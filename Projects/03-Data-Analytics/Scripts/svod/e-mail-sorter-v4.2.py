@@ -3,10 +3,19 @@ import re
 import shutil
 from datetime import datetime
 import openpyxl
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+import zipfile
+import posixpath
+import struct
+from itertools import groupby
+import xml.etree.ElementTree as ET
 import logging
+import time
 from pathlib import Path
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import sys
 
 # Настройка логирования
@@ -16,12 +25,656 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# Окно поиска в листах Excel: первые строки и столбцы каждого листа
+EXCEL_MAX_ROWS = 500
+EXCEL_MAX_COLS = 20
+
+# Пространства имен разметки xlsx для быстрого чтения без openpyxl
+XLSX_MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+XLSX_CONTENT_TYPES_NS = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+XLSX_SHARED_STRINGS_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml'
+# Цифры номера строки в адресе ячейки (A12 -> столбец A)
+XLSX_ROW_DIGITS = '0123456789'
+
+# Пространство имен разметки Word (.docx) и части документа с текстом: верхние колонтитулы и основной текст
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DOCX_HEADER_PART = re.compile(r'word/header(\d*)\.xml')
+DOCX_DOCUMENT_PART = 'word/document.xml'
+
+# Подпись составного файла OLE2 (старые .xls и .doc) и служебный номер сектора "конец цепочки"
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+OLE_END_OF_CHAIN = 0xFFFFFFFE
+
+# Записи BIFF8, нужные для чтения текста ячеек .xls
+BIFF_BOF = 0x0809
+BIFF_EOF = 0x000A
+BIFF_FILEPASS = 0x002F
+BIFF_BOUNDSHEET = 0x0085
+BIFF_WINDOW1 = 0x003D
+BIFF_SST = 0x00FC
+BIFF_CONTINUE = 0x003C
+BIFF_LABELSST = 0x00FD
+BIFF_LABEL = 0x0204
+BIFF_RSTRING = 0x00D6
+BIFF8_VERSION = 0x0600
+
+# Файл-указатель дедупликации парсера: повтор вложения без жесткой ссылки (внутри - относительный путь к копии).
+# Сортировщик переносит указатель, а не копию: место на диске остается сэкономленным
+DEDUP_POINTER_SUFFIX = '.ссылка'
+
+# Сколько файлов отдавать процессу поиска за одну задачу (меньше обмена между процессами)
+PROCESS_CHUNK_SIZE = 8
+
+# Сортировщик в рабочем процессе (копия настроек поиска из основного процесса)
+_sort_worker = None
+
+
+def init_sort_worker(sorter):
+    """Инициализация рабочего процесса поиска"""
+    global _sort_worker
+    _sort_worker = sorter
+
+
+def identify_in_worker(file_info):
+    """Поиск ключей в содержимом файла в рабочем процессе.
+    Возвращает только решение: (файл, папка или None, изменения статистики, ошибка)"""
+    file_path, rel_path = file_info
+    stats_before = dict(_sort_worker.stats)
+    try:
+        folder_name = _sort_worker.identify_report_type(file_path)
+        error = None
+    except Exception as e:
+        folder_name, error = None, str(e)
+    match_stats = {key: value - stats_before.get(key, 0) for key, value in _sort_worker.stats.items()
+                   if value != stats_before.get(key, 0)}
+    return file_info, folder_name, match_stats, error
+
+
+class UnsupportedWorkbook(Exception):
+    """Книга, которую собственное чтение не разбирает (xlsx читается через openpyxl)"""
+
+
+def xlsx_text(node):
+    """Текст строки xlsx (<si> или <is>): прямой <t> и <t> фрагментов <r>, без фонетики <rPh> - как openpyxl"""
+    snippets = []
+    plain = node.find(XLSX_MAIN_NS + 't')
+    if plain is not None and plain.text is not None:
+        snippets.append(plain.text)
+    for run in node.findall(XLSX_MAIN_NS + 'r'):
+        text = run.find(XLSX_MAIN_NS + 't')
+        if text is not None and text.text is not None:
+            snippets.append(text.text)
+    return ''.join(snippets)
+
+
+class XlsxSharedStrings:
+    """Общие строки книги, читаемые потоково: файл разбирается только до самой дальней запрошенной строки"""
+
+    def __init__(self, archive, path):
+        self.strings = []
+        self.source = archive.open(path) if path else None
+        self.events = ET.iterparse(self.source, events=('end',)) if path else iter(())
+
+    def __getitem__(self, index):
+        while index >= len(self.strings):
+            event, node = next(self.events, (None, None))
+            if node is None:
+                raise UnsupportedWorkbook(f"нет общей строки {index}")
+            if node.tag == XLSX_MAIN_NS + 'si':
+                self.strings.append(xlsx_text(node).replace('x005F_', ''))
+                node.clear()
+        return self.strings[index]
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+
+class XlsxSheet:
+    """Лист книги для быстрого чтения: iter_rows как у листа openpyxl в режиме read_only (values_only)"""
+
+    def __init__(self, book, title, path):
+        self.book = book
+        self.title = title
+        self.path = path
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=True):
+        book = self.book
+        row_tag = XLSX_MAIN_NS + 'row'
+        value_tag, inline_tag = XLSX_MAIN_NS + 'v', XLSX_MAIN_NS + 'is'
+        counter = min_row
+        row_counter = 0
+        with book.archive.open(self.path) as source:
+            for event, row in ET.iterparse(source, events=('end',)):
+                if row.tag != row_tag:
+                    continue
+                row_number = row.get('r')
+                row_counter = int(float(row_number)) if row_number else row_counter + 1
+                if max_row is not None and row_counter > max_row:
+                    # Дальше окна поиска лист не читаем; недостающие строки окна - пустые (как в openpyxl)
+                    while counter <= max_row:
+                        counter += 1
+                        yield ()
+                    return
+                values = {}
+                column = 0
+                for cell in row:
+                    coordinate = cell.get('r')
+                    column = column_index_from_string(coordinate.rstrip(XLSX_ROW_DIGITS)) if coordinate else column + 1
+                    if min_col <= column <= (max_col or column):
+                        values[column] = book.cell_value(cell, value_tag, inline_tag)
+                row.clear()
+                # Пропущенные строки - пустые; повтор или строка не по порядку не выдается (как в openpyxl)
+                while counter < row_counter:
+                    counter += 1
+                    yield ()
+                if counter == row_counter:
+                    counter += 1
+                    yield tuple(values[column] for column in sorted(values))
+
+
+class XlsxTextReader:
+    """Быстрое чтение значений ячеек xlsx напрямую из zip (iterparse) без загрузки книги в openpyxl.
+    Значения приводятся так же, как в openpyxl (числа, даты по стилям, общие и встроенные строки);
+    все необычное - UnsupportedWorkbook, и файл читается через openpyxl"""
+
+    def __init__(self, file_path):
+        self.archive = zipfile.ZipFile(file_path)
+        self.shared_strings = None
+        try:
+            self.load_workbook()
+        except Exception:
+            self.close()
+            raise
+
+    def load_workbook(self):
+        names = set(self.archive.namelist())
+        if 'xl/workbook.xml' not in names or 'xl/_rels/workbook.xml.rels' not in names:
+            raise UnsupportedWorkbook("нестандартное расположение книги")
+        workbook = ET.fromstring(self.archive.read('xl/workbook.xml'))
+        if workbook.tag != XLSX_MAIN_NS + 'workbook':
+            raise UnsupportedWorkbook("неизвестное пространство имен книги")
+
+        properties = workbook.find(XLSX_MAIN_NS + 'workbookPr')
+        self.epoch = WINDOWS_EPOCH
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            self.epoch = MAC_EPOCH
+
+        # Активный лист: первый вид книги с activeTab (как wb.active в openpyxl)
+        self.active_index = 0
+        for view in workbook.iter(XLSX_MAIN_NS + 'workbookView'):
+            if view.get('activeTab') is not None:
+                self.active_index = int(view.get('activeTab'))
+                break
+
+        relationships = {}
+        for rel in ET.fromstring(self.archive.read('xl/_rels/workbook.xml.rels')):
+            target = rel.get('Target', '')
+            target = target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            relationships[rel.get('Id')] = (rel.get('Type', ''), target)
+
+        self.sheets = []
+        for sheet in workbook.iter(XLSX_MAIN_NS + 'sheet'):
+            rel_type, target = relationships.get(sheet.get(XLSX_REL_NS + 'id'), ('', None))
+            if not rel_type.endswith('/worksheet') or target not in names:
+                raise UnsupportedWorkbook(f"лист {sheet.get('name')} не является обычным листом")
+            self.sheets.append(XlsxSheet(self, sheet.get('name'), target))
+        self.sheetnames = [sheet.title for sheet in self.sheets]
+
+        # Общие строки - по типу содержимого, как в openpyxl
+        strings_path = None
+        if '[Content_Types].xml' in names:
+            for override in ET.fromstring(self.archive.read('[Content_Types].xml')):
+                if override.get('ContentType') == XLSX_SHARED_STRINGS_TYPE:
+                    strings_path = override.get('PartName', '').lstrip('/')
+        self.shared_strings = XlsxSharedStrings(self.archive, strings_path if strings_path in names else None)
+        self.load_date_styles(names)
+
+    def load_date_styles(self, names):
+        """Номера стилей ячеек с форматами даты и длительности (числа в них openpyxl отдает как даты)"""
+        self.date_styles = set()
+        self.timedelta_styles = set()
+        if 'xl/styles.xml' not in names:
+            return
+        styles = ET.fromstring(self.archive.read('xl/styles.xml'))
+        custom_formats = {int(fmt.get('numFmtId')): fmt.get('formatCode')
+                          for fmt in styles.iter(XLSX_MAIN_NS + 'numFmt')}
+        cell_formats = styles.find(XLSX_MAIN_NS + 'cellXfs')
+        if cell_formats is None:
+            return
+        for index, xf in enumerate(cell_formats.findall(XLSX_MAIN_NS + 'xf')):
+            format_id = int(xf.get('numFmtId', 0))
+            fmt = custom_formats[format_id] if format_id in custom_formats else BUILTIN_FORMATS.get(format_id)
+            if is_date_format(fmt):
+                self.date_styles.add(index)
+            if is_timedelta_format(fmt):
+                self.timedelta_styles.add(index)
+
+    def cell_value(self, cell, value_tag, inline_tag):
+        """Значение ячейки (data_only): как WorkSheetParser.parse_cell в openpyxl"""
+        data_type = cell.get('t', 'n')
+        if data_type == 'inlineStr':
+            inline = cell.find(inline_tag)
+            return xlsx_text(inline) if inline is not None else None
+        value = cell.findtext(value_tag, None) or None
+        if value is None:
+            return None
+        if data_type == 's':
+            return self.shared_strings[int(value)]
+        if data_type == 'n':
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            style = int(cell.get('s') or 0) if self.date_styles else 0
+            if style in self.date_styles:
+                try:
+                    return from_excel(value, self.epoch, timedelta=style in self.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return value
+        if data_type == 'b':
+            return bool(int(value))
+        if data_type == 'd':
+            return from_ISO8601(value)
+        return value
+
+    @property
+    def active(self):
+        return self.sheets[self.active_index] if 0 <= self.active_index < len(self.sheets) else None
+
+    def __getitem__(self, sheet_name):
+        return self.sheets[self.sheetnames.index(sheet_name)]
+
+    def close(self):
+        if self.shared_strings is not None:
+            self.shared_strings.close()
+        self.archive.close()
+
+
+def docx_paragraph_text(paragraph):
+    """Текст абзаца Word: фрагменты <w:t>, табуляции и переносы как пробелы (удаленный текст и коды полей не входят)"""
+    parts = []
+    for node in paragraph.iter():
+        if node.tag == WORD_NS + 't':
+            parts.append(node.text or '')
+        elif node.tag in (WORD_NS + 'tab', WORD_NS + 'br', WORD_NS + 'cr'):
+            parts.append(' ')
+    return ''.join(parts).strip()
+
+
+def iter_docx_lines(file_path):
+    """Непустые строки .docx потоком (zip + iterparse, без python-docx): сначала верхние колонтитулы, затем текст.
+    Абзац - строка; строка таблицы - ячейки через пробел, как строки Excel"""
+    with zipfile.ZipFile(file_path) as archive:
+        names = archive.namelist()
+        if DOCX_DOCUMENT_PART not in names:
+            raise ValueError("в файле нет word/document.xml")
+        headers = sorted((int(match.group(1) or 0), name) for name in names
+                         for match in [DOCX_HEADER_PART.fullmatch(name)] if match)
+        for part in [name for _, name in headers] + [DOCX_DOCUMENT_PART]:
+            with archive.open(part) as source:
+                table_depth = 0
+                for event, node in ET.iterparse(source, events=('start', 'end')):
+                    if node.tag == WORD_NS + 'tbl':
+                        table_depth += 1 if event == 'start' else -1
+                    if event != 'end':
+                        continue
+                    if node.tag == WORD_NS + 'p' and not table_depth:
+                        line = docx_paragraph_text(node)
+                        node.clear()
+                    elif node.tag == WORD_NS + 'tr' and table_depth == 1:
+                        cells = (' '.join(filter(None, (docx_paragraph_text(paragraph)
+                                                        for paragraph in cell.iter(WORD_NS + 'p'))))
+                                 for cell in node.findall(WORD_NS + 'tc'))
+                        line = ' '.join(filter(None, cells))
+                        node.clear()
+                    else:
+                        continue
+                    if line:
+                        yield line
+
+
+def read_ole_stream(file_path, stream_name):
+    """Содержимое потока составного файла OLE2 (.xls, .doc) по имени, без сторонних библиотек"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if data[:8] != OLE_SIGNATURE:
+        raise UnsupportedWorkbook("файл не является составным документом OLE2")
+    sector_size = 1 << struct.unpack_from('<H', data, 0x1E)[0]
+    mini_sector_size = 1 << struct.unpack_from('<H', data, 0x20)[0]
+    (fat_count, directory_start, _, mini_cutoff, minifat_start, minifat_count,
+     difat_start, difat_count) = struct.unpack_from('<8I', data, 0x2C)
+    sector_count = len(data) // sector_size - 1
+
+    def sector(number):
+        if number >= sector_count:
+            raise UnsupportedWorkbook(f"сектор {number} за концом файла")
+        start = (number + 1) * sector_size
+        return data[start:start + sector_size]
+
+    # Таблица размещения: номера ее секторов в заголовке и в цепочке DIFAT
+    fat_sectors = list(struct.unpack_from('<109I', data, 0x4C))
+    entries_per_sector = sector_size // 4
+    for _ in range(difat_count):
+        if difat_start >= OLE_END_OF_CHAIN:
+            break
+        entries = struct.unpack(f'<{entries_per_sector}I', sector(difat_start))
+        fat_sectors.extend(entries[:-1])
+        difat_start = entries[-1]
+    fat = []
+    for number in fat_sectors[:fat_count]:
+        fat.extend(struct.unpack(f'<{entries_per_sector}I', sector(number)))
+
+    def chain(start, table, read):
+        parts = []
+        number = start
+        while number < OLE_END_OF_CHAIN:
+            if len(parts) > len(table) or number >= len(table):
+                raise UnsupportedWorkbook("поврежденная цепочка секторов")
+            parts.append(read(number))
+            number = table[number]
+        return b''.join(parts)
+
+    directory = chain(directory_start, fat, sector)
+    root = None
+    for position in range(0, len(directory) - 127, 128):
+        entry = directory[position:position + 128]
+        name_length = struct.unpack_from('<H', entry, 0x40)[0]
+        name = entry[:max(name_length - 2, 0)].decode('utf-16-le', 'replace')
+        entry_type = entry[0x42]
+        start, size = struct.unpack_from('<IQ', entry, 0x74)
+        if sector_size == 512:
+            # В версии 3 старшие байты размера не используются
+            size &= 0xFFFFFFFF
+        if entry_type == 5:
+            root = (start, size)
+        elif entry_type == 2 and name.lower() == stream_name.lower():
+            if size >= mini_cutoff:
+                return chain(start, fat, sector)[:size]
+            # Маленькие потоки лежат в мини-потоке корневого элемента
+            if root is None:
+                raise UnsupportedWorkbook("нет корневого элемента OLE2")
+            mini_stream = chain(root[0], fat, sector)[:root[1]]
+            minifat = chain(minifat_start, fat, sector)
+            minifat = struct.unpack(f'<{len(minifat) // 4}I', minifat)
+
+            def mini_sector(number):
+                return mini_stream[number * mini_sector_size:(number + 1) * mini_sector_size]
+            return chain(start, minifat, mini_sector)[:size]
+    raise UnsupportedWorkbook(f"в файле нет потока {stream_name}")
+
+
+def biff_string(data, offset, length_size=2):
+    """Строка BIFF8 (длина, флаги, символы) внутри одной записи; форматирование и фонетика пропускаются"""
+    length = data[offset] if length_size == 1 else struct.unpack_from('<H', data, offset)[0]
+    flags = data[offset + length_size]
+    offset += length_size + 1
+    if flags & 0x08:
+        offset += 2
+    if flags & 0x04:
+        offset += 4
+    if flags & 0x01:
+        return data[offset:offset + 2 * length].decode('utf-16-le')
+    return data[offset:offset + length].decode('latin-1')
+
+
+class XlsSharedStrings:
+    """Таблица общих строк .xls (SST и ее CONTINUE); разбирается только до самой дальней запрошенной строки"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.strings = []
+        self.chunk = 0
+        # Число строк в таблице, затем сами строки с 8-го байта
+        self.count = struct.unpack_from('<I', chunks[0], 4)[0] if chunks else 0
+        self.offset = 8
+
+    def read_bytes(self, size):
+        parts = []
+        while size:
+            chunk = self.chunks[self.chunk]
+            if self.offset >= len(chunk):
+                self.next_chunk()
+                continue
+            part = chunk[self.offset:self.offset + size]
+            self.offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def read_chars(self, count, wide):
+        """Символы строки; на границе CONTINUE первый байт новой записи заново задает ширину символов"""
+        parts = []
+        while count:
+            chunk = self.chunks[self.chunk]
+            if self.offset >= len(chunk):
+                self.next_chunk()
+                wide = self.chunks[self.chunk][0] & 0x01
+                self.offset = 1
+                continue
+            width = 2 if wide else 1
+            taken = min(count, (len(chunk) - self.offset) // width)
+            if not taken:
+                raise UnsupportedWorkbook("символ разорван границей записи SST")
+            raw = chunk[self.offset:self.offset + taken * width]
+            parts.append(raw.decode('utf-16-le') if wide else raw.decode('latin-1'))
+            self.offset += taken * width
+            count -= taken
+        return ''.join(parts)
+
+    def next_chunk(self):
+        self.chunk += 1
+        self.offset = 0
+        if self.chunk >= len(self.chunks):
+            raise UnsupportedWorkbook("таблица общих строк обрывается")
+
+    def __getitem__(self, index):
+        if index >= self.count:
+            raise UnsupportedWorkbook(f"нет общей строки {index}")
+        while index >= len(self.strings):
+            length, flags = struct.unpack('<HB', self.read_bytes(3))
+            runs = struct.unpack('<H', self.read_bytes(2))[0] if flags & 0x08 else 0
+            extra = struct.unpack('<I', self.read_bytes(4))[0] if flags & 0x04 else 0
+            self.strings.append(self.read_chars(length, flags & 0x01))
+            # Форматирование (4 байта на фрагмент) и фонетика не нужны
+            self.read_bytes(4 * runs + extra)
+        return self.strings[index]
+
+
+class XlsSheet:
+    """Лист .xls: iter_rows отдает текстовые ячейки строк (как values_only у openpyxl, без чисел)"""
+
+    def __init__(self, book, title, offset):
+        self.book = book
+        self.title = title
+        self.offset = offset
+
+    def iter_text_cells(self, max_row, min_col, max_col):
+        """(строка, столбец, текст) текстовых ячеек листа в окне; нумерация с 1, как в openpyxl"""
+        depth = 0
+        for record_type, data in self.book.iter_records(self.offset):
+            if record_type == BIFF_BOF:
+                depth += 1
+            elif record_type == BIFF_EOF:
+                depth -= 1
+                if depth <= 0:
+                    return
+            elif depth == 1 and record_type in (BIFF_LABELSST, BIFF_LABEL, BIFF_RSTRING):
+                row, column = struct.unpack_from('<HH', data)
+                row += 1
+                column += 1
+                if max_row is not None and row > max_row:
+                    # Ячейки BIFF идут по строкам: дальше окна поиска лист не читаем
+                    return
+                if not min_col <= column <= (max_col or column):
+                    continue
+                if record_type == BIFF_LABELSST:
+                    yield row, column, self.book.shared_strings[struct.unpack_from('<I', data, 6)[0]]
+                else:
+                    yield row, column, biff_string(data, 6)
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=True):
+        counter = min_row
+        cells = self.iter_text_cells(max_row, min_col, max_col)
+        for row, row_cells in groupby(cells, key=lambda cell: cell[0]):
+            values = {column: text for _, column, text in row_cells}
+            if row < counter:
+                # Строка не по порядку: текст все равно отдаем в поиск
+                yield tuple(values[column] for column in sorted(values))
+                continue
+            while counter < row:
+                counter += 1
+                yield ()
+            counter += 1
+            yield tuple(values[column] for column in sorted(values))
+
+
+class XlsTextReader:
+    """Текст ячеек старой книги .xls (BIFF8) потоком записей, без построения всей книги:
+    общие строки (SST) и ячейки LABEL/LABELSST; API листов - как у XlsxTextReader"""
+
+    def __init__(self, file_path):
+        self.stream = read_ole_stream(file_path, 'Workbook')
+        self.sheets = []
+        self.active_index = 0
+        records = self.iter_records(0)
+        record_type, data = next(records, (None, b''))
+        if record_type != BIFF_BOF or len(data) < 2 or struct.unpack_from('<H', data)[0] != BIFF8_VERSION:
+            raise UnsupportedWorkbook("книга не в формате BIFF8")
+        sheet_types = []
+        sst_chunks = []
+        active_tab = None
+        previous_type = None
+        for record_type, data in records:
+            if record_type == BIFF_EOF:
+                break
+            if record_type == BIFF_FILEPASS:
+                raise UnsupportedWorkbook("книга защищена паролем")
+            if record_type == BIFF_BOUNDSHEET:
+                offset, visibility, sheet_type = struct.unpack_from('<IBB', data)
+                sheet_types.append(sheet_type)
+                if sheet_type == 0:
+                    self.sheets.append(XlsSheet(self, biff_string(data, 6, length_size=1), offset))
+            elif record_type == BIFF_WINDOW1 and active_tab is None:
+                active_tab = struct.unpack_from('<H', data, 10)[0]
+            elif record_type == BIFF_SST:
+                sst_chunks = [data]
+            elif record_type == BIFF_CONTINUE and previous_type == BIFF_SST:
+                sst_chunks.append(data)
+                continue
+            previous_type = record_type
+        # Активный лист: WINDOW1 считает все листы книги, включая диаграммы
+        if active_tab is not None:
+            is_worksheet = active_tab < len(sheet_types) and sheet_types[active_tab] == 0
+            self.active_index = sheet_types[:active_tab].count(0) if is_worksheet else None
+        self.sheetnames = [sheet.title for sheet in self.sheets]
+        self.shared_strings = XlsSharedStrings(sst_chunks)
+
+    def iter_records(self, offset):
+        """Записи BIFF (тип, данные) с заданного смещения потока Workbook"""
+        stream = self.stream
+        while offset + 4 <= len(stream):
+            record_type, size = struct.unpack_from('<HH', stream, offset)
+            yield record_type, stream[offset + 4:offset + 4 + size]
+            offset += 4 + size
+
+    @property
+    def active(self):
+        if self.active_index is None or not 0 <= self.active_index < len(self.sheets):
+            return None
+        return self.sheets[self.active_index]
+
+    def __getitem__(self, sheet_name):
+        return self.sheets[self.sheetnames.index(sheet_name)]
+
+    def close(self):
+        self.stream = b''
+
+
+def open_xls_workbook(file_path):
+    """Книга .xls для чтения текста: BIFF8 - своим разбором, а .xls, который на деле xlsx (zip), - как xlsx"""
+    if zipfile.is_zipfile(file_path):
+        return XlsxTextReader(file_path)
+    return XlsTextReader(file_path)
+
+
+class ReportKeyMatcher:
+    """Ключи поиска, собранные в одно регулярное выражение в виде дерева префиксов:
+    все ключи проверяются за один проход поиска по тексту, без перебора ключей по строкам.
+    Ключи передаются в порядке приоритета (порядок файла настроек): [(ключ, папка)]"""
+
+    def __init__(self, keys):
+        self.keys = [search_key for search_key, _ in keys]
+        self.folders = [folder_name for _, folder_name in keys]
+        # Одинаковые ключи (например, ключи имени в нижнем регистре) - действует первый по порядку
+        index_of = {}
+        for index, search_key in enumerate(self.keys):
+            index_of.setdefault(search_key, index)
+        # Найденный в позиции ключ - самый длинный из начинающихся там; остальные - его префиксы
+        self.prefix_keys = {search_key: tuple(sorted(index_of[prefix] for prefix in index_of
+                                                     if search_key.startswith(prefix)))
+                            for search_key in index_of}
+        trie = {}
+        for search_key in index_of:
+            node = trie
+            for char in search_key:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        self.pattern = re.compile(self.trie_pattern(trie)) if trie else None
+
+    @classmethod
+    def trie_pattern(cls, node):
+        """Регулярное выражение узла дерева: ветви по следующему символу, конец ключа - необязательное продолжение
+        (жадное, поэтому в каждой позиции совпадает самый длинный ключ)"""
+        branches = [re.escape(char) + cls.trie_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    def __len__(self):
+        return len(self.keys)
+
+    def iter_hits(self, text):
+        """Номера ключей, найденных в тексте (по позициям; поиск продолжается со следующего символа,
+        чтобы не пропустить ключи, пересекающиеся с найденным)"""
+        if self.pattern is None:
+            return
+        search = self.pattern.search
+        position = 0
+        while position <= len(text):
+            match = search(text, position)
+            if match is None:
+                return
+            yield from self.prefix_keys[match.group()]
+            position = match.start() + 1
+
+    def find(self, text):
+        """Папка первого по приоритету ключа, найденного в тексте, или None"""
+        best = None
+        for index in self.iter_hits(text):
+            if best is None or index < best:
+                best = index
+                # Первый ключ лучше любого другого - дальше искать незачем
+                if best == 0:
+                    break
+        return self.folders[best] if best is not None else None
+
+
 class ReportSorter:
-    def __init__(self, source_folder, output_folder, report_names_file, interactive=False):
+    def __init__(self, source_folder, output_folder, report_names_file, interactive=False,
+                 scan_mode='full', sheet_order='workbook', excel_reader='fast'):
         self.source_folder = source_folder
         self.output_folder = output_folder
         self.report_names_file = report_names_file
         self.interactive = interactive
+        # Поиск в содержимом: 'full' - все окно файла, выбирается первый ключ в порядке файла настроек
+        # (чтение прекращается только на первом ключе списка); 'first' - чтение до первой строки с ключом
+        self.scan_mode = scan_mode
+        # Порядок листов Excel: 'workbook' - как в книге, 'active' - сначала активный лист
+        self.sheet_order = sheet_order
+        # Чтение .xlsx: 'fast' - напрямую из zip (при любой необычности - openpyxl), 'openpyxl' - только openpyxl
+        self.excel_reader = excel_reader
         os.makedirs(output_folder, exist_ok=True)
         # Основные форматы
         self.supported_formats = ['.xlsx', '.xls', '.pdf', '.docx', '.doc']
@@ -29,6 +682,15 @@ class ReportSorter:
         # тип_поиска: 'content' или 'filename'
         self.search_to_folder = {}
         self.found_folders = set()
+        # Одинаковое содержимое (жесткие ссылки дедупликации, указатели парсера): {файл: (st_dev, st_ino)}
+        # и решения поиска по этому ключу - повтор получает папку первой копии без повторного чтения
+        self.file_identity = {}
+        self.verdict_cache = {}
+        # Указатели дедупликации {путь указателя: путь копии} и перемещенные копии {старый путь: новый путь}
+        self.pointer_targets = {}
+        self.moved_paths = {}
+        # Автоматы поиска ключей (перестраиваются при каждом изменении ключей)
+        self.build_matchers()
         # Статистика
         self.stats = {
             'total_files': 0,
@@ -40,7 +702,8 @@ class ReportSorter:
             'interactive_choices': 0,
             'exact_matches': 0,
             'name_matches': 0,
-            'new_keys_added': 0
+            'new_keys_added': 0,
+            'duplicates': 0
         }
         # Для хранения неотсортированных файлов
         self.unsorted_files = []
@@ -113,6 +776,7 @@ class ReportSorter:
                     if search_key:
                         self.search_to_folder[search_key] = (search_key, 'content')
 
+            self.build_matchers()
             print(f"✅ Загружено ключей поиска: {len(self.search_to_folder)}")
             print(f"✅ Будут созданы папки: {len(set([v[0] for v in self.search_to_folder.values()]))}")
             debug_file = os.path.join(self.output_folder, "настройки_поиска.txt")
@@ -134,6 +798,17 @@ class ReportSorter:
             print(f"❌ Ошибка загрузки: {e}")
             return False
 
+    def build_matchers(self):
+        """Автоматы поиска: ключи содержимого (с учетом регистра) и ключи имени файла (в нижнем регистре)"""
+        self.content_matcher = ReportKeyMatcher(
+            [(search_key, folder_name) for search_key, (folder_name, search_type) in self.search_to_folder.items()
+             if search_type == 'content'])
+        self.filename_matcher = ReportKeyMatcher(
+            [(search_key.lower(), folder_name) for search_key, (folder_name, search_type)
+             in self.search_to_folder.items() if search_type == 'filename'])
+        # Решения, принятые со старыми ключами, больше не действуют
+        self.verdict_cache = {}
+
     def save_report_names(self):
         """Сохранение ключей поиска в файл"""
         try:
@@ -149,56 +824,121 @@ class ReportSorter:
             print(f"❌ Ошибка сохранения настроек: {e}")
             return False
 
-    def search_exact_in_excel(self, file_path, filename):
-        """ТОЧНЫЙ поиск ключей в содержимом Excel файла"""
-        try:
-            wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
-            all_text_lines = []
-            for sheet_name in wb.sheetnames:
-                ws = wb[sheet_name]
-                for row in ws.iter_rows(min_row=1, max_row=500, min_col=1, max_col=20, values_only=True):
-                    row_texts = [str(cell).strip() for cell in row if cell]
-                    if row_texts:
-                        row_line = ' '.join(row_texts)
-                        all_text_lines.append(row_line)
-            wb.close()
-
-            if not all_text_lines:
-                return None
-
-            for search_key, (folder_name, search_type) in self.search_to_folder.items():
-                if search_type == 'content':
-                    for line in all_text_lines:
-                        if search_key in line:
-                            return folder_name
+    def match_content(self, lines, filename):
+        """Папка по ключам в строках файла, которые подаются по мере чтения.
+        Выбирается первый ключ в порядке файла настроек; чтение прекращается, как только решение известно"""
+        matcher = self.content_matcher
+        hits = set()
+        for line in lines:
+            found = set(matcher.iter_hits(line))
+            if found:
+                hits |= found
+                # Первый ключ списка не перебить; в режиме 'first' решает первая строка с ключом
+                if 0 in hits or self.scan_mode == 'first':
+                    break
+        if not hits:
             return None
+        best = min(hits)
+        if len(set(matcher.folders[index] for index in hits)) > 1:
+            self.log_detail(f"  {filename}: найдены ключи разных папок "
+                            f"({'; '.join(matcher.keys[index] for index in sorted(hits))}), "
+                            f"выбран '{matcher.keys[best]}'")
+        return matcher.folders[best]
+
+    def iter_excel_lines(self, wb):
+        """Строки листов в окне поиска (ячейки строки через пробел), лист за листом в заданном порядке"""
+        sheet_names = list(wb.sheetnames)
+        if self.sheet_order == 'active' and wb.active is not None and wb.active.title in sheet_names:
+            sheet_names.remove(wb.active.title)
+            sheet_names.insert(0, wb.active.title)
+        for sheet_name in sheet_names:
+            ws = wb[sheet_name]
+            for row in ws.iter_rows(min_row=1, max_row=EXCEL_MAX_ROWS, min_col=1, max_col=EXCEL_MAX_COLS,
+                                    values_only=True):
+                row_texts = [str(cell).strip() for cell in row if cell]
+                if row_texts:
+                    yield ' '.join(row_texts)
+
+    def open_excel_workbook(self, file_path):
+        """Книга Excel для чтения значений: .xls - своим разбором BIFF (openpyxl его не читает), остальное - openpyxl"""
+        if file_path.lower().endswith('.xls'):
+            return open_xls_workbook(file_path)
+        return openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+
+    def search_exact_in_excel(self, file_path, filename, excel_reader=None):
+        """ТОЧНЫЙ поиск ключей в содержимом Excel файла (строки идут в поиск сразу при чтении)"""
+        excel_reader = excel_reader or self.excel_reader
+        if excel_reader == 'fast' and file_path.lower().endswith('.xlsx'):
+            try:
+                wb = XlsxTextReader(file_path)
+                try:
+                    return self.match_content(self.iter_excel_lines(wb), filename)
+                finally:
+                    wb.close()
+            except Exception as e:
+                self.log_detail(f"Быстрое чтение Excel {filename} не удалось ({e}), читаем через openpyxl")
+        try:
+            wb = self.open_excel_workbook(file_path)
+            try:
+                return self.match_content(self.iter_excel_lines(wb), filename)
+            finally:
+                wb.close()
         except Exception as e:
             self.log_detail(f"Ошибка чтения Excel {filename}: {e}")
             return None
 
+    def iter_pdf_lines(self, pdf_reader):
+        """Непустые строки текста PDF; страница извлекается, только когда до нее дошел поиск"""
+        for page in pdf_reader.pages:
+            text = page.extract_text()
+            if text:
+                for line in text.split('\n'):
+                    line_clean = line.strip()
+                    if line_clean:
+                        yield line_clean
+
+    def benchmark_excel_readers(self):
+        """Сравнение быстрого чтения и openpyxl на .xlsx исходной папки: время и совпадение результатов (файлы не перемещаются)"""
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(self.source_folder)
+                 for name in sorted(names) if name.lower().endswith('.xlsx')]
+        print(f"\n⏱️  Сравнение чтения Excel на {len(files)} файлах .xlsx...")
+        timings = {'fast': 0.0, 'openpyxl': 0.0}
+        mismatches = []
+        for file_path in files:
+            verdicts = {}
+            for reader in ('openpyxl', 'fast'):
+                started = time.perf_counter()
+                verdicts[reader] = self.search_exact_in_excel(file_path, os.path.basename(file_path), reader)
+                timings[reader] += time.perf_counter() - started
+            if verdicts['fast'] != verdicts['openpyxl']:
+                mismatches.append((file_path, verdicts['openpyxl'], verdicts['fast']))
+        print(f"   openpyxl: {timings['openpyxl']:.2f} сек")
+        print(f"   быстрое чтение: {timings['fast']:.2f} сек")
+        if timings['fast'] > 0:
+            print(f"   ускорение: {timings['openpyxl'] / timings['fast']:.1f}x")
+        if mismatches:
+            print(f"❌ Разные результаты: {len(mismatches)}")
+            for file_path, expected, got in mismatches[:20]:
+                print(f"   {file_path}: openpyxl → {expected}, быстрое → {got}")
+        else:
+            print("✅ Результаты поиска совпадают")
+        return not mismatches
+
+    def search_exact_in_word(self, file_path, filename):
+        """ТОЧНЫЙ поиск ключей в содержимом .docx (абзацы идут в поиск по мере чтения)"""
+        try:
+            return self.match_content(iter_docx_lines(file_path), filename)
+        except Exception as e:
+            self.log_detail(f"Ошибка Word {filename}: {e}")
+            return None
+
     def search_exact_in_pdf(self, file_path, filename):
         """ТОЧНЫЙ поиск ключей в содержимом PDF"""
         try:
             import PyPDF2
             with open(file_path, 'rb') as f:
                 pdf_reader = PyPDF2.PdfReader(f)
-                pdf_lines = []
-                for page in pdf_reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        lines = text.split('\n')
-                        for line in lines:
-                            line_clean = line.strip()
-                            if line_clean:
-                                pdf_lines.append(line_clean)
-
-                if pdf_lines:
-                    for search_key, (folder_name, search_type) in self.search_to_folder.items():
-                        if search_type == 'content':
-                            for line in pdf_lines:
-                                if search_key in line:
-                                    return folder_name
-            return None
+                return self.match_content(self.iter_pdf_lines(pdf_reader), filename)
         except Exception as e:
             self.log_detail(f"Ошибка PDF {filename}: {e}")
             return None
@@ -207,15 +947,32 @@ class ReportSorter:
         """Поиск ключей в имени файла, учитывая тип поиска"""
         name_without_ext = os.path.splitext(filename)[0]
         clean_name = re.sub(r'[_\-.]', ' ', name_without_ext.lower())
-
-        for search_key, (folder_name, search_type) in self.search_to_folder.items():
-            if search_type == 'filename':
-                if search_key.lower() in clean_name:
-                    return folder_name
-        return None
+        return self.filename_matcher.find(clean_name)
 
     def identify_report_type(self, file_path):
-        """Поиск ТОЛЬКО в содержимом файлов (оригинальная логика)"""
+        """Поиск ТОЛЬКО в содержимом файлов; для повтора уже проверенного содержимого - готовое решение"""
+        identity = self.file_identity.get(file_path)
+        if identity is not None and identity in self.verdict_cache:
+            self.stats['duplicates'] += 1
+            folder_name = self.verdict_cache[identity]
+            self.log_detail(f"  {os.path.basename(file_path)}: повтор уже проверенного файла, папка: {folder_name}")
+            return folder_name
+        folder_name = self.search_content(self.content_path(file_path))
+        self.remember_verdict(file_path, folder_name)
+        return folder_name
+
+    def content_path(self, file_path):
+        """Файл с содержимым: для указателя дедупликации - копия, на которую он ведет"""
+        return self.pointer_targets.get(file_path, file_path)
+
+    def remember_verdict(self, file_path, folder_name):
+        """Запоминание решения поиска для остальных копий того же содержимого"""
+        identity = self.file_identity.get(file_path)
+        if identity is not None:
+            self.verdict_cache[identity] = folder_name
+
+    def search_content(self, file_path):
+        """Поиск ключей в содержимом файла по его формату"""
         filename = os.path.basename(file_path)
         file_ext = os.path.splitext(filename)[1].lower()
 
@@ -223,8 +980,8 @@ class ReportSorter:
             return self.search_exact_in_excel(file_path, filename)
         elif file_ext == '.pdf':
             return self.search_exact_in_pdf(file_path, filename)
-        elif file_ext in ['.docx', '.doc']:
-            return None
+        elif file_ext == '.docx':
+            return self.search_exact_in_word(file_path, filename)
         return None
 
     def identify_report_type_with_filename(self, file_path):
@@ -241,8 +998,8 @@ class ReportSorter:
             return self.search_exact_in_excel(file_path, filename)
         elif file_ext == '.pdf':
             return self.search_exact_in_pdf(file_path, filename)
-        elif file_ext in ['.docx', '.doc']:
-            return None
+        elif file_ext == '.docx':
+            return self.search_exact_in_word(file_path, filename)
         return None
 
     def get_interactive_choice(self, filename, file_ext, file_path, organization):
@@ -393,6 +1150,7 @@ class ReportSorter:
             return None
 
         self.search_to_folder[search_key] = (folder_name, search_type)
+        self.build_matchers()
         self.stats['new_keys_added'] += 1
         print(f"\n✅ Добавлен ключ поиска: '{search_key}' → папка '{folder_name}' (тип поиска: {search_type})")
 
@@ -443,8 +1201,8 @@ class ReportSorter:
                 return self.search_exact_in_excel(file_path, filename)
             elif file_ext == '.pdf':
                 return self.search_exact_in_pdf(file_path, filename)
-            elif file_ext in ['.docx', '.doc']:
-                return None
+            elif file_ext == '.docx':
+                return self.search_exact_in_word(file_path, filename)
         return None
 
 
@@ -459,8 +1217,9 @@ class ReportSorter:
                 self.unsorted_files.remove((file_path, rel_path, organization))
                 continue
 
-            filename = os.path.basename(file_path)
+            filename = self.display_name(file_path)
             file_ext = os.path.splitext(filename)[1].lower()
+            content_path = self.content_path(file_path)
 
             found = False
             target_folder = None
@@ -476,7 +1235,7 @@ class ReportSorter:
                 if file_ext in ['.xlsx', '.xls']:
                     wb = None
                     try:
-                        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+                        wb = self.open_excel_workbook(content_path)
                         for sheet in wb.sheetnames:
                             ws = wb[sheet]
                             for row in ws.iter_rows(min_row=1, max_row=500, min_col=1, max_col=20, values_only=True):
@@ -497,7 +1256,7 @@ class ReportSorter:
                 elif file_ext == '.pdf':
                     try:
                         import PyPDF2
-                        with open(file_path, 'rb') as f:
+                        with open(content_path, 'rb') as f:
                             pdf_reader = PyPDF2.PdfReader(f)
                             for page in pdf_reader.pages:
                                 text = page.extract_text()
@@ -507,6 +1266,13 @@ class ReportSorter:
                                     break
                     except Exception as e:
                         self.log_detail(f"Ошибка PDF при ресортировке {filename}: {e}")
+                elif file_ext == '.docx':
+                    try:
+                        if any(new_search_key in line for line in iter_docx_lines(content_path)):
+                            target_folder = self.search_to_folder[new_search_key][0]
+                            found = True
+                    except Exception as e:
+                        self.log_detail(f"Ошибка Word при ресортировке {filename}: {e}")
 
             if found:
                 print(f"   ✅ Найдено: {filename} → {target_folder}")
@@ -526,7 +1292,7 @@ class ReportSorter:
         """Получение предпросмотра содержимого файла"""
         try:
             if file_ext in ['.xlsx', '.xls']:
-                wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+                wb = self.open_excel_workbook(file_path)
                 sheet = wb.active
                 preview_lines = []
                 for i, row in enumerate(sheet.iter_rows(min_row=1, max_row=10, values_only=True), 1):
@@ -544,6 +1310,14 @@ class ReportSorter:
                         return text[:max_chars] + ('...' if len(text) > max_chars else '')
                 except Exception:
                     return "[Не удалось прочитать содержимое PDF]"
+            elif file_ext == '.docx':
+                preview_lines = []
+                for line in iter_docx_lines(file_path):
+                    preview_lines.append(line)
+                    if sum(len(preview_line) for preview_line in preview_lines) >= max_chars:
+                        break
+                text = '\n'.join(preview_lines)
+                return text[:max_chars] + ('...' if len(text) > max_chars else '')
             else:
                 return "[Просмотр содержимого недоступен для этого формата]"
         except Exception as e:
@@ -713,7 +1487,7 @@ class ReportSorter:
         os.makedirs(target_dir, exist_ok=True)
         self.found_folders.add(safe_folder_name)
 
-        original_filename = os.path.basename(source_path)
+        original_filename = self.display_name(source_path)
         # Извлекаем дату из пути источника, если не передана
         if source_date_part is None:
             # Путь может быть: Организации_и_письма/Название_организации/2024-01-15_1430/файл.xlsx
@@ -729,15 +1503,19 @@ class ReportSorter:
         final_filename = self.create_final_filename(original_filename, organization, target_folder_name, source_date_part)
         target_path = os.path.join(target_dir, final_filename)
 
-        # Если файл уже существует, добавляем номер
+        # Если файл (или указатель с тем же именем) уже существует, добавляем номер
         counter = 1
         base_name, ext = os.path.splitext(target_path)
-        while os.path.exists(target_path):
+        while os.path.exists(target_path) or os.path.exists(target_path + DEDUP_POINTER_SUFFIX):
             target_path = f"{base_name}_{counter}{ext}"
             counter += 1
 
         try:
-            shutil.move(source_path, target_path)
+            if source_path in self.pointer_targets:
+                self.move_pointer(source_path, target_path)
+            else:
+                shutil.move(source_path, target_path)
+                self.moved_paths[os.path.abspath(source_path)] = os.path.abspath(target_path)
             self.stats['moved'] += 1
             log_msg = f"  ПЕРЕМЕЩЕН в: {safe_folder_name}/{os.path.basename(target_path)}"
             if counter > 1:
@@ -752,25 +1530,87 @@ class ReportSorter:
             self.stats['errors'] += 1
             return False
 
+    def display_name(self, file_path):
+        """Имя файла без окончания указателя дедупликации"""
+        filename = os.path.basename(file_path)
+        if file_path in self.pointer_targets:
+            return filename[:-len(DEDUP_POINTER_SUFFIX)]
+        return filename
+
+    def read_pointer(self, pointer_path):
+        """Путь копии, на которую ведет указатель дедупликации парсера, или None, если копии нет"""
+        try:
+            with open(pointer_path, 'r', encoding='utf-8') as f:
+                target_path = os.path.normpath(os.path.join(os.path.dirname(pointer_path), f.read().strip()))
+        except OSError as e:
+            self.log_detail(f"  Не удалось прочитать указатель {pointer_path}: {e}")
+            return None
+        if not os.path.isfile(target_path):
+            self.log_detail(f"  Указатель {pointer_path} ведет к отсутствующему файлу {target_path}")
+            return None
+        return target_path
+
+    def write_pointer(self, pointer_path, target_path):
+        """Указатель с относительным путем к копии (текущее место копии, если ее уже переместили)"""
+        target_path = self.moved_paths.get(os.path.abspath(target_path), target_path)
+        with open(pointer_path, 'w', encoding='utf-8') as f:
+            f.write(os.path.relpath(target_path, os.path.dirname(pointer_path)) + '\n')
+
+    def move_pointer(self, pointer_path, file_path):
+        """Перенос указателя под именем file_path: копия с содержимым остается одна"""
+        target_path = self.pointer_targets.pop(pointer_path)
+        new_pointer_path = file_path + DEDUP_POINTER_SUFFIX
+        self.write_pointer(new_pointer_path, target_path)
+        os.remove(pointer_path)
+        self.pointer_targets[new_pointer_path] = target_path
+
+    def update_pointers(self):
+        """Указатели, чьи копии переместили после них (и указатели хранилища парсера), - на новое место копий"""
+        updated = 0
+        for pointer_path, target_path in self.pointer_targets.items():
+            if os.path.abspath(target_path) in self.moved_paths and os.path.isfile(pointer_path):
+                self.write_pointer(pointer_path, target_path)
+                updated += 1
+        if updated:
+            self.log_detail(f"Указателей дедупликации обновлено: {updated}")
+
     def scan_all_files(self):
-        """Сканирование всех файлов"""
+        """Сканирование всех файлов; указатели дедупликации сортируются как файлы, повторы содержимого отмечаются"""
         print(f"\n🔍 Сканирование папки: {self.source_folder}")
         all_files = []
         for root, dirs, files in os.walk(self.source_folder):
             for file in files:
-                file_ext = os.path.splitext(file)[1].lower()
-                if file_ext in self.supported_formats:
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(root, self.source_folder)
-                    all_files.append((file_path, rel_path))
+                file_path = os.path.join(root, file)
+                identity_path = file_path
+                if file.endswith(DEDUP_POINTER_SUFFIX):
+                    target_path = self.read_pointer(file_path)
+                    if target_path is None:
+                        continue
+                    # Указатели хранилища парсера не сортируются, но после перемещения копии обновляются
+                    self.pointer_targets[file_path] = target_path
+                    file_ext = os.path.splitext(file[:-len(DEDUP_POINTER_SUFFIX)])[1].lower()
+                    if file_ext not in self.supported_formats:
+                        continue
+                    identity_path = target_path
+                else:
+                    file_ext = os.path.splitext(file)[1].lower()
+                    if file_ext not in self.supported_formats:
+                        continue
+                rel_path = os.path.relpath(root, self.source_folder)
+                all_files.append((file_path, rel_path))
+                try:
+                    stat = os.stat(identity_path)
+                    self.file_identity[file_path] = (stat.st_dev, stat.st_ino)
+                except OSError:
+                    pass
 
         self.stats['total_files'] = len(all_files)
         print(f"✅ Найдено файлов: {self.stats['total_files']}")
         self.all_files_original = all_files.copy()
         return all_files
 
-    def process_file(self, file_info):
-        """Обработка одного файла"""
+    def process_file(self, file_info, verdict=None):
+        """Обработка одного файла (verdict - готовое решение поиска из рабочего процесса)"""
         file_path, rel_path = file_info
         try:
             self.stats['processed'] += 1
@@ -788,7 +1628,14 @@ class ReportSorter:
 
             organization = self.extract_organization_from_path(file_path, rel_path)
 
-            folder_name = self.identify_report_type(file_path)
+            if verdict is None:
+                folder_name = self.identify_report_type(file_path)
+            else:
+                _, folder_name, match_stats, error = verdict
+                for key, value in match_stats.items():
+                    self.stats[key] += value
+                if error:
+                    raise RuntimeError(error)
 
             if folder_name:
                 self.stats['exact_matches'] += 1
@@ -830,13 +1677,14 @@ class ReportSorter:
                 print(f"\n⚠️  Файл уже перемещен, пропускаем")
                 continue
 
-            filename = os.path.basename(file_path)
+            filename = self.display_name(file_path)
             file_ext = os.path.splitext(filename)[1].lower()
 
             print(f"\n📋 Файл {i}/{len(unsorted_copy)}: {filename}")
             print(f"   Организация: {organization}")
 
-            folder_choice = self.get_interactive_choice(filename, file_ext, file_path, organization)
+            # Просмотр и поиск - по файлу с содержимым (для указателя - по копии)
+            folder_choice = self.get_interactive_choice(filename, file_ext, self.content_path(file_path), organization)
 
             if folder_choice:
                 self.stats['interactive_choices'] += 1
@@ -896,8 +1744,34 @@ class ReportSorter:
             print(f"✅ Удалено {deleted_dirs_count} папок по условию.")
 
 
-    def process_all_files(self, max_workers=4):
-        """Обработка всех файлов"""
+    def process_files_in_processes(self, all_files, max_workers):
+        """Поиск в содержимом в пуле процессов; перемещение файлов и статистика - в основном процессе"""
+        results = []
+        print(f"\n🔀 Поиск в содержимом в {max_workers} процессах (по {PROCESS_CHUNK_SIZE} файлов на задачу)...")
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_sort_worker,
+                                 initargs=(self,)) as executor:
+            # Ошибки поиска возвращаются в решении, поэтому map не прерывается на отдельном файле
+            for verdict in executor.map(identify_in_worker, all_files, chunksize=PROCESS_CHUNK_SIZE):
+                if not verdict[3]:
+                    self.remember_verdict(verdict[0][0], verdict[1])
+                results.append(self.process_file(verdict[0], verdict))
+        return results
+
+    def split_duplicates(self, all_files):
+        """Первые копии каждого содержимого и повторы (повторы обрабатываются после, по готовым решениям)"""
+        first_files, duplicate_files = [], []
+        seen = set()
+        for file_info in all_files:
+            identity = self.file_identity.get(file_info[0])
+            if identity is not None and identity in seen:
+                duplicate_files.append(file_info)
+            else:
+                seen.add(identity)
+                first_files.append(file_info)
+        return first_files, duplicate_files
+
+    def process_all_files(self, max_workers=4, backend='thread'):
+        """Обработка всех файлов (backend: 'thread' - пул потоков, 'process' - поиск в пуле процессов)"""
         if not self.load_report_names():
             return False
 
@@ -958,11 +1832,17 @@ class ReportSorter:
             # Обработка файлов в интерактивном режиме
             if self.unsorted_files:
                 self.process_interactive_files()
+        elif backend == 'process':
+            # Чтение Excel и PDF упирается в процессор - потоки мешают друг другу из-за GIL
+            first_files, duplicate_files = self.split_duplicates(all_files)
+            results = self.process_files_in_processes(first_files, max_workers)
+            results.extend(self.process_file(file_info) for file_info in duplicate_files)
         else:
-            # Неинтерактивный режим - используем многопоточность
+            # Неинтерактивный режим - используем многопоточность; повторы - после первых копий
+            first_files, duplicate_files = self.split_duplicates(all_files)
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 future_to_file = {executor.submit(self.process_file, file_info): file_info
-                                  for file_info in all_files}
+                                  for file_info in first_files}
                 for future in as_completed(future_to_file):
                     try:
                         result = future.result()
@@ -971,6 +1851,10 @@ class ReportSorter:
                         error_msg = f"Ошибка в потоке: {e}"
                         print(f"❌ {error_msg}")
                         self.log_detail(error_msg)
+            results.extend(self.process_file(file_info) for file_info in duplicate_files)
+
+        # Указатели, перенесенные раньше своих копий, ведут к новому месту копий
+        self.update_pointers()
 
         # --- НОВОЕ ---
         # Выполняем очистку после завершения основной сортировки
@@ -1016,6 +1900,7 @@ class ReportSorter:
             f.write(f"Успешно перемещено: {self.stats['moved']}\n")
             f.write(f"Точных совпадений в содержимом: {self.stats['exact_matches']}\n")
             f.write(f"Совпадений по имени файла (после добавления ключей): {self.stats['name_matches']}\n")
+            f.write(f"Повторов (решение первой копии, без повторного чтения): {self.stats['duplicates']}\n")
             if self.interactive:
                 f.write(f"Интерактивных выборов: {self.stats['interactive_choices']}\n")
                 f.write(f"Добавлено новых ключей: {self.stats['new_keys_added']}\n")
@@ -1096,6 +1981,19 @@ def main():
     parser.add_argument('--config', required=True, help='Файл с названиями отчетов и ключами поиска')
     parser.add_argument('--interactive', action='store_true', help='Интерактивный режим')
     parser.add_argument('--workers', type=int, default=4, help='Количество потоков (по умолчанию: 4)')
+    parser.add_argument('--backend', choices=['thread', 'process'], default='thread',
+                        help='Поиск в содержимом: thread - потоки, process - процессы (по умолчанию: thread)')
+    parser.add_argument('--scan', choices=['full', 'first'], default='full',
+                        help='full - читать все окно файла и выбрать первый ключ по порядку настроек, '
+                             'first - остановиться на первой строке с ключом (по умолчанию: full)')
+    parser.add_argument('--sheet-order', choices=['workbook', 'active'], default='workbook',
+                        help='Порядок листов Excel: workbook - как в книге, active - сначала активный лист '
+                             '(по умолчанию: workbook)')
+    parser.add_argument('--excel-reader', choices=['fast', 'openpyxl'], default='fast',
+                        help='Чтение .xlsx: fast - напрямую из zip с откатом на openpyxl, openpyxl - только openpyxl '
+                             '(по умолчанию: fast)')
+    parser.add_argument('--benchmark-excel', action='store_true',
+                        help='Только сравнить скорость и результаты чтения .xlsx (fast и openpyxl), файлы не перемещать')
 
     args = parser.parse_args()
 
@@ -1107,6 +2005,10 @@ def main():
     print(f"Файл настроек: {args.config}")
     print(f"Интерактивный режим: {'Да' if args.interactive else 'Нет'}")
     print(f"Потоков обработки: {args.workers}")
+    print(f"Поиск в содержимом: {'процессы' if args.backend == 'process' else 'потоки'}")
+    print(f"Чтение содержимого: {'до первой строки с ключом' if args.scan == 'first' else 'все окно файла'}, "
+          f"листы Excel: {'сначала активный' if args.sheet_order == 'active' else 'по порядку книги'}")
+    print(f"Чтение .xlsx: {'openpyxl' if args.excel_reader == 'openpyxl' else 'быстрое (с откатом на openpyxl)'}")
     print("="*80)
     print("⚠️  ВНИМАНИЕ: Файлы будут ПЕРЕМЕЩЕНЫ, а не скопированы!")
     print("⚠️  Рекомендуется сделать резервную копию перед запуском!")
@@ -1133,11 +2035,19 @@ def main():
         source_folder=args.source,
         output_folder=args.output,
         report_names_file=args.config,
-        interactive=args.interactive
+        interactive=args.interactive,
+        scan_mode=args.scan,
+        sheet_order=args.sheet_order,
+        excel_reader=args.excel_reader
     )
 
+    if args.benchmark_excel:
+        sorter.benchmark_excel_readers()
+        return
+
     try:
-        success = sorter.process_all_files(max_workers=args.workers if not args.interactive else 1)
+        success = sorter.process_all_files(max_workers=args.workers if not args.interactive else 1,
+                                           backend=args.backend)
         if success:
             print("\n✅ Сортировка завершена успешно!")
             print(f"\n📁 Результаты в папке: {args.output}")